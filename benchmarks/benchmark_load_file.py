@@ -0,0 +1,52 @@
+"""
+Compare loading a CSV file with row at a time inserts against the COPY based bulk load.
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+
+from benchmark_utilities import load_config, get_db_connection, run_pipeline
+
+
+def write_summary_file(file_name, number_of_rows):
+    """Write a CSV file shaped like test/test_summary_file.csv"""
+    with open(file_name, "w", newline="") as fw:
+        csv_writer = csv.writer(fw)
+        csv_writer.writerow(["eid", "person_id", "month_of_birth", "year_of_birth", "admit_date", "discharge_date",
+                             "drg", "group"])
+        for i in range(number_of_rows):
+            csv_writer.writerow([i, "p%s" % i, "%02d" % (i % 12 + 1), 1930 + i % 80, "2014-01-01", "2014-01-02",
+                                 str(700 + i % 100), str(i % 3)])
+
+
+def main(config_json_filename, db_schema, number_of_rows):
+
+    config_dict = load_config(config_json_filename)
+    connection, meta_data = get_db_connection(config_dict, db_schema)
+
+    file_directory = tempfile.mkdtemp()
+    write_summary_file(os.path.join(file_directory, "summary_file.csv"), number_of_rows)
+
+    for bulk_load in (False, True):
+        pipeline_structure = [
+            {"step_number": 1, "data_transformation_class": "Load file", "name": "Load main file",
+             "parameters": {"file_name": "summary_file.csv", "file_type": "csv", "common_id_field_name": "eid",
+                            "bulk_load": bulk_load}}]
+
+        pipeline_name = "benchmark load file bulk_load=%s" % bulk_load
+        elapsed_time = run_pipeline(pipeline_name, pipeline_structure, connection, meta_data, file_directory)
+        print("bulk_load=%s: %s rows in %.2f seconds (%.1f rows/sec)" % (bulk_load, number_of_rows, elapsed_time,
+                                                                       number_of_rows / elapsed_time))
+
+
+if __name__ == "__main__":
+    arg_parse_obj = argparse.ArgumentParser(description="Benchmark loading a CSV file into the database")
+    arg_parse_obj.add_argument("-c", "--config-json-filename", dest="config_json_filename", default="./config.json")
+    arg_parse_obj.add_argument("-s", "--db-schema", dest="db_schema", default="benchmark",
+                               help="Schema to drop and recreate for the benchmark")
+    arg_parse_obj.add_argument("-n", "--number-of-rows", dest="number_of_rows", type=int, default=100000)
+
+    arg_obj = arg_parse_obj.parse_args()
+    main(arg_obj.config_json_filename, arg_obj.db_schema, arg_obj.number_of_rows)
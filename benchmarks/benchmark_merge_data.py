@@ -0,0 +1,83 @@
+"""
+Time 4 and 8 way merges of loaded steps and the growth of the data_transformations table in each job.
+"""
+
+import argparse
+import csv
+import os
+import tempfile
+
+from benchmark_utilities import load_config, get_db_connection, run_pipeline
+
+
+def write_step_file(file_name, step_index, number_of_rows):
+    """Write a CSV file with fields specific to a step so the merged record grows with each step"""
+    with open(file_name, "w", newline="") as fw:
+        csv_writer = csv.writer(fw)
+        csv_writer.writerow(["eid"] + ["s%s_f%s" % (step_index, j) for j in range(5)])
+        for i in range(number_of_rows):
+            csv_writer.writerow([i] + ["%s-%s" % (i, j) for j in range(5)])
+
+
+def get_table_size(connection, meta_data):
+    return list(connection.execute("select pg_total_relation_size('%s.data_transformations')" % meta_data.schema))[0][0]
+
+
+def get_merge_step_elapsed_time(connection, meta_data, merge_step_number):
+    schema = meta_data.schema
+    sql_statement = """
+select extract(epoch from pjdts.end_date_time - pjdts.start_date_time)
+    from %s.pipeline_jobs_data_transformation_steps pjdts
+    join %s.data_transformation_steps dts on pjdts.data_transformation_step_id = dts.id
+    where dts.step_number = %s order by pjdts.id desc limit 1""" % (schema, schema, merge_step_number)
+    return float(list(connection.execute(sql_statement))[0][0])
+
+
+def main(config_json_filename, db_schema, number_of_rows):
+
+    config_dict = load_config(config_json_filename)
+    connection, meta_data = get_db_connection(config_dict, db_schema)
+
+    file_directory = tempfile.mkdtemp()
+    for step_index in range(1, 9):
+        write_step_file(os.path.join(file_directory, "step_%s.csv" % step_index), step_index, number_of_rows)
+
+    for number_of_steps in (4, 8):
+
+        pipeline_structure = []
+        for step_index in range(1, number_of_steps + 1):
+            pipeline_structure += [
+                {"step_number": step_index, "data_transformation_class": "Load file", "name": "Load %s" % step_index,
+                 "parameters": {"file_name": "step_%s.csv" % step_index, "file_type": "csv",
+                                "common_id_field_name": "eid", "bulk_load": True}}]
+
+        # Key every other step by a field name to include jsonb_insert in the merge
+        step_numbers = [step_index if step_index % 2 else [step_index, "step_%s" % step_index]
+                        for step_index in range(1, number_of_steps + 1)]
+        merge_step_number = number_of_steps + 1
+        pipeline_structure += [{"step_number": merge_step_number, "data_transformation_class": "Merge",
+                                "name": "Merge %s steps" % number_of_steps,
+                                "parameters": {"step_numbers": step_numbers}}]
+
+        pipeline_name = "benchmark %s way merge" % number_of_steps
+
+        table_size_before_job = get_table_size(connection, meta_data)
+        run_pipeline(pipeline_name, pipeline_structure, connection, meta_data, file_directory)
+        table_size_growth = get_table_size(connection, meta_data) - table_size_before_job
+
+        elapsed_time = get_merge_step_elapsed_time(connection, meta_data, merge_step_number)
+
+        print("%s way merge: %s rows in %.2f seconds (%.1f rows/sec), data_transformations grew %.1f MB in the job" %
+              (number_of_steps, number_of_rows, elapsed_time, number_of_rows / elapsed_time,
+               table_size_growth / (1024.0 * 1024.0)))
+
+
+if __name__ == "__main__":
+    arg_parse_obj = argparse.ArgumentParser(description="Benchmark merging data from multiple steps")
+    arg_parse_obj.add_argument("-c", "--config-json-filename", dest="config_json_filename", default="./config.json")
+    arg_parse_obj.add_argument("-s", "--db-schema", dest="db_schema", default="benchmark",
+                               help="Schema to drop and recreate for the benchmark")
+    arg_parse_obj.add_argument("-n", "--number-of-rows", dest="number_of_rows", type=int, default=100000)
+
+    arg_obj = arg_parse_obj.parse_args()
+    main(arg_obj.config_json_filename, arg_obj.db_schema, arg_obj.number_of_rows)
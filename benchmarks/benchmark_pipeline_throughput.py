@@ -0,0 +1,228 @@
+"""
+Run the reference Load -> Coalesce -> Merge -> Map -> Indicator -> Score -> Merge -> Write pipeline on synthetic
+encounters and diagnosis codes shaped like test/test_summary_file.csv and test/test_summary_dx_list.csv. Rows/sec of
+each step are written as JSON which can be compared against the JSON of another commit with --compare.
+"""
+
+import argparse
+import csv
+import datetime
+import json
+import os
+import random
+import subprocess
+import tempfile
+
+from benchmark_utilities import load_config, get_db_connection, run_pipeline
+
+scales = {"10K": 10000, "1M": 1000000, "10M": 10000000}
+
+
+def code_vocabulary(code_vocabulary_size):
+    """ICD-10 like codes, e.g., N10 and E119"""
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    return ["%s%s" % (letters[i % len(letters)], 10 + i // len(letters)) for i in range(code_vocabulary_size)]
+
+
+def write_synthetic_files(file_directory, number_of_encounters, dx_codes_per_encounter, codes, seed=1):
+    """Write a summary file with a row per encounter and a DX list with on average dx_codes_per_encounter codes for
+    each encounter"""
+
+    random_obj = random.Random(seed)
+    start_date = datetime.date(2014, 1, 1)
+
+    with open(os.path.join(file_directory, "summary_file.csv"), "w", newline="") as fw:
+        csv_writer = csv.writer(fw)
+        csv_writer.writerow(["eid", "person_id", "month_of_birth", "year_of_birth", "admit_date", "discharge_date",
+                             "drg", "group"])
+        for i in range(number_of_encounters):
+            admit_date = start_date + datetime.timedelta(days=random_obj.randint(0, 1000))
+            discharge_date = admit_date + datetime.timedelta(days=random_obj.randint(0, 14))
+            csv_writer.writerow([i, "p%s" % random_obj.randint(0, number_of_encounters // 2),
+                                 "%02d" % random_obj.randint(1, 12), random_obj.randint(1920, 2010),
+                                 admit_date.isoformat(), discharge_date.isoformat(), random_obj.randint(1, 999),
+                                 random_obj.randint(1, 3)])
+
+    with open(os.path.join(file_directory, "summary_dx_list.csv"), "w", newline="") as fw:
+        csv_writer = csv.writer(fw)
+        csv_writer.writerow(["eid", "seq_id", "poa", "code"])
+        for i in range(number_of_encounters):
+            for seq_id in range(1, random_obj.randint(1, 2 * dx_codes_per_encounter - 1) + 1):
+                csv_writer.writerow([i, seq_id, random_obj.randint(0, 1), random_obj.choice(codes)])
+
+
+def reference_pipeline_structure(codes, number_of_groups=10, bulk_load=True):
+    """The pipeline of test/test_pipeline_build.json where one in four codes is mapped to one of number_of_groups
+    groups which are the variables of the logistic regression model"""
+
+    mapping_rules = {}
+    for i, code in enumerate(codes[::4]):
+        mapping_rules[code] = "G%s" % (i % number_of_groups)
+
+    model_parameters = {"intercept": -5.0}
+    for j in range(number_of_groups):
+        model_parameters["G%s" % j] = 0.1 * (j + 1)
+
+    return [
+        {"step_number": 1, "data_transformation_class": "Load file", "name": "Load main file",
+         "parameters": {"file_name": "summary_file.csv", "file_type": "csv", "common_id_field_name": "eid",
+                        "bulk_load": bulk_load}},
+        {"step_number": 2, "data_transformation_class": "Load file", "name": "Load DX file",
+         "parameters": {"file_name": "summary_dx_list.csv", "file_type": "csv", "common_id_field_name": "eid",
+                        "bulk_load": bulk_load}},
+        {"step_number": 3, "data_transformation_class": "Coalesce", "name": "Create DX list",
+         "parameters": {"step_number": 2, "field_name": "dx_list"}},
+        {"step_number": 4, "data_transformation_class": "Merge", "name": "Merge records together",
+         "parameters": {"step_numbers": [1, 3]}},
+        {"step_number": 5, "data_transformation_class": "Map with Dict", "name": "Translate codes",
+         "parameters": {"step_number": 4, "fields_to_map": ["dx_list", "code"], "mapping_rules": mapping_rules}},
+        {"step_number": 6, "data_transformation_class": "Transform indicator list to dict",
+         "name": "Change indicator to dict", "parameters": {"step_number": 5}},
+        {"step_number": 7, "data_transformation_class": "Score", "name": "Score with logistic regression",
+         "parameters": {"step_number": 6, "model_name": "Logistic regression", "model_parameters": model_parameters}},
+        {"step_number": 8, "data_transformation_class": "Merge", "name": "Merge scores",
+         "parameters": {"step_numbers": [4, [5, "transformed_dx"], [7, "model_score"]]}},
+        {"step_number": 9, "data_transformation_class": "Write file", "name": "Write results",
+         "parameters": {"file_name": "benchmark_output.json", "file_type": "JSON", "step_number": 8}}
+    ]
+
+
+def get_step_throughput(connection, meta_data, pipeline_name):
+    """Metrics of each step in the latest job of the pipeline; rows are the larger of rows read and written"""
+
+    schema = meta_data.schema
+    sql_statement = """
+select dts.step_number, dts.name, dtsc.name as data_transformation_class, m.rows_read, m.rows_written,
+    m.bytes_written, m.wall_time, m.db_time, m.python_time
+  from %s.data_transformation_step_metrics m
+    join %s.pipeline_jobs_data_transformation_steps pjdts on pjdts.id = m.pipeline_job_data_transformation_step_id
+    join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+    join %s.data_transformation_step_classes dtsc on dtsc.id = dts.data_transformation_step_class_id
+    join %s.pipelines p on p.id = dts.pipeline_id
+  where p.name = '%s' and pjdts.pipeline_job_id = (select max(pjdts2.pipeline_job_id)
+    from %s.pipeline_jobs_data_transformation_steps pjdts2 where pjdts2.data_transformation_step_id = dts.id)
+  order by dts.step_number""" % (schema, schema, schema, schema, schema, pipeline_name, schema)
+
+    steps = []
+    for r in connection.execute(sql_statement):
+        number_of_rows = max(r.rows_read or 0, r.rows_written or 0)
+        steps += [{"step_number": r.step_number, "name": r.name,
+                   "data_transformation_class": r.data_transformation_class, "rows_read": r.rows_read,
+                   "rows_written": r.rows_written, "bytes_written": r.bytes_written, "wall_time": r.wall_time,
+                   "db_time": r.db_time, "python_time": r.python_time,
+                   "rows_per_second": number_of_rows / r.wall_time if r.wall_time > 0 else None}]
+    return steps
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.split(os.path.abspath(__file__))[0]).decode("utf8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline_results, max_slowdown=0.2):
+    """Print the change in rows/sec of each step against a baseline; returns the steps which slowed by more than
+    max_slowdown"""
+
+    baseline_steps = dict([(s["step_number"], s) for s in baseline_results["steps"]])
+    print("Compared with %s (%s encounters)" % (baseline_results["commit"], baseline_results["number_of_encounters"]))
+
+    slower_steps = []
+    for step in results["steps"]:
+        baseline_step = baseline_steps.get(step["step_number"])
+        if baseline_step is None or not step["rows_per_second"] or not baseline_step["rows_per_second"]:
+            continue
+
+        ratio = step["rows_per_second"] / baseline_step["rows_per_second"]
+        flag = ""
+        if ratio < 1.0 - max_slowdown:
+            slower_steps += [step["step_number"]]
+            flag = " slower"
+
+        print("  Step %s '%s': %.1f rows/sec vs %.1f rows/sec (%.2fx)%s" % (
+            step["step_number"], step["name"], step["rows_per_second"], baseline_step["rows_per_second"], ratio, flag))
+
+    return slower_steps
+
+
+def main(config_json_filename, db_schema, number_of_encounters, dx_codes_per_encounter, code_vocabulary_size,
+         output_json_filename=None, baseline_json_filename=None, max_slowdown=0.2, bulk_load=True, seed=1):
+
+    config_dict = load_config(config_json_filename)
+    connection, meta_data = get_db_connection(config_dict, db_schema)
+
+    jobs_options = {}
+    for option_name in ["write_batch_size", "stream_results", "fetch_size", "max_parallel_steps", "commit_chunk_size"]:
+        if option_name in config_dict:
+            jobs_options[option_name] = config_dict[option_name]
+
+    codes = code_vocabulary(code_vocabulary_size)
+
+    file_directory = tempfile.mkdtemp()
+    write_synthetic_files(file_directory, number_of_encounters, dx_codes_per_encounter, codes, seed)
+
+    pipeline_name = "benchmark reference pipeline"
+    elapsed_time = run_pipeline(pipeline_name, reference_pipeline_structure(codes, bulk_load=bulk_load), connection,
+                                meta_data, file_directory, **jobs_options)
+
+    results = {"commit": get_commit(),
+               "number_of_encounters": number_of_encounters,
+               "dx_codes_per_encounter": dx_codes_per_encounter,
+               "code_vocabulary_size": code_vocabulary_size,
+               "bulk_load": bulk_load,
+               "jobs_options": jobs_options,
+               "wall_time": elapsed_time,
+               "steps": get_step_throughput(connection, meta_data, pipeline_name)}
+
+    print("%s encounters in %.2f seconds" % (number_of_encounters, elapsed_time))
+    for step in results["steps"]:
+        print("  Step %s '%s': %s rows in %.2f seconds (%s rows/sec)" % (
+            step["step_number"], step["name"], max(step["rows_read"] or 0, step["rows_written"] or 0), step["wall_time"],
+            "%.1f" % step["rows_per_second"] if step["rows_per_second"] else "-"))
+
+    if output_json_filename is not None:
+        with open(output_json_filename, "w") as fw:
+            json.dump(results, fw, indent=4, sort_keys=True)
+
+    if baseline_json_filename is not None:
+        with open(baseline_json_filename) as f:
+            baseline_results = json.load(f)
+        return compare_results(results, baseline_results, max_slowdown)
+
+    return []
+
+
+if __name__ == "__main__":
+    arg_parse_obj = argparse.ArgumentParser(description="Benchmark the rows/sec of each step of the reference pipeline")
+    arg_parse_obj.add_argument("-c", "--config-json-filename", dest="config_json_filename", default="./config.json")
+    arg_parse_obj.add_argument("-s", "--db-schema", dest="db_schema", default="benchmark",
+                               help="Schema to drop and recreate for the benchmark")
+    arg_parse_obj.add_argument("--scale", dest="scale", choices=sorted(scales.keys()), default="10K",
+                               help="Number of encounters")
+    arg_parse_obj.add_argument("-n", "--number-of-encounters", dest="number_of_encounters", type=int, default=None,
+                               help="Overrides --scale")
+    arg_parse_obj.add_argument("--dx-codes-per-encounter", dest="dx_codes_per_encounter", type=int, default=5)
+    arg_parse_obj.add_argument("--code-vocabulary-size", dest="code_vocabulary_size", type=int, default=1000)
+    arg_parse_obj.add_argument("--no-bulk-load", dest="bulk_load", action="store_false", default=True)
+    arg_parse_obj.add_argument("--seed", dest="seed", type=int, default=1)
+    arg_parse_obj.add_argument("-o", "--output-json-filename", dest="output_json_filename", default=None)
+    arg_parse_obj.add_argument("--compare", dest="baseline_json_filename", default=None,
+                               help="JSON written by -o for another commit")
+    arg_parse_obj.add_argument("--max-slowdown", dest="max_slowdown", type=float, default=0.2,
+                               help="Fraction of the baseline rows/sec a step can lose before it is reported as slower")
+
+    arg_obj = arg_parse_obj.parse_args()
+
+    if arg_obj.number_of_encounters is None:
+        number_of_encounters = scales[arg_obj.scale]
+    else:
+        number_of_encounters = arg_obj.number_of_encounters
+
+    slower_steps = main(arg_obj.config_json_filename, arg_obj.db_schema, number_of_encounters,
+                        arg_obj.dx_codes_per_encounter, arg_obj.code_vocabulary_size, arg_obj.output_json_filename,
+                        arg_obj.baseline_json_filename, arg_obj.max_slowdown, arg_obj.bulk_load, arg_obj.seed)
+
+    if len(slower_steps):
+        raise SystemExit("Steps %s are slower than the baseline" % slower_steps)
@@ -0,0 +1,64 @@
+"""
+Compare scoring against an HTTP REST model a request at a time without connection reuse, with the pooled session
+of HTTPRestModel, and with batches of records per request. Run test/rest_scoring_test_server.py first.
+"""
+
+import argparse
+import random
+import time
+import requests
+
+import benchmark_utilities  # Sets the import path of data_extract_transform_score
+from data_extract_transform_score.models import HTTPRestModel
+
+
+def random_input_dicts(number_of_records):
+    return [{"X": float(random.randint(0, 1)), "Y": float(random.randint(0, 1))} for i in range(number_of_records)]
+
+
+def score_without_session(url, input_dicts):
+    return [requests.post(url, json=input_dict).json() for input_dict in input_dicts]
+
+
+def score_with_session(url, input_dicts):
+    model_obj = HTTPRestModel({"url": url})
+    scored_list = [model_obj.score(input_dict) for input_dict in input_dicts]
+    model_obj.close()
+    return scored_list
+
+
+def score_with_batches(url, batch_url, input_dicts, batch_size):
+    model_obj = HTTPRestModel({"url": url, "batch_url": batch_url})
+    scored_list = []
+    for i in range(0, len(input_dicts), batch_size):
+        scored_list += model_obj.score_batch(input_dicts[i:i + batch_size])
+    model_obj.close()
+    return scored_list
+
+
+def main(url, batch_url, number_of_records, batch_size):
+
+    input_dicts = random_input_dicts(number_of_records)
+
+    modes = [("requests.post", lambda: score_without_session(url, input_dicts)),
+             ("pooled session", lambda: score_with_session(url, input_dicts)),
+             ("batches of %s" % batch_size, lambda: score_with_batches(url, batch_url, input_dicts, batch_size))]
+
+    for mode_name, score_func in modes:
+        start_time = time.time()
+        scored_list = score_func()
+        elapsed_time = time.time() - start_time
+        print("%s: %s records in %.2f seconds (%.1f records/sec)" % (mode_name, len(scored_list), elapsed_time,
+                                                                    len(scored_list) / elapsed_time))
+
+
+if __name__ == "__main__":
+    arg_parse_obj = argparse.ArgumentParser(description="Benchmark scoring against an HTTP REST model")
+    arg_parse_obj.add_argument("-u", "--url", dest="url", default="http://localhost:5000/logistic_regression/")
+    arg_parse_obj.add_argument("-b", "--batch-url", dest="batch_url",
+                               default="http://localhost:5000/logistic_regression/batch/")
+    arg_parse_obj.add_argument("-n", "--number-of-records", dest="number_of_records", type=int, default=2000)
+    arg_parse_obj.add_argument("--batch-size", dest="batch_size", type=int, default=100)
+
+    arg_obj = arg_parse_obj.parse_args()
+    main(arg_obj.url, arg_obj.batch_url, arg_obj.number_of_records, arg_obj.batch_size)
@@ -0,0 +1,154 @@
+"""
+Time the per-record logic of steps on in-memory records without a database: mapping codes, indicator lists to
+dicts, scoring with generalized linear models, registered transformations and converting external database rows
+to JSON. Records are shaped like the records of the reference pipeline in benchmark_pipeline_throughput.py.
+"""
+
+import argparse
+import copy
+import datetime
+import json
+import random
+import sys
+import time
+
+from benchmark_pipeline_throughput import code_vocabulary, reference_pipeline_structure
+
+from data_extract_transform_score.data_transformations import MapDataWithDict, TransformIndicatorListToDict, \
+    ScoreData, ReadFromExternalDB, _load_transformation_registry
+
+
+def generate_merged_records(number_of_records, dx_codes_per_encounter, codes, seed=1):
+    """Records like the output of the merge of the summary file and the DX list"""
+
+    random_obj = random.Random(seed)
+    records = []
+    for i in range(number_of_records):
+        dx_list = [{"eid": str(i), "seq_id": str(seq_id), "poa": str(random_obj.randint(0, 1)),
+                    "code": random_obj.choice(codes)}
+                   for seq_id in range(1, random_obj.randint(1, 2 * dx_codes_per_encounter - 1) + 1)]
+        records += [{"eid": str(i), "person_id": "p%s" % i, "month_of_birth": "%02d" % random_obj.randint(1, 12),
+                     "year_of_birth": str(random_obj.randint(1920, 2010)), "admit_date": "2014-01-01",
+                     "discharge_date": "2014-01-02", "drg": str(random_obj.randint(1, 999)),
+                     "group": str(random_obj.randint(1, 3)), "dx_list": dx_list}]
+    return records
+
+
+def generate_external_rows(number_of_records, seed=1):
+    """Rows as returned from an external database query with a mix of column types and NULLs"""
+
+    random_obj = random.Random(seed)
+    column_names = ["eid", "person_id", "admit_date", "length_of_stay", "drg", "notes"]
+    rows = []
+    for i in range(number_of_records):
+        rows += [(i, "p%s  " % i, datetime.datetime(2014, 1, 1) + datetime.timedelta(days=random_obj.randint(0, 1000)),
+                  random_obj.random() * 10, random_obj.choice([str(random_obj.randint(1, 999)), None]),
+                  "note %s" % i)]
+    return column_names, rows
+
+
+def time_kernel(kernel_name, kernel_function, records, repeat=3, copy_records=False):
+    """Best of repeat runs of the kernel over all records. Kernels which change their records in place are run on
+    copies made outside of the timing."""
+
+    elapsed_times = []
+    for j in range(repeat):
+        if copy_records:
+            kernel_records = copy.deepcopy(records)
+        else:
+            kernel_records = records
+
+        start_time = time.perf_counter()
+        kernel_function(kernel_records)
+        elapsed_times += [time.perf_counter() - start_time]
+
+    elapsed_time = min(elapsed_times)
+    records_per_second = len(records) / elapsed_time if elapsed_time > 0 else None
+    print("%-45s %10s records in %8.3f seconds (%s records/sec)" % (
+        kernel_name, len(records), elapsed_time, "%.1f" % records_per_second if records_per_second else "-"))
+
+    return {"kernel": kernel_name, "records": len(records), "seconds": elapsed_time,
+            "records_per_second": records_per_second}
+
+
+def main(number_of_records, dx_codes_per_encounter, code_vocabulary_size, repeat=3, output_json_filename=None,
+         seed=1):
+
+    codes = code_vocabulary(code_vocabulary_size)
+    steps = dict([(step["step_number"], step) for step in reference_pipeline_structure(codes)])
+
+    merged_records = generate_merged_records(number_of_records, dx_codes_per_encounter, codes, seed)
+
+    map_obj = MapDataWithDict(**steps[5]["parameters"])
+    mapped_records = [map_obj.map_data(record)[0] for record in merged_records]
+    indicator_records = [TransformIndicatorListToDict.indicator_dict(record) for record in mapped_records]
+
+    score_obj = ScoreData(**steps[7]["parameters"])
+    column_names, external_rows = generate_external_rows(number_of_records, seed)
+    external_row_dicts = [dict(zip(column_names, row)) for row in external_rows]
+    read_obj = ReadFromExternalDB()
+
+    results = []
+
+    results += [time_kernel("MapDataWithDict.map_data", lambda records: [map_obj.map_data(r) for r in records],
+                            merged_records, repeat)]
+
+    results += [time_kernel("TransformIndicatorListToDict.indicator_dict",
+                            lambda records: [TransformIndicatorListToDict.indicator_dict(r) for r in records],
+                            mapped_records, repeat)]
+
+    # Models add the intercept to the records they score
+    results += [time_kernel("GeneralizedLinearModel.score",
+                            lambda records: [score_obj.model_obj.score(r) for r in records],
+                            indicator_records, repeat, copy_records=True)]
+
+    def score_in_batches(records):
+        for k in range(0, len(records), score_obj.batch_size):
+            score_obj.model_obj.score_batch(records[k:k + score_obj.batch_size])
+
+    results += [time_kernel("GeneralizedLinearModel.score_batch", score_in_batches, indicator_records, repeat,
+                            copy_records=True)]
+
+    transformation_registry = _load_transformation_registry()
+    for transformation_name in sorted(transformation_registry.transformation_name_dict.keys()):
+        transformation_func = transformation_registry.transformation_name_dict[transformation_name]
+        results += [time_kernel("Transformation '%s'" % transformation_name,
+                                lambda records: [transformation_func(r) for r in records],
+                                merged_records, repeat, copy_records=True)]
+
+    results += [time_kernel("ReadFromExternalDB._convert_row_to_json",
+                            lambda records: [read_obj._convert_row_to_json(r) for r in records],
+                            external_row_dicts, repeat)]
+
+    def convert_rows(records):
+        convert_row_to_json = read_obj._json_row_converter(column_names, records[0])
+        return [convert_row_to_json(r) for r in records]
+
+    results += [time_kernel("ReadFromExternalDB._json_row_converter", convert_rows, external_rows, repeat)]
+
+    if output_json_filename is not None:
+        with open(output_json_filename, "w") as fw:
+            json.dump({"number_of_records": number_of_records, "dx_codes_per_encounter": dx_codes_per_encounter,
+                       "code_vocabulary_size": code_vocabulary_size, "kernels": results}, fw, indent=4, sort_keys=True)
+
+    return results
+
+
+if __name__ == "__main__":
+    arg_parse_obj = argparse.ArgumentParser(description="Benchmark the per-record logic of steps without a database")
+    arg_parse_obj.add_argument("-n", "--number-of-records", dest="number_of_records", type=int, default=100000)
+    arg_parse_obj.add_argument("--dx-codes-per-encounter", dest="dx_codes_per_encounter", type=int, default=5)
+    arg_parse_obj.add_argument("--code-vocabulary-size", dest="code_vocabulary_size", type=int, default=1000)
+    arg_parse_obj.add_argument("-r", "--repeat", dest="repeat", type=int, default=3)
+    arg_parse_obj.add_argument("--seed", dest="seed", type=int, default=1)
+    arg_parse_obj.add_argument("-l", "--local-classes-path", dest="local_classes_path", default=None,
+                               help="Directory with a localized_dets.py whose transformations are also timed")
+    arg_parse_obj.add_argument("-o", "--output-json-filename", dest="output_json_filename", default=None)
+
+    arg_obj = arg_parse_obj.parse_args()
+
+    if arg_obj.local_classes_path is not None:
+        sys.path.insert(0, arg_obj.local_classes_path)
+
+    main(arg_obj.number_of_records, arg_obj.dx_codes_per_encounter, arg_obj.code_vocabulary_size, arg_obj.repeat,
+         arg_obj.output_json_filename, arg_obj.seed)
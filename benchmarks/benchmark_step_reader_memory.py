@@ -0,0 +1,73 @@
+"""
+Compare the peak resident memory of a step that reads an upstream step through a server side cursor
+against one that reads it through a default client side cursor. Each mode is run in its own process.
+"""
+
+import argparse
+import csv
+import multiprocessing
+import os
+import resource
+import tempfile
+
+from benchmark_utilities import load_config, get_db_connection, run_pipeline
+
+
+def write_wide_file(file_name, number_of_rows, number_of_columns=20):
+    """Write a CSV file with enough columns that holding a step in memory is noticeable"""
+    field_names = ["eid"] + ["field_%s" % j for j in range(number_of_columns)]
+    with open(file_name, "w", newline="") as fw:
+        csv_writer = csv.writer(fw)
+        csv_writer.writerow(field_names)
+        for i in range(number_of_rows):
+            csv_writer.writerow([i] + ["value %s %s" % (i, j) for j in range(number_of_columns)])
+
+
+def run_mode(config_dict, db_schema, file_directory, stream_results, fetch_size, result_queue):
+
+    connection, meta_data = get_db_connection(config_dict, db_schema)
+
+    pipeline_structure = [
+        {"step_number": 1, "data_transformation_class": "Load file", "name": "Load wide file",
+         "parameters": {"file_name": "wide_file.csv", "file_type": "csv", "common_id_field_name": "eid",
+                        "bulk_load": True}},
+        {"step_number": 2, "data_transformation_class": "Transform with function", "name": "Read step",
+         "parameters": {"step_number": 1, "transformation_name": "Identity"}}]
+
+    rss_before_job = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    elapsed_time = run_pipeline("benchmark step reader", pipeline_structure, connection, meta_data, file_directory,
+                                stream_results=stream_results, fetch_size=fetch_size)
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    result_queue.put((rss_before_job, peak_rss, elapsed_time))
+
+
+def main(config_json_filename, db_schema, number_of_rows, fetch_size):
+
+    config_dict = load_config(config_json_filename)
+
+    file_directory = tempfile.mkdtemp()
+    write_wide_file(os.path.join(file_directory, "wide_file.csv"), number_of_rows)
+
+    for stream_results in (False, True):
+        result_queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_mode, args=(config_dict, db_schema, file_directory,
+                                                                 stream_results, fetch_size, result_queue))
+        process.start()
+        rss_before_job, peak_rss, elapsed_time = result_queue.get()
+        process.join()
+
+        print("stream_results=%s: %s rows in %.2f seconds, peak RSS %.1f MB (%.1f MB before the job)" %
+              (stream_results, number_of_rows, elapsed_time, peak_rss / 1024.0, rss_before_job / 1024.0))
+
+
+if __name__ == "__main__":
+    arg_parse_obj = argparse.ArgumentParser(description="Benchmark peak memory of reading an upstream step")
+    arg_parse_obj.add_argument("-c", "--config-json-filename", dest="config_json_filename", default="./config.json")
+    arg_parse_obj.add_argument("-s", "--db-schema", dest="db_schema", default="benchmark",
+                               help="Schema to drop and recreate for the benchmark")
+    arg_parse_obj.add_argument("-n", "--number-of-rows", dest="number_of_rows", type=int, default=200000)
+    arg_parse_obj.add_argument("-f", "--fetch-size", dest="fetch_size", type=int, default=1000)
+
+    arg_obj = arg_parse_obj.parse_args()
+    main(arg_obj.config_json_filename, arg_obj.db_schema, arg_obj.number_of_rows, arg_obj.fetch_size)
@@ -0,0 +1,50 @@
+"""
+Shared helpers for the benchmark scripts. Benchmarks drop and recreate all tables in the schema
+they are run against so point them at a dedicated schema.
+"""
+
+import json
+import os
+import sys
+import time
+import sqlalchemy as sa
+
+try:
+    import data_extract_transform_score as dets
+except ImportError:
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], os.path.pardir)))
+    import data_extract_transform_score as dets
+
+from data_extract_transform_score.schema_define import create_and_populate_schema
+from data_extract_transform_score.pipeline import Pipeline, Jobs
+
+
+def load_config(config_json_filename):
+    with open(config_json_filename, "r") as f:
+        return json.load(f)
+
+
+def get_db_connection(config_dict, db_schema):
+    """Connect to the PostgreSQL database and initialize an empty benchmark schema"""
+    engine = sa.create_engine(config_dict["connection_uri"], executemany_mode="values")
+    connection = engine.connect()
+    connection.execute("create schema if not exists %s" % db_schema)
+
+    meta_data = sa.MetaData(connection, schema=db_schema)
+    meta_data, table_dict = create_and_populate_schema(connection, meta_data)
+
+    return connection, meta_data
+
+
+def run_pipeline(pipeline_name, pipeline_structure, connection, meta_data, file_directory, **jobs_options):
+    """Load and run a pipeline returning the elapsed time in seconds"""
+
+    pipeline_obj = Pipeline(pipeline_name, connection, meta_data)
+    pipeline_obj.load_steps_into_db(pipeline_structure)
+
+    jobs_obj = Jobs("Benchmark " + pipeline_name, connection, meta_data, file_directory, **jobs_options)
+    jobs_obj.create_jobs_to_run(pipeline_name)
+
+    start_time = time.time()
+    jobs_obj.run_job()
+    return time.time() - start_time
@@ -1,13 +1,23 @@
+import atexit
+import collections
+import concurrent.futures
+import contextlib
 import csv
 import datetime
+import decimal
+import hashlib
+import inspect
 from db_classes import PipelineJobDataTranformationStep, DataTransformationStep, DataTransformationDB
 from transformations import TransformationsRegistry
 from sqlalchemy import text
 import models
 import json
+import multiprocessing
 import os
 import sqlalchemy as sa
 import sys
+import threading
+import time
 
 
 def open_csv_file(file_name, mode="r"):
@@ -19,12 +29,137 @@ def open_csv_file(file_name, mode="r"):
         return open(file_name, newline="", mode=mode)
 
 
+def copy_text_escape(value):
+    """Escape a value for the PostgreSQL COPY text format"""
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class CopyLinesReader(object):
+    """File like object that lets COPY FROM STDIN pull lines from an iterator a block at a time"""
+
+    def __init__(self, lines_iterator):
+        self.lines_iterator = lines_iterator
+        self.buffer = ""
+        self.read_time = 0.0  # Seconds spent producing lines, which is not database time
+
+    def read(self, size=-1):
+        start_time = time.time()
+        lines = [self.buffer]
+        buffer_size = len(self.buffer)
+        while size < 0 or buffer_size < size:
+            try:
+                line = next(self.lines_iterator)
+            except StopIteration:
+                break
+            lines.append(line)
+            buffer_size += len(line)
+
+        buffer = "".join(lines)
+        if size < 0:
+            self.buffer = ""
+        else:
+            self.buffer = buffer[size:]
+            buffer = buffer[:size]
+
+        self.read_time += time.time() - start_time
+        return buffer
+
+
+@contextlib.contextmanager
+def _no_timing():
+    yield
+
+
+class FetchedRows(object):
+    """Rows already fetched from a step which are read like a result proxy, by iteration or with fetchmany"""
+
+    def __init__(self, row_objs):
+        self.row_objs = row_objs
+        self.position = 0
+
+    def __iter__(self):
+        while self.position < len(self.row_objs):
+            self.position += 1
+            yield self.row_objs[self.position - 1]
+
+    def fetchmany(self, size):
+        row_objs = self.row_objs[self.position:self.position + size]
+        self.position += len(row_objs)
+        return row_objs
+
+
+class TimedRows(object):
+    """Rows of a result proxy read by iteration or with fetchmany where the time fetching them is counted as DB time
+    of the step"""
+
+    def __init__(self, result_proxy, step_timer, fetch_size):
+        self.result_proxy = result_proxy
+        self.step_timer = step_timer
+        self.fetch_size = fetch_size
+
+    def __iter__(self):
+        row_objs = self.fetchmany(self.fetch_size)
+        while len(row_objs):
+            for row_obj in row_objs:
+                yield row_obj
+            row_objs = self.fetchmany(self.fetch_size)
+
+    def fetchmany(self, size):
+        with self.step_timer.db_call():
+            return self.result_proxy.fetchmany(size)
+
+
+def source_fingerprint(code_objs):
+    """Hash of the source of the modules which define the classes (and their base classes) and functions in
+    code_objs; None when the source of a module can not be read"""
+
+    module_names = set()
+    for code_obj in code_objs:
+        if inspect.isclass(code_obj):
+            module_names |= set([c.__module__ for c in code_obj.__mro__ if c is not object])
+        else:
+            module_names.add(getattr(code_obj, "__module__", None))
+
+    source_hash = hashlib.sha256()
+    for module_name in sorted(module_names, key=str):
+        try:
+            source_hash.update(inspect.getsource(sys.modules[module_name]).encode("utf8"))
+        except (KeyError, TypeError, OSError):
+            return None
+
+    return source_hash.hexdigest()
+
+
 class DataTransformation(object):
     """Base class for representing a data transformation"""
 
+    write_batch_size = 1000  # Number of rows buffered by _write_data before they are inserted
+    stream_results = True  # Read steps through a server side (named) cursor
+    fetch_size = 1000  # Number of rows fetched at a time from a server side cursor
+    rows_read = None  # Set by steps which read rows from outside of data_transformations
+    rows_written = 0  # Counted as rows are inserted by _flush_write_buffer and _insert_with_sql
+    bytes_written = 0  # JSONB bytes of data and meta inserted; None when they are not counted or not returned
+    count_bytes_written = True  # Buffered inserts return the bytes they wrote
+    reusable = True  # Output depends only on the parameters, input files and steps read so it can be reused
+    commit_chunk_size = None  # Rows read from a step between commits by steps which run with _run_in_chunks
+    step_timer = None  # Counts the time of work on the DBAPI cursor as DB time when set
+    read_reused_step_outputs = True  # Steps which reused an earlier job's step output are read from that step
+
     def run(self):
         pass
 
+    def input_file_names(self):
+        """Paths of the files the step reads which are part of the step's fingerprint"""
+        return []
+
+    def code_objs(self):
+        """Classes and functions whose source is part of the step's fingerprint"""
+        return [self.__class__]
+
+    def code_fingerprint(self):
+        """Hash of the source of the step's code; None when it can not be read and the step is not reused"""
+        return source_fingerprint(self.code_objs())
+
     def set_connection_and_meta_data(self, connection, meta_data):
         """This method will be called by the JobRunner"""
         self.connection = connection
@@ -40,24 +175,66 @@ class DataTransformation(object):
         else:
             self.external_data_connections_dict = {}
 
-    def set_pipeline_job_data_transformation_id(self, pipeline_job_data_transformation_id):
-        """This method will be called by the JobRunner"""
+    def set_write_batch_size(self, write_batch_size):
+        self.write_batch_size = write_batch_size
+
+    def set_stream_results(self, stream_results, fetch_size=None):
+        self.stream_results = stream_results
+        if fetch_size is not None:
+            self.fetch_size = fetch_size
+
+    def set_commit_chunk_size(self, commit_chunk_size):
+        self.commit_chunk_size = commit_chunk_size
+
+    def set_count_bytes_written(self, count_bytes_written):
+        """This method will be called by the JobRunner with False when step metrics are not recorded"""
+        self.count_bytes_written = count_bytes_written
+
+    def set_step_timer(self, step_timer):
+        """This method will be called by the JobRunner with the StepTimer of the step"""
+        self.step_timer = step_timer
+
+    def _db_call(self, python_time=None):
+        """Context in which time is counted as DB time of the step"""
+        if self.step_timer is None:
+            return _no_timing()
+        else:
+            return self.step_timer.db_call(python_time)
+
+    def set_read_reused_step_outputs(self, read_reused_step_outputs):
+        """False when the schema has no reused_pipeline_job_data_transformation_step_id column"""
+        self.read_reused_step_outputs = read_reused_step_outputs
+
+    def set_pipeline_job_data_transformation_id(self, pipeline_job_data_transformation_id, pipeline_job_id=None,
+                                                data_transformation_step_row=None):
+        """This method will be called by the JobRunner which passes the pipeline job id and step row it already has;
+        otherwise they are read from the database"""
         self.pipeline_job_data_transformation_step_id = pipeline_job_data_transformation_id
         self.pipeline_job_data_transformation_obj = PipelineJobDataTranformationStep(self.connection, self.meta_data)
-        self.pipeline_job_data_trans_row = self.pipeline_job_data_transformation_obj.find_by_id(self.pipeline_job_data_transformation_step_id)
-        self.pipeline_job_id = self.pipeline_job_data_trans_row.pipeline_job_id
-        self.data_transformation_step_id = self.pipeline_job_data_trans_row.data_transformation_step_id
-
         self.data_transformation_step_obj = DataTransformationStep(self.connection, self.meta_data)
-        self.data_transformation_step_row = self.data_transformation_step_obj.find_by_id(self.data_transformation_step_id)
+
+        if pipeline_job_id is None or data_transformation_step_row is None:
+            pipeline_job_data_trans_row = self.pipeline_job_data_transformation_obj.find_by_id(self.pipeline_job_data_transformation_step_id)
+            pipeline_job_id = pipeline_job_data_trans_row.pipeline_job_id
+            data_transformation_step_row = self.data_transformation_step_obj.find_by_id(pipeline_job_data_trans_row.data_transformation_step_id)
+
+        self.pipeline_job_id = pipeline_job_id
+        self.data_transformation_step_id = data_transformation_step_row.id
+        self.data_transformation_step_row = data_transformation_step_row
 
         self.data_transformation_obj = DataTransformationDB(self.connection, self.meta_data)
+        self._write_buffer = []
+
+    def _sql_statement_execute(self, sql_statement, parameter_dict=None, execution_options=None):
+        if execution_options is None:
+            connection = self.connection
+        else:
+            connection = self.connection.execution_options(**execution_options)
 
-    def _sql_statement_execute(self, sql_statement, parameter_dict=None):
         if parameter_dict is None:
-            result_proxy = self.connection.execute(sql_statement)
+            result_proxy = connection.execute(sql_statement)
         else:
-            result_proxy = self.connection.execute(text(sql_statement), **parameter_dict)
+            result_proxy = connection.execute(text(sql_statement), **parameter_dict)
 
         return result_proxy
 
@@ -73,7 +250,69 @@ class DataTransformation(object):
         dict_to_write = {"data": data, "common_id": common_id, "meta": meta}
         dict_to_write["pipeline_job_data_transformation_step_id"] = self.pipeline_job_data_transformation_step_id
         dict_to_write["created_at"] = datetime.datetime.utcnow()
-        self.data_transformation_obj.insert_struct(dict_to_write)
+        self._write_buffer.append(dict_to_write)
+
+        if len(self._write_buffer) >= self.write_batch_size:
+            self._flush_write_buffer()
+
+    def _flush_write_buffer(self):
+        """Insert rows buffered by _write_data; call before committing the transaction"""
+        if len(self._write_buffer):
+            if self.count_bytes_written and self.bytes_written is not None:
+                sum_returning_sql = "pg_column_size(data) + coalesce(pg_column_size(meta), 0)"
+            else:
+                sum_returning_sql = None
+
+            with self._db_call():
+                buffer_bytes_written = self.data_transformation_obj.insert_structs(self._write_buffer,
+                                                                                   sum_returning_sql)
+
+            self.rows_written += len(self._write_buffer)
+            if buffer_bytes_written is None:
+                self.bytes_written = None
+            else:
+                self.bytes_written += buffer_bytes_written
+
+            self._write_buffer = []
+
+    def _insert_with_sql(self, sql_statement, parameter_dict):
+        """Execute an insert into data_transformations and count the rows and bytes it inserts"""
+
+        sql_statement = """
+with inserted_rows as (%s
+    returning pg_column_size(data) + coalesce(pg_column_size(meta), 0) as row_bytes)
+select count(*) as rows_written, coalesce(sum(row_bytes), 0) as bytes_written from inserted_rows""" % sql_statement
+
+        # Statements starting with "with" are not autocommitted unless asked
+        written_row = list(self._sql_statement_execute(sql_statement, parameter_dict,
+                                                       execution_options={"autocommit": True}))[0]
+
+        self.rows_written += written_row.rows_written
+        if self.bytes_written is not None:
+            self.bytes_written += written_row.bytes_written
+
+    def _data_transformation_step_ids(self, step_number):
+        """Ids of the steps in this pipeline job with the step number. Filtering data transformations on these ids
+        instead of joining to the steps gives the query planner row estimates from the data_transformations table
+        and, when data_transformations is partitioned, limits the query to the partitions of the steps."""
+
+        schema = self._schema_name()
+
+        # A step which reused the output of an earlier job's step is read from that step
+        if self.read_reused_step_outputs:
+            step_id_sql = "coalesce(pjdts.reused_pipeline_job_data_transformation_step_id, pjdts.id)"
+        else:
+            step_id_sql = "pjdts.id"
+
+        sql_expression = """
+select %s as id from %spipeline_jobs_data_transformation_steps pjdts
+    join %sdata_transformation_steps dts on pjdts.data_transformation_step_id = dts.id
+    where pjdts.pipeline_job_id = :pipeline_job_id and dts.step_number = :step_number order by pjdts.id""" % (step_id_sql, schema, schema)
+
+        result_proxy = self._sql_statement_execute(sql_expression, {"pipeline_job_id": self.pipeline_job_id,
+                                                                    "step_number": step_number})
+
+        return [row_obj.id for row_obj in result_proxy]
 
     def _get_data_transformation_step_proxy(self, step_number):
 
@@ -81,14 +320,70 @@ class DataTransformation(object):
 
         sql_expression = """
 select dt.* from %sdata_transformations dt
-    join %spipeline_jobs_data_transformation_steps pjdts
-        on dt.pipeline_job_data_transformation_step_id = pjdts.id and pjdts.pipeline_job_id = :pipeline_job_id
-    join %sdata_transformation_steps dts on pjdts.data_transformation_step_id = dts.id
-    where dts.step_number = :step_number""" % (schema, schema, schema)
+    where dt.pipeline_job_data_transformation_step_id = any(:step_ids)""" % (schema,)
+
+        if self.stream_results:
+            execution_options = {"stream_results": True, "max_row_buffer": self.fetch_size}
+        else:
+            execution_options = None
 
-        result_proxy = self._sql_statement_execute(sql_expression, {"pipeline_job_id": self.pipeline_job_id, "step_number": step_number})
+        result_proxy = self._sql_statement_execute(sql_expression, {"step_ids": self._data_transformation_step_ids(step_number)},
+                                                   execution_options=execution_options)
 
-        return result_proxy
+        if self.step_timer is not None:
+            return TimedRows(result_proxy, self.step_timer, self.fetch_size)
+        else:
+            return result_proxy
+
+    def _run_in_chunks(self, step_number, process_rows):
+        """Read a step commit_chunk_size rows at a time in order of id and call process_rows with each chunk. The
+        output of a chunk is committed together with the id of its last row as the checkpoint of the step, so a
+        failed step which is resumed starts after its last committed chunk."""
+
+        schema = self._schema_name()
+        step_ids = self._data_transformation_step_ids(step_number)
+
+        if len(step_ids) == 1:  # An equality lets the rows be read in order from the index on (step, id)
+            step_ids_sql = "= :step_id"
+        else:
+            step_ids_sql = "= any(:step_ids)"
+
+        sql_expression = """
+select dt.* from %sdata_transformations dt
+    where dt.pipeline_job_data_transformation_step_id %s and dt.id > :checkpoint_id
+    order by dt.id limit :commit_chunk_size""" % (schema, step_ids_sql)
+
+        checkpoint_id = self.pipeline_job_data_transformation_obj.find_by_id(
+            self.pipeline_job_data_transformation_step_id).checkpoint_id
+
+        if checkpoint_id is not None:
+            print("    " + "Resuming after data transformation %s" % checkpoint_id)
+        else:
+            checkpoint_id = 0
+
+        parameter_dict = {"step_ids": step_ids, "step_id": step_ids[0] if len(step_ids) else None,
+                          "checkpoint_id": checkpoint_id, "commit_chunk_size": self.commit_chunk_size}
+
+        number_of_rows = self.commit_chunk_size
+        while number_of_rows == self.commit_chunk_size:
+
+            transaction = self.connection.begin()
+            try:
+                row_objs = list(self._sql_statement_execute(sql_expression, parameter_dict))
+                number_of_rows = len(row_objs)
+
+                if number_of_rows:
+                    process_rows(FetchedRows(row_objs))
+                    self._flush_write_buffer()
+
+                    parameter_dict["checkpoint_id"] = row_objs[-1].id
+                    self.pipeline_job_data_transformation_obj.update_struct(self.pipeline_job_data_transformation_step_id,
+                                                                            {"checkpoint_id": row_objs[-1].id})
+            except:
+                transaction.rollback()
+                raise
+
+            transaction.commit()
 
 
 class ClientServerDataTransformation(DataTransformation):
@@ -111,16 +406,21 @@ class ServerServerDataTransformation(DataTransformation):
 
 class ReadFileIntoDB(ClientServerDataTransformation):
     """Read a fine into a database"""
-    def __init__(self, file_name, file_type, common_id_field_name, delimiter=","):
+    def __init__(self, file_name, file_type, common_id_field_name, delimiter=",", bulk_load=False):
         self.file_name = file_name
         self.common_id_field_name = common_id_field_name
         self.file_type = file_type
         self.delimiter = delimiter
+        self.bulk_load = bulk_load  # Use PostgreSQL COPY through a staging table
+
+    def input_file_names(self):
+        return [os.path.abspath(os.path.join(self.file_directory, self.file_name))]
 
     def run(self):
 
         transaction = self.connection.begin() # For data loading faster to have a single transaction
 
+        start_time = time.time()
         try:
 
             if self.file_type == "csv":
@@ -128,17 +428,10 @@ class ReadFileIntoDB(ClientServerDataTransformation):
                 localized_file_name = os.path.abspath(os.path.join(self.file_directory, self.file_name))
                 with open_csv_file(localized_file_name, mode="r") as f:
                     csv_dict_reader = csv.DictReader(f)
-                    i = 1
-                    for row_dict in csv_dict_reader:
-                        common_id = row_dict[self.common_id_field_name]
-                        data = row_dict
-                        meta = {"row": i}
-                        self._write_data(data, common_id, meta=meta)
-
-                        if i % 10000 == 0:
-                            print("    " + "Imported %s rows into DB" % i)
-
-                        i += 1
+                    if self.bulk_load:
+                        number_of_rows = self._bulk_load_rows(csv_dict_reader)
+                    else:
+                        number_of_rows = self._insert_rows(csv_dict_reader)
             else:
                 raise RuntimeError
 
@@ -148,22 +441,136 @@ class ReadFileIntoDB(ClientServerDataTransformation):
 
         transaction.commit()
 
+        self.rows_read = number_of_rows
+
+        elapsed_time = time.time() - start_time
+        if elapsed_time > 0:
+            print("    " + "Imported %s rows into DB (%.1f rows/sec)" % (number_of_rows, number_of_rows / elapsed_time))
+
+    def _insert_rows(self, csv_dict_reader):
+        """Insert a row at a time"""
+        i = 0
+        for row_dict in csv_dict_reader:
+            i += 1
+            common_id = row_dict[self.common_id_field_name]
+            data = row_dict
+            meta = {"row": i}
+            self._write_data(data, common_id, meta=meta)
+
+            if i % 10000 == 0:
+                print("    " + "Imported %s rows into DB" % i)
+
+        self._flush_write_buffer()
+
+        return i
+
+    def _bulk_load_rows(self, csv_dict_reader):
+        """COPY rows into a temporary staging table and build the data transformations with a single insert"""
+
+        schema = self._schema_name()
+        staging_table_name = "staging_data_transformations_%s" % self.pipeline_job_data_transformation_step_id
+
+        self._sql_statement_execute(
+            "create temporary table %s (row_number bigint, common_id varchar(255), data jsonb) on commit drop"
+            % staging_table_name)
+
+        copy_statement = "copy %s (row_number, common_id, data) from stdin" % staging_table_name
+        cursor = self.connection.connection.cursor()  # Shares the transaction of the SQLAlchemy connection
+
+        self.rows_copied = 0
+        copy_lines_reader = CopyLinesReader(self._copy_lines(csv_dict_reader))
+        try:
+            with self._db_call(lambda: copy_lines_reader.read_time):
+                cursor.copy_expert(copy_statement, copy_lines_reader)
+        finally:
+            cursor.close()
+
+        sql_statement = """
+insert into %sdata_transformations (common_id, data, meta, created_at, pipeline_job_data_transformation_step_id)
+select common_id, data, jsonb_build_object('row', row_number),
+  cast(now() as timestamp) at time zone 'utc', :pipeline_job_data_transformation_step_id
+    from %s order by row_number""" % (schema, staging_table_name)
+
+        self._insert_with_sql(sql_statement, {
+            "pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id})
+
+        return self.rows_copied
+
+    def _copy_lines(self, csv_dict_reader):
+        """Format each row in the file as a line of the staging table"""
+        for row_dict in csv_dict_reader:
+            self.rows_copied += 1
+            i = self.rows_copied
+            yield "%s\t%s\t%s\n" % (i, copy_text_escape(row_dict[self.common_id_field_name]),
+                                    copy_text_escape(json.dumps(row_dict)))
+
+            if i % 10000 == 0:
+                print("    " + "Copied %s rows into DB" % i)
+
+
+class ExternalDBEngines(object):
+    """Process wide registry of pooled engines keyed by the name of an external data connection. The engines are
+    shared by the steps of the jobs run in the process and their connections are closed when the process exits."""
+
+    engine_option_names = ["pool_size", "max_overflow", "pool_timeout", "pool_recycle", "pool_pre_ping"]
+
+    def __init__(self):
+        self.engines_dict = {}
+        self.lock = threading.Lock()
+
+    def get_engine(self, data_connection_name, data_connection_dict):
+
+        connection_string = data_connection_dict["connection_string"]
+
+        with self.lock:
+            if data_connection_name in self.engines_dict:
+                engine = self.engines_dict[data_connection_name]
+                if str(engine.url) == str(sa.engine.url.make_url(connection_string)):
+                    return engine
+                else:  # The configuration of the data connection has changed
+                    engine.dispose()
+
+            engine_options = {"pool_pre_ping": True}
+            for option_name in self.engine_option_names:
+                if option_name in data_connection_dict:
+                    engine_options[option_name] = data_connection_dict[option_name]
+
+            engine = sa.create_engine(connection_string, **engine_options)
+            self.engines_dict[data_connection_name] = engine
+
+            return engine
+
+    def dispose_all(self):
+        """Close pooled connections"""
+        with self.lock:
+            for data_connection_name in self.engines_dict:
+                self.engines_dict[data_connection_name].dispose()
+            self.engines_dict = {}
+
+
+external_db_engines = ExternalDBEngines()
+atexit.register(external_db_engines.dispose_all)
+
 
 class ReadFromExternalDB(ClientServerDataTransformation):
     """Read data from an external data source defined by an SQLAlchemy Connection String"""
 
+    reusable = False  # The external data can change between jobs
+
     def _connect_to_database(self, data_connection_name):
 
         data_connection_dict = self.external_data_connections_dict[data_connection_name]
-        connection_string = data_connection_dict["connection_string"]
-
-        engine = sa.create_engine(connection_string)
+        engine = external_db_engines.get_engine(data_connection_name, data_connection_dict)
 
         return engine.connect()
 
-    def _execute_external_query(self, external_connection, query_string, parameter_dict={}):
+    def _execute_external_query(self, external_connection, query_string, parameter_dict={}, expanding_parameters=None):
+
+        sql_text = sa.text(query_string)
+        if expanding_parameters is not None:  # Parameters bound as a list, e.g., "where eid in :common_ids"
+            sql_text = sql_text.bindparams(*[sa.bindparam(name, expanding=True) for name in expanding_parameters])
 
-        result_set = external_connection.execute(sa.text(query_string), **parameter_dict)
+        result_set = external_connection.execute(sql_text, **parameter_dict)
 
         return result_set
 
@@ -172,88 +579,254 @@ class ReadFromExternalDB(ClientServerDataTransformation):
         row_dict = {}
 
         for column in row_data.keys():
-            data_value = row_data[column]
-            if data_value.__class__ in (int, float):
-                row_dict[column] = data_value
-            else:
-                string_value = str(data_value)
-                if u"\u0000" in string_value:
-                   string_value = " ".join(string_value.split(u"\u0000"))
-                row_dict[column] = string_value.rstrip()
+            row_dict[column] = self._convert_value_to_json(row_data[column])
 
         return row_dict
 
+    def _convert_value_to_json(self, data_value):
+        if data_value.__class__ in (int, float):
+            return data_value
+        else:
+            return self._clean_string(str(data_value))
+
+    def _clean_string(self, string_value):
+        if u"\u0000" in string_value:
+            string_value = " ".join(string_value.split(u"\u0000"))
+        return string_value.rstrip()
+
+    def _json_row_converter(self, column_names, first_row):
+        """Returns a function which converts rows like _convert_row_to_json. The conversion for each column is
+        chosen from the first row so values are not dispatched on their type a cell at a time."""
+
+        column_converters = []
+        for data_value in first_row:
+            value_class = data_value.__class__
+            if value_class in (int, float):
+                column_converters += [(value_class, None)]
+            elif value_class == u"".__class__:
+                column_converters += [(value_class, self._clean_string)]
+            else:
+                column_converters += [(None, None)]
+
+        column_names_converters = list(zip(column_names, column_converters))
+        convert_value_to_json = self._convert_value_to_json
+
+        def convert_row(row_data):
+            row_dict = {}
+            for (column_name, (value_class, converter)), data_value in zip(column_names_converters, row_data):
+                if data_value.__class__ is not value_class:  # A NULL or a value not typed like the first row
+                    row_dict[column_name] = convert_value_to_json(data_value)
+                elif converter is None:
+                    row_dict[column_name] = data_value
+                else:
+                    row_dict[column_name] = converter(data_value)
+            return row_dict
+
+        return convert_row
+
 
 class ReadDataFromExternalDBQuery(ReadFromExternalDB):
     """Read data from a query where each db row"""
 
-    def __init__(self, external_data_connection_name, sql_query, common_id_field_name):
+    def __init__(self, external_data_connection_name, sql_query, common_id_field_name, stream_external_results=False,
+                 chunk_size=10000):
         self.query_string = sql_query
         self.external_data_connection_name = external_data_connection_name
         self.common_id_field_name = common_id_field_name
+        self.stream_external_results = stream_external_results  # Server side cursor on the external data source
+        self.chunk_size = chunk_size
 
     def run(self):
 
-        connection = self._connect_to_database(self.external_data_connection_name)
-        result_set = self._execute_external_query(connection, self.query_string)
+        external_connection = self._connect_to_database(self.external_data_connection_name)
+        if self.stream_external_results:
+            connection = external_connection.execution_options(stream_results=True, max_row_buffer=self.chunk_size)
+        else:
+            connection = external_connection
 
         i = 1
         transaction = self.connection.begin()
         try:
-            for row_dict in result_set:
-                common_id = row_dict[self.common_id_field_name]
-                data = self._convert_row_to_json(row_dict)
-                meta = {"row": i}
-                self._write_data(data, common_id, meta=meta)
+            result_set = self._execute_external_query(connection, self.query_string)
+            column_names = result_set.keys()
 
-                if i % 10000 == 0:
-                    print("    " + "Imported %s rows into DB" % i)
+            row_chunk = result_set.fetchmany(self.chunk_size)
+            if len(row_chunk):
+                convert_row_to_json = self._json_row_converter(column_names, row_chunk[0])
 
-                i += 1
+            while len(row_chunk):
+                for row_dict in row_chunk:
+                    common_id = row_dict[self.common_id_field_name]
+                    data = convert_row_to_json(row_dict)
+                    meta = {"row": i}
+                    self._write_data(data, common_id, meta=meta)
+
+                    if i % 10000 == 0:
+                        print("    " + "Imported %s rows into DB" % i)
+
+                    i += 1
+
+                row_chunk = result_set.fetchmany(self.chunk_size)
+
+            self._flush_write_buffer()
+            self.rows_read = i - 1
 
         except:
             transaction.rollback()
             raise()
+        finally:
+            external_connection.close()  # Returns the connection to the pool
 
         transaction.commit()
 
 
+def _common_id_key(value):
+    """Text used to match a common id to the value of a column: surrounding blanks, such as the padding of a CHAR
+    column, are removed and whole numbers are written without a fraction"""
+    if isinstance(value, (float, decimal.Decimal)):
+        try:
+            if value == int(value):
+                value = int(value)
+        except (ValueError, OverflowError):  # NaN and infinity
+            pass
+
+    return str(value).strip()
+
+
 class ReadDataFromExternalDBQueryById(ReadFromExternalDB):
+    """Query an external data source for each common_id in a step.
 
-    def __init__(self, external_data_connection_name, sql_query, step_number):
+    By default the query is run once per common_id bound to :common_id. When batch_size is set the query is
+    run once per batch_size common_ids bound as a list to :common_ids, e.g., "where eid = ANY(:common_ids)"
+    on PostgreSQL or "where eid in :common_ids" with expand_common_ids, and each result row is matched back
+    to its common_id by the value in common_id_field_name.
+
+    Common ids are text so on PostgreSQL a list compared to a column of another type needs a cast, e.g.,
+    "where eid = ANY(CAST(:common_ids AS int[]))". Result rows whose value does not match a common id of the
+    batch are counted in rows_not_matched and reported rather than written.
+    """
+
+    rows_not_matched = 0
+
+    def __init__(self, external_data_connection_name, sql_query, step_number, batch_size=None,
+                 common_id_field_name=None, expand_common_ids=False):
         self.query_string = sql_query
         self.external_data_connection_name = external_data_connection_name
         self.step_number = step_number
+        self.batch_size = batch_size
+        self.common_id_field_name = common_id_field_name
+        self.expand_common_ids = expand_common_ids
+
+        if self.batch_size is not None and self.common_id_field_name is None:
+            raise RuntimeError("A common_id_field_name is required to query by batches of common ids")
 
     def run(self):
 
         external_connection = self._connect_to_database(self.external_data_connection_name)
+        self.row_number = 1  # Numbers the external rows across chunks
+        self.rows_not_matched = 0
+
+        if self.commit_chunk_size is not None:
+            self.row_number = self._last_row_number() + 1  # A resumed step continues after its committed rows
+            try:
+                self._run_in_chunks(self.step_number, lambda row_proxy: self._query_rows(external_connection, row_proxy))
+            finally:
+                external_connection.close()
+            return
 
         transaction = self.connection.begin()
         try:
 
             row_proxy = self._get_data_transformation_step_proxy(self.step_number)
+            self._query_rows(external_connection, row_proxy)
 
-            i = 1
-            for row_obj in row_proxy:
-
-                external_row_result = self._execute_external_query(external_connection, self.query_string,
-                                                                   {"common_id": row_obj.common_id})
-
-                for external_row in external_row_result:
-
-                    data = self._convert_row_to_json(external_row)
-                    meta = {"row": i}
-                    self._write_data(data, row_obj.common_id, meta)
-
-                    i += 1
+            self._flush_write_buffer()
 
         except:
             transaction.rollback()
             raise()
+        finally:
+            external_connection.close()  # Returns the connection to the pool
 
         transaction.commit()
 
+    def _last_row_number(self):
+        schema = self._schema_name()
+        result_proxy = self._sql_statement_execute("""
+select coalesce(max(cast(dt.meta ->> 'row' as bigint)), 0) as row_number from %sdata_transformations dt
+    where dt.pipeline_job_data_transformation_step_id = :pipeline_job_data_transformation_step_id""" % schema,
+                                                   {"pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id})
+        return list(result_proxy)[0].row_number
+
+    def _query_rows(self, external_connection, row_proxy):
+        if self.batch_size is None:
+            self._query_by_common_id(external_connection, row_proxy)
+        else:
+            self._query_by_batches_of_common_ids(external_connection, row_proxy)
+
+    def _query_by_common_id(self, external_connection, row_proxy):
+
+        for row_obj in row_proxy:
+
+            external_row_result = self._execute_external_query(external_connection, self.query_string,
+                                                               {"common_id": row_obj.common_id})
+
+            for external_row in external_row_result:
+
+                data = self._convert_row_to_json(external_row)
+                meta = {"row": self.row_number}
+                self._write_data(data, row_obj.common_id, meta)
+
+                self.row_number += 1
+
+    def _query_by_batches_of_common_ids(self, external_connection, row_proxy):
+
+        if self.expand_common_ids:
+            expanding_parameters = ["common_ids"]
+        else:
+            expanding_parameters = None
+
+        row_objs = row_proxy.fetchmany(self.batch_size)
+        while len(row_objs):
+
+            common_ids = []
+            common_ids_set = set()
+            for row_obj in row_objs:
+                if row_obj.common_id not in common_ids_set:
+                    common_ids += [row_obj.common_id]
+                    common_ids_set.add(row_obj.common_id)
+
+            external_row_result = self._execute_external_query(external_connection, self.query_string,
+                                                               {"common_ids": common_ids}, expanding_parameters)
+
+            common_id_external_rows_dict = {}
+            for external_row in external_row_result:
+                common_id = _common_id_key(external_row[self.common_id_field_name])
+                if common_id not in common_id_external_rows_dict:
+                    common_id_external_rows_dict[common_id] = []
+                common_id_external_rows_dict[common_id] += [external_row]
+
+            matched_common_ids = set()
+            for row_obj in row_objs:  # Written in the same order as querying a common_id at a time
+                common_id = _common_id_key(row_obj.common_id)
+                if common_id in common_id_external_rows_dict:
+                    matched_common_ids.add(common_id)
+                    for external_row in common_id_external_rows_dict[common_id]:
+                        data = self._convert_row_to_json(external_row)
+                        meta = {"row": self.row_number}
+                        self._write_data(data, row_obj.common_id, meta)
+
+                        self.row_number += 1
+
+            not_matched_common_ids = [c for c in common_id_external_rows_dict if c not in matched_common_ids]
+            if len(not_matched_common_ids):
+                number_of_rows = sum([len(common_id_external_rows_dict[c]) for c in not_matched_common_ids])
+                self.rows_not_matched += number_of_rows
+                print("    " + "%s rows of the query did not match a common id by '%s', e.g., %r" %
+                      (number_of_rows, self.common_id_field_name, not_matched_common_ids[0]))
+
+            row_objs = row_proxy.fetchmany(self.batch_size)
+
 
 class FilterBy(ServerServerDataTransformation):
     """Filters and selects a JSONB data or meta_data element"""
@@ -276,15 +849,11 @@ class FilterBy(ServerServerDataTransformation):
         select common_id, %s, meta,
           cast(now() as timestamp) at time zone 'utc', :pipeline_job_data_transformation_step_id
             from   %sdata_transformations dt 
-              join %spipeline_jobs_data_transformation_steps pjdts on pjdts.id = dt.pipeline_job_data_transformation_step_id
-              join %sdata_transformation_steps dts ON dts.id = pjdts.data_transformation_step_id
-              join %spipeline_jobs pj on pj.id = pjdts.pipeline_job_id
-              where dts.step_number = :step_number and pj.id = :pipeline_job_id
+              where dt.pipeline_job_data_transformation_step_id = any(:step_ids)
                 and (%s)                        
-            """ % (schema_text, data_sql_bit, schema_text, schema_text, schema_text, schema_text, self.filter_criteria)
+            """ % (schema_text, data_sql_bit, schema_text, self.filter_criteria)
 
-        self._sql_statement_execute(sql_statement, {"step_number": self.step_number,
-                                                    "pipeline_job_id": self.pipeline_job_id,
+        self._insert_with_sql(sql_statement, {"step_ids": self._data_transformation_step_ids(self.step_number),
                                                     "pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id
                                                     })
 
@@ -310,13 +879,10 @@ insert into %sdata_transformations (common_id, data, meta, created_at, pipeline_
 select common_id, %s, jsonb_agg(dt.meta order by dt.id) as meta,
   cast(now() as timestamp) at time zone 'utc', :pipeline_job_data_transformation_step_id
     from %sdata_transformations dt
-    join %spipeline_jobs_data_transformation_steps pjdts on dt.pipeline_job_data_transformation_step_id = pjdts.id
-    join %sdata_transformation_steps dts on pjdts.data_transformation_step_id = dts.id
-    where step_number = :step_number and pjdts.pipeline_job_id = :pipeline_job_id
-    group by dt.common_id order by common_id""" % (schema_text, data_sql_bit, schema_text, schema_text, schema_text)
+    where dt.pipeline_job_data_transformation_step_id = any(:step_ids)
+    group by dt.common_id order by common_id""" % (schema_text, data_sql_bit, schema_text)
 
-        self._sql_statement_execute(sql_statement, {"step_number": self.step_number,
-                                                    "pipeline_job_id": self.pipeline_job_id,
+        self._insert_with_sql(sql_statement, {"step_ids": self._data_transformation_step_ids(self.step_number),
                                                     "pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id
                                                     })
 
@@ -335,23 +901,20 @@ class SwapMetaToData(ServerServerDataTransformation):
                 select common_id, meta, NULL,
                   cast(now() as timestamp) at time zone 'utc', :pipeline_job_data_transformation_step_id
                     from   %sdata_transformations dt 
-                      join %spipeline_jobs_data_transformation_steps pjdts on pjdts.id = dt.pipeline_job_data_transformation_step_id
-                      join %sdata_transformation_steps dts ON dts.id = pjdts.data_transformation_step_id
-                      join %spipeline_jobs pj on pj.id = pjdts.pipeline_job_id
-                      where dts.step_number = :step_number and pj.id = :pipeline_job_id
+                      where dt.pipeline_job_data_transformation_step_id = any(:step_ids)
                                           
                     """ % (
-        schema_text, schema_text, schema_text, schema_text, schema_text)
+        schema_text, schema_text)
 
-        self._sql_statement_execute(sql_statement, {"step_number": self.step_number,
-                                                    "pipeline_job_id": self.pipeline_job_id,
+        self._insert_with_sql(sql_statement, {"step_ids": self._data_transformation_step_ids(self.step_number),
                                                     "pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id
                                                     })
 
 
 class MergeData(ServerServerDataTransformation):
     """Merge JSON in data by the common id.
-    Assumption here is the common_id field is unique"""
+    Assumption here is the common_id field is unique, a common_id repeated in a step after the first repeats the
+    merged row"""
 
     def __init__(self, step_numbers):
 
@@ -373,110 +936,117 @@ class MergeData(ServerServerDataTransformation):
         return data_sql_bit
 
     def run(self):
+        """A single insert with a left outer join for each step after the first, so each merged row is written once"""
 
         schema = self._schema_name()
 
         step_number_1, field_name_1 = self.step_number_pairs[0]
-        step_number_2, field_name_2 = self.step_number_pairs[1]
+        print("    " + "Joining steps %s" % ", ".join([str(step_number) for step_number, field_name in self.step_number_pairs]))
 
-        field_name_expanded_1 = self._field_name_keyed(field_name_1, "dt1")
-        field_name_expanded_2 = self._field_name_keyed(field_name_2, "dt2")
+        parameter_dict = {"pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id}
 
-        print("    " + "Joining steps %s, %s" % (step_number_1, step_number_2))
+        from_sql = ""
+        for i, (step_number, field_name) in enumerate(self.step_number_pairs):
+            j = i + 1
+            parameter_dict["step_ids_%s" % j] = self._data_transformation_step_ids(step_number)
+
+            step_sql = """(
+    select dt%s.id, dt%s.common_id, %s as data from %sdata_transformations dt%s
+        where dt%s.pipeline_job_data_transformation_step_id = any(:step_ids_%s)) t%s""" % \
+                       (j, j, self._field_name_keyed(field_name, "dt%s" % j), schema, j, j, j, j)
+
+            if j == 1:
+                from_sql += step_sql
+            else:
+                # Merge each step into the data merged so far
+                merged_data_sql = "t1.data" if j == 2 else "m%s.data" % (j - 1)
+                from_sql += """
+    left outer join %s on t1.common_id = t%s.common_id
+    cross join lateral (select case when t%s.data is not null then %s || t%s.data else %s end as data) m%s""" % \
+                            (step_sql, j, j, merged_data_sql, j, merged_data_sql, j)
+
+        number_of_steps = len(self.step_number_pairs)
+        if number_of_steps == 1:
+            data_sql = "t1.data"
+        else:
+            data_sql = "m%s.data" % number_of_steps
+        meta_sql = "jsonb_build_array(%s)" % ", ".join(["t%s.id" % (i + 1) for i in range(number_of_steps)])
 
         sql_statement = """
 insert into %sdata_transformations (common_id, data, meta, created_at, pipeline_job_data_transformation_step_id)
-  select t1.common_id,
-    case when t2.data is not null then t1.data || t2.data else t1.data end as data, json_build_array(t1.id, t2.id) as meta,
+  select t1.common_id, %s as data, %s as meta,
     cast(now() as timestamp) at time zone 'utc', :pipeline_job_data_transformation_step_id
-from (
-    select dt1.id, dt1.common_id, %s as data from %sdata_transformations dt1
-        join %spipeline_jobs_data_transformation_steps pjdts1
-            on dt1.pipeline_job_data_transformation_step_id = pjdts1.id and pjdts1.pipeline_job_id = :pipeline_job_id
-        join %sdata_transformation_steps dts1 on pjdts1.data_transformation_step_id = dts1.id and step_number = :step_number_1) t1
-    left outer join (
-    select dt2.id, dt2.common_id, %s as data from %sdata_transformations dt2
-        join %spipeline_jobs_data_transformation_steps pjdts2
-            on dt2.pipeline_job_data_transformation_step_id = pjdts2.id and pjdts2.pipeline_job_id = :pipeline_job_id
-        join %sdata_transformation_steps dts2 on pjdts2.data_transformation_step_id = dts2.id and step_number = :step_number_2) t2
-    on t1.common_id = t2.common_id
-        """ % (schema, field_name_expanded_1, schema, schema, schema, field_name_expanded_2, schema, schema, schema)
+from %s
+        """ % (schema, data_sql, meta_sql, from_sql)
 
         transaction = self.connection.begin()
         try:
-            self._sql_statement_execute(sql_statement, {"step_number_1": step_number_1,
-                                                    "step_number_2":  step_number_2,
-                                                    "pipeline_job_id": self.pipeline_job_id,
-                                                    "pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id
-                                                    })
+            self._insert_with_sql(sql_statement, parameter_dict)
         except:
             transaction.rollback()
             raise()
 
         transaction.commit()
 
-        if len(self.step_number_pairs) > 2:
-
-            for step_number_pair in self.step_number_pairs[2:]:
-
-                step_number_2, field_name_2 = step_number_pair
-                field_name_expanded_2 = self._field_name_keyed(field_name_2, "dt2")
-
-                print("    " + "Joining step %s" % (step_number_2,))
-
-                sql_expression = """
-                update %sdata_transformations as dtp
-            set data =
-                case when t2.data is not null then t1.data || t2.data else t1.data end,
-                 meta = t1.meta || jsonb_build_array(t2.id)
-                 from
-                (select dt1.id, dt1.data, dt1.common_id, dt1.meta from
-                     %sdata_transformations dt1 join
-                        %spipeline_jobs_data_transformation_steps pjdts1
-                        on pjdts1.id = dt1.pipeline_job_data_transformation_step_id and pjdts1.pipeline_job_id = :pipeline_job_id
-                    join %sdata_transformation_steps dts1
-                        on dts1.id = pjdts1.data_transformation_step_id and dts1.step_number = :current_step_number) t1
-                left outer join
-                (select dt2.id, dt2.common_id, %s as data from
-                     %sdata_transformations dt2 join
-                     %spipeline_jobs_data_transformation_steps pjdts2
-                        on pjdts2.id = dt2.pipeline_job_data_transformation_step_id and pjdts2.pipeline_job_id = :pipeline_job_id
-                    join %sdata_transformation_steps dts2
-                        on dts2.id = pjdts2.data_transformation_step_id and dts2.step_number = :step_number_2) t2
-                on t2.common_id = t1.common_id where dtp.id = t1.id
-                """ % (schema, schema, schema, schema, field_name_expanded_2, schema, schema, schema)
-
-                transaction = self.connection.begin()
-
-                try:
-
-                    self._sql_statement_execute(sql_expression, {"pipeline_job_id": self.pipeline_job_id,
-                                                                 "step_number_2": step_number_2,
-                                                                 "current_step_number": self.data_transformation_step_row.step_number
-                                                                 })
-                except:
-                    transaction.rollback()
-                    raise()
-
-                transaction.commit()
-
 
-class TransformIndicatorListToDict(ServerClientServerDataTransformation):
-    def __init__(self, step_number):
+class TransformIndicatorListToDict(ServerServerDataTransformation):
+    """Transform a list of indicators into a dict {indicator: 1.0} with jsonb_object_agg in the database. An
+    execution_mode of "client" transforms each row in Python."""
+    def __init__(self, step_number, execution_mode="server"):
         self.step_number = step_number
 
+        if execution_mode not in ("client", "server"):
+            raise RuntimeError("Execution mode '%s' is not 'client' or 'server'" % execution_mode)
+        self.execution_mode = execution_mode
+
     def run(self):
 
+        if self.execution_mode == "server":
+            self._transform_on_server()
+        else:
+            self._transform_on_client()
+
+    def _transform_on_server(self):
+
+        schema_text = self._schema_name()
+
+        # The elements of a list or the keys of a dict are the indicators
+        sql_statement = """
+insert into %sdata_transformations (common_id, data, meta, created_at, pipeline_job_data_transformation_step_id)
+select dt.common_id,
+    coalesce((select jsonb_object_agg(coalesce(i.indicator, 'null'), 1.0)
+        from (select jsonb_array_elements_text(dt.data) as indicator where jsonb_typeof(dt.data) = 'array'
+              union all
+              select jsonb_object_keys(dt.data) where jsonb_typeof(dt.data) = 'object') i), '{}'::jsonb),
+    'null'::jsonb, cast(now() as timestamp) at time zone 'utc', :pipeline_job_data_transformation_step_id
+    from %sdata_transformations dt
+    where dt.pipeline_job_data_transformation_step_id = any(:step_ids)
+    order by dt.id""" % (schema_text, schema_text)
+
+        self._insert_with_sql(sql_statement, {"step_ids": self._data_transformation_step_ids(self.step_number),
+                                                    "pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id
+                                                    })
+
+    @staticmethod
+    def indicator_dict(data):
+        """The elements of a list or the keys of a dict as indicators set to 1.0"""
+        indicator_dict = {}
+        for indicator in data:
+            indicator_dict[indicator] = 1.0
+        return indicator_dict
+
+    def _transform_on_client(self):
+
+        if self.commit_chunk_size is not None:
+            self._run_in_chunks(self.step_number, self._transform_rows)
+            return
+
         transaction = self.connection.begin()
         try:
             result_proxy = self._get_data_transformation_step_proxy(self.step_number)
-            for result in result_proxy:
-
-                indicator_dict = {}
-                for indicator in result.data:
-                    indicator_dict[indicator] = 1.0
+            self._transform_rows(result_proxy)
 
-                self._write_data(indicator_dict, result.common_id, None)
+            self._flush_write_buffer()
 
         except:
             transaction.rollback()
@@ -484,13 +1054,19 @@ class TransformIndicatorListToDict(ServerClientServerDataTransformation):
 
         transaction.commit()
 
+    def _transform_rows(self, result_proxy):
+        for result in result_proxy:
+            self._write_data(self.indicator_dict(result.data), result.common_id, None)
+
 
 class MapDataWithDict(ServerClientServerDataTransformation):
-    """Create an indicator flag based on a look-up of a table"""
-    def __init__(self, fields_to_map, step_number, json_file_name=None, mapping_rules=None, field_name=None):
+    """Create an indicator flag based on a look-up of a table. With execution_mode "server" the mapping is loaded
+    into a temporary table and the step runs as a single insert in the database."""
+    def __init__(self, fields_to_map, step_number, json_file_name=None, mapping_rules=None, field_name=None,
+                 execution_mode="client"):
 
         if fields_to_map.__class__ != [].__class__:
-            self.fields_to_map = [fields_to_map]
+            fields_to_map = [fields_to_map]
 
         self.fields_to_map = fields_to_map # Can be a list of fields to descend into
         self.step_number = step_number
@@ -498,114 +1074,291 @@ class MapDataWithDict(ServerClientServerDataTransformation):
         self.mapping_rules = mapping_rules
         self.field_name = field_name
 
+        if execution_mode not in ("client", "server"):
+            raise RuntimeError("Execution mode '%s' is not 'client' or 'server'" % execution_mode)
+        self.execution_mode = execution_mode
+
+    def input_file_names(self):
+        if self.json_file_name is None:
+            return []
+        else:
+            return [os.path.abspath(os.path.join(self.file_directory, self.json_file_name))]
+
     def run(self):
 
+        if self.execution_mode == "client" and self.commit_chunk_size is not None:
+            self._load_mapping_rules()
+            self._run_in_chunks(self.step_number, self._map_rows)
+            return
+
         transaction = self.connection.begin()
 
         try:
-            if self.json_file_name is not None:
-                local_json_file_name = os.path.abspath(os.path.join(self.file_directory, self.json_file_name))
-                with open(local_json_file_name, "r") as f:
-                    self.mapping_rules = json.load(f)
+            self._load_mapping_rules()
+
+            if self.execution_mode == "server":
+                self._map_on_server()
+                transaction.commit()
+                return
 
             result_proxy = self._get_data_transformation_step_proxy(self.step_number)
-            for result in result_proxy:
+            self._map_rows(result_proxy)
 
-                result_data = result.data
+            self._flush_write_buffer()
 
-                i = 1
-                for field_to_map in self.fields_to_map:  # Traverse down to the field
-                    if field_to_map not in result_data and i < len(self.fields_to_map):
-                        break
+        except:
+            transaction.rollback()
+            raise RuntimeError("Transaction rolled back")
+
+        transaction.commit()
+
+    def _load_mapping_rules(self):
+        if self.json_file_name is not None:
+            local_json_file_name = os.path.abspath(os.path.join(self.file_directory, self.json_file_name))
+            with open(local_json_file_name, "r") as f:
+                self.mapping_rules = json.load(f)
+
+    def _map_rows(self, result_proxy):
+        for result in result_proxy:
+            mapped = self.map_data(result.data)
+            if mapped is not None:
+                data, meta_list = mapped
+                self._write_data(data, result.common_id, meta_list)
+
+    def map_data(self, result_data):
+        """Map a record on the client; returns the mapped data and meta or None when the record does not have the
+        fields to descend into"""
+
+        i = 1
+        for field_to_map in self.fields_to_map:  # Traverse down to the field
+            if field_to_map not in result_data and i < len(self.fields_to_map):
+                return None
+            else:
+
+                if i == len(self.fields_to_map):
+                    data_list = []
+                    meta_list = []
+
+                    if result_data.__class__ == [].__class__:
+                        result_value = result_data
                     else:
+                        result_value = [result_data]
 
-                        if i == len(self.fields_to_map):
-                            data_list = []
-                            meta_list = []
+                    for element in result_value:
 
-                            if result_data.__class__ == [].__class__:
-                                result_value = result_data
-                            else:
-                                result_value = [result_data]
+                        if element.__class__ == {}.__class__:
+                            field_key = field_to_map
 
-                            for element in result_value:
+                            if field_key in element:
+                                field_value = element[field_key]
 
-                                if element.__class__ == {}.__class__:
-                                    field_key = field_to_map
+                                if field_value in self.mapping_rules:
 
-                                    if field_key in element:
-                                        field_value = element[field_key]
+                                    if self.mapping_rules[field_value].__class__ in ([].__class__, u"".__class__, {}.__class__):
+                                        mapped_value = self.mapping_rules[field_value]
 
-                                        if field_value in self.mapping_rules:
+                                        if mapped_value.__class__ != [].__class__:
+                                            mapped_value = [mapped_value]
 
-                                            if self.mapping_rules[field_value].__class__ in ([].__class__, u"".__class__, {}.__class__):
-                                                mapped_value = self.mapping_rules[field_value]
+                                        data_list += mapped_value
+                                        meta_list += [{field_value: self.mapping_rules[field_value]}]
 
-                                                if mapped_value.__class__ != [].__class__:
-                                                    mapped_value = [mapped_value]
+                    if self.field_name is not None:
+                        data = {self.field_name: data_list}
+                    else:
+                        data = data_list
 
-                                                data_list += mapped_value
-                                                meta_list += [{field_value: self.mapping_rules[field_value]}]
+                    return data, meta_list
 
-                            if self.field_name is not None:
-                                data = {self.field_name: data_list}
-                            else:
-                                data = data_list
+                elif i < len(self.fields_to_map):
+                    try:
+                        result_data = result_data[field_to_map]
+                    except TypeError:
+                        return None
 
-                            self._write_data(data, result.common_id, meta_list)
+                i += 1
 
-                        elif i < len(self.fields_to_map):
-                            try:
-                                result_data = result_data[field_to_map]
-                            except TypeError:
-                                break
+    def _map_on_server(self):
+        """Same output as mapping on the client: rows are kept when the path down to the last field is through
+        objects and only string values of the last field are looked up"""
 
-                        i += 1
-        except:
-            transaction.rollback()
-            raise RuntimeError("Transaction rolled back")
+        schema = self._schema_name()
+        mapping_table_name = "mapping_rules_%s" % self.pipeline_job_data_transformation_step_id
+
+        self._sql_statement_execute(
+            "create temporary table %s (field_value text primary key, mapped_value jsonb) on commit drop"
+            % mapping_table_name)
+
+        mapping_rows = [{"field_value": field_value, "mapped_value": json.dumps(mapped_value)}
+                        for field_value, mapped_value in self.mapping_rules.items()
+                        if mapped_value.__class__ in ([].__class__, u"".__class__, {}.__class__)]
+        if len(mapping_rows):
+            self.connection.execute(text("insert into %s (field_value, mapped_value) values (:field_value, cast(:mapped_value as jsonb))"
+                                         % mapping_table_name), mapping_rows)
+
+        parameter_dict = {"step_ids": self._data_transformation_step_ids(self.step_number),
+                          "pipeline_job_data_transformation_step_id": self.pipeline_job_data_transformation_step_id,
+                          "path_to_map": self.fields_to_map[:-1], "field_key": self.fields_to_map[-1]}
+
+        path_conditions_sql = ""
+        for i in range(len(self.fields_to_map) - 1):  # Descend only through objects which have the field
+            parameter_dict["parent_path_%s" % i] = self.fields_to_map[:i]
+            parameter_dict["field_%s" % i] = self.fields_to_map[i]
+            path_conditions_sql += """
+        and jsonb_typeof(dt.data #> cast(:parent_path_%s as text[])) = 'object'
+        and dt.data #> cast(:parent_path_%s as text[]) ? :field_%s""" % (i, i, i)
+
+        data_sql = """coalesce((select jsonb_agg(mv.value order by me.element_number, mv.value_number)
+        from mapped_elements me cross join lateral jsonb_array_elements(
+            case when jsonb_typeof(me.mapped_value) = 'array' then me.mapped_value else jsonb_build_array(me.mapped_value) end)
+            with ordinality as mv(value, value_number)
+        where me.id = sr.id), '[]'::jsonb)"""
+
+        if self.field_name is not None:
+            parameter_dict["field_name"] = self.field_name
+            data_sql = "jsonb_build_object(cast(:field_name as text), %s)" % data_sql
 
-        transaction.commit()
+        sql_statement = """
+with source_rows as (
+    select dt.id, dt.common_id, dt.data #> cast(:path_to_map as text[]) as value_to_map
+    from %sdata_transformations dt
+    where dt.pipeline_job_data_transformation_step_id = any(:step_ids)%s
+), mapped_elements as (
+    select sr.id, e.element_number, e.element ->> :field_key as field_value, mr.mapped_value
+    from source_rows sr
+    cross join lateral jsonb_array_elements(
+        case when jsonb_typeof(sr.value_to_map) = 'array' then sr.value_to_map else jsonb_build_array(sr.value_to_map) end)
+        with ordinality as e(element, element_number)
+    join %s mr on mr.field_value = e.element ->> :field_key
+    where jsonb_typeof(e.element) = 'object' and jsonb_typeof(e.element -> :field_key) = 'string'
+)
+insert into %sdata_transformations (common_id, data, meta, created_at, pipeline_job_data_transformation_step_id)
+select sr.common_id, %s,
+    coalesce((select jsonb_agg(jsonb_build_object(me.field_value, me.mapped_value) order by me.element_number)
+        from mapped_elements me where me.id = sr.id), '[]'::jsonb),
+    cast(now() as timestamp) at time zone 'utc', :pipeline_job_data_transformation_step_id
+    from source_rows sr order by sr.id""" % (schema, path_conditions_sql, mapping_table_name, schema, data_sql)
+
+        self._insert_with_sql(sql_statement, parameter_dict)
+
+
+def _load_transformation_registry():
+    try:
+        import localized_dets as ld
+        return TransformationsRegistry(ld.LOCAL_TRANSFORMATIONS_TO_REGISTER)
+    except ImportError:
+        return TransformationsRegistry()
+
+
+_worker_transformation_func = None
+
+
+def _initialize_transformation_worker(transformation_name, parent_sys_path):
+    """Runs once in each worker process to load the transformation from the registry"""
+    global _worker_transformation_func
+
+    for path in parent_sys_path:
+        if path not in sys.path:
+            sys.path.append(path)
+
+    _worker_transformation_func = _load_transformation_registry().transformation_name_dict[transformation_name]
+
+
+def _transform_data_chunk(data_list):
+    return [_worker_transformation_func(data) for data in data_list]
 
 
 class TransformDataWithFunction(ServerClientServerDataTransformation):
-    def __init__(self, step_number, transformation_name):
+    """Applies a registered transformation to each row. With workers set the rows are transformed a chunk at a time
+    in a pool of worker processes and written in order. The workers are spawned rather than forked, as a fork taken
+    while other steps run in threads can copy a lock held by one of them into the child."""
+
+    def __init__(self, step_number, transformation_name, workers=None, chunk_size=1000):
 
         self.step_number = step_number
-        try:
-            import localized_dets as ld
-            self.transformation_registry = TransformationsRegistry(ld.LOCAL_TRANSFORMATIONS_TO_REGISTER)
-        except ImportError:
-            self.transformation_registry = TransformationsRegistry()
+        self.transformation_name = transformation_name
+        self.workers = workers
+        self.chunk_size = chunk_size
 
+        self.transformation_registry = _load_transformation_registry()
         self.transformation_func = self.transformation_registry.transformation_name_dict[transformation_name]
 
+    def code_objs(self):
+        return [self.__class__, self.transformation_func]
+
     def run(self):
 
+        if self.commit_chunk_size is not None:
+            self._run_in_chunks(self.step_number, self._transform_rows)
+            return
+
         transaction = self.connection.begin()
         try:
 
             row_proxy = self._get_data_transformation_step_proxy(self.step_number)
-            for row_obj in row_proxy:
-                data, meta = self.transformation_func(row_obj.data)
-                # print(data, meta)
-                # raise RuntimeError
-                self._write_data(data, row_obj.common_id, meta)
+            self._transform_rows(row_proxy)
+
+            self._flush_write_buffer()
+
         except:
             transaction.rollback()
             raise
 
         transaction.commit()
 
+    def _transform_rows(self, row_proxy):
+        if self.workers is not None and self.workers > 1:
+            self._transform_in_worker_processes(row_proxy)
+        else:
+            for row_obj in row_proxy:
+                data, meta = self.transformation_func(row_obj.data)
+                self._write_data(data, row_obj.common_id, meta)
+
+    def _transform_in_worker_processes(self, row_proxy):
+        """At most twice workers chunks are read ahead of the chunk being written"""
+
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                          mp_context=multiprocessing.get_context("spawn"),
+                                                          initializer=_initialize_transformation_worker,
+                                                          initargs=(self.transformation_name, list(sys.path)))
+        pending_chunks = collections.deque()
+        try:
+            row_objs = row_proxy.fetchmany(self.chunk_size)
+            while len(row_objs):
+                common_ids = [row_obj.common_id for row_obj in row_objs]
+                data_list = [row_obj.data for row_obj in row_objs]
+                pending_chunks.append((common_ids, executor.submit(_transform_data_chunk, data_list)))
+
+                if len(pending_chunks) >= 2 * self.workers:
+                    self._write_transformed_chunk(*pending_chunks.popleft())
+
+                row_objs = row_proxy.fetchmany(self.chunk_size)
+
+            while len(pending_chunks):
+                self._write_transformed_chunk(*pending_chunks.popleft())
+        finally:
+            for common_ids, transformed_future in pending_chunks:
+                transformed_future.cancel()
+            executor.shutdown(wait=True)
+
+    def _write_transformed_chunk(self, common_ids, transformed_future):
+        for common_id, (data, meta) in zip(common_ids, transformed_future.result()):
+            self._write_data(data, common_id, meta)
+
 
 class ScoreData(ServerClientServerDataTransformation):
     """Handles scoring of data against a model"""
 
-    def __init__(self, step_number, model_name, model_parameters):
+    def __init__(self, step_number, model_name, model_parameters, batch_size=1000, explanation=None,
+                 explanation_top_k=None, max_in_flight=None, retries=3, retry_backoff=0.5):
 
         self.step_number = step_number
         self.model_name = model_name
         self.model_parameters = model_parameters
+        self.batch_size = batch_size  # Rows passed at a time to models which support batch scoring
+        self.max_in_flight = max_in_flight  # Score this many rows (or batches) at a time on a thread pool
+        self.retries = retries  # Retries of a models.TransientModelError with an exponential backoff in seconds
+        self.retry_backoff = retry_backoff
 
         try:
             import localized_dets as ld
@@ -615,28 +1368,115 @@ class ScoreData(ServerClientServerDataTransformation):
 
         self.model = self.model_registry.model_name_class_dict[self.model_name]
         self.model_obj = self.model(model_parameters)
+        self.reusable = not isinstance(self.model_obj, models.HTTPRestModel)  # Remote models can change between jobs
+
+        if explanation is not None:  # "full", "top_k" or "none" for generalized linear models
+            self.model_obj.set_explanation(explanation, explanation_top_k)
+
+    def code_objs(self):
+        return [self.__class__, self.model]  # Model parameters are part of the step's parameters
 
     def run(self):
 
+        if self.commit_chunk_size is not None:
+            try:
+                self._run_in_chunks(self.step_number, self._score_rows)
+            finally:
+                self.model_obj.close()
+            return
+
         transaction = self.connection.begin()
 
         try:
             row_proxy = self._get_data_transformation_step_proxy(self.step_number)
-            for row_obj in row_proxy:
-                score_result, meta = self.model_obj.score(row_obj.data)
-                meta["model name"] = self.model_name
-                self._write_data({"score": score_result}, row_obj.common_id, meta)
+            self._score_rows(row_proxy)
+
+            self._flush_write_buffer()
 
         except:
             transaction.rollback()
             raise()
+        finally:
+            self.model_obj.close()
 
         transaction.commit()
 
+    def _score_rows(self, row_proxy):
+        if self.max_in_flight is not None and self.max_in_flight > 1:
+            self._score_concurrently(row_proxy)
+        else:
+            for row_objs in self._row_obj_chunks(row_proxy):
+                self._write_scores(row_objs, self._score_row_objs(row_objs))
+
+    def _row_obj_chunks(self, row_proxy):
+        """Rows are scored a batch at a time by models which support it otherwise a row at a time"""
+        if self.model_obj.supports_batch_scoring:
+            row_objs = row_proxy.fetchmany(self.batch_size)
+            while len(row_objs):
+                yield row_objs
+                row_objs = row_proxy.fetchmany(self.batch_size)
+        else:
+            for row_obj in row_proxy:
+                yield [row_obj]
+
+    def _score_row_objs(self, row_objs):
+        return self.score_records([row_obj.data for row_obj in row_objs], [row_obj.common_id for row_obj in row_objs])
+
+    def score_records(self, input_dicts, common_ids=None):
+        """Scores and meta of records, as a batch when the model supports it, retrying transient model errors"""
+
+        attempt = 0
+        while True:
+            try:
+                if self.model_obj.supports_batch_scoring:
+                    return self.model_obj.score_batch(input_dicts, common_ids)
+                else:
+                    return [self.model_obj.score(input_dict) for input_dict in input_dicts]
+
+            except models.TransientModelError as e:
+                if attempt >= self.retries:
+                    raise
+                retry_wait = self.retry_backoff * (2 ** attempt)
+                print("    " + "Retrying in %s seconds after: %s" % (retry_wait, e))
+                time.sleep(retry_wait)
+                attempt += 1
+
+    def _score_concurrently(self, row_proxy):
+        """Scores are requested on a thread pool but written in the order of the rows. At most twice
+        max_in_flight chunks are read ahead of the chunk being written."""
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight)
+        pending_scores = collections.deque()
+        try:
+            for row_objs in self._row_obj_chunks(row_proxy):
+                pending_scores.append((row_objs, executor.submit(self._score_row_objs, row_objs)))
+
+                if len(pending_scores) >= 2 * self.max_in_flight:
+                    pending_row_objs, scored_future = pending_scores.popleft()
+                    self._write_scores(pending_row_objs, scored_future.result())
+
+            while len(pending_scores):
+                pending_row_objs, scored_future = pending_scores.popleft()
+                self._write_scores(pending_row_objs, scored_future.result())
+        finally:
+            for pending_row_objs, scored_future in pending_scores:
+                scored_future.cancel()
+            executor.shutdown(wait=True)
+
+    def _write_scores(self, row_objs, scored_list):
+        for row_obj, (score_result, meta) in zip(row_objs, scored_list):
+            self._write_score(score_result, meta, row_obj.common_id)
+
+    def _write_score(self, score_result, meta, common_id):
+        meta["model name"] = self.model_name
+        self._write_data({"score": score_result}, common_id, meta)
+
 
 class WriteFile(ServerClientDataTransformation):
     """Write file to client filesystem from the server database"""
 
+    reusable = False  # The file is written in every job
+
     def __init__(self, step_number, file_name, file_type, fields_to_export=None):
         self.step_number = step_number
         self.file_name = file_name
@@ -1,5 +1,11 @@
+import threading
 from sqlalchemy import and_
 
+try:
+    import psycopg2.extras
+except ImportError:
+    psycopg2 = None
+
 class DBClass(object):
     """Base Class for a PostgreSQL table in a schema"""
     def __init__(self, connection, meta_data):
@@ -21,6 +27,50 @@ class DBClass(object):
     def insert_struct(self, data_struct):
         return self.connection.execute(self.table_obj.insert(data_struct).returning(self.table_obj.c.id)).fetchone()[0]
 
+    def insert_structs(self, data_structs, sum_returning_sql=None):
+        """Insert a list of rows with the same keys without returning ids. With psycopg2 the rows are sent with
+        execute_values on the DBAPI cursor so the speed does not depend on the engine's executemany_mode, and the sum
+        over the inserted rows of sum_returning_sql is returned; other drivers use executemany and return None."""
+
+        if psycopg2 is None or self.connection.dialect.driver != "psycopg2" or not len(data_structs):
+            self.connection.execute(self.table_obj.insert(), data_structs)
+            return None
+
+        dialect = self.connection.dialect
+        column_names = list(data_structs[0].keys())
+        bind_processors = [self.table_obj.c[column_name].type.bind_processor(dialect) for column_name in column_names]
+
+        values = []
+        for data_struct in data_structs:
+            values += [tuple([data_struct[column_name] if bind_processor is None else bind_processor(data_struct[column_name])
+                              for column_name, bind_processor in zip(column_names, bind_processors)])]
+
+        sql_statement = "insert into %s (%s) values %%s" % (
+            dialect.identifier_preparer.format_table(self.table_obj),
+            ", ".join([dialect.identifier_preparer.quote(column_name) for column_name in column_names]))
+
+        if sum_returning_sql is not None:  # A single value is sent back rather than a value for each row
+            sql_statement = """with inserted_rows as (%s returning %s as returned_value)
+select coalesce(sum(returned_value), 0) from inserted_rows""" % (sql_statement, sum_returning_sql)
+
+        # Begins a transaction if the connection is not in one as the DBAPI cursor is not autocommitted
+        transaction = self.connection.begin()
+        try:
+            cursor = self.connection.connection.cursor()
+            try:
+                returned_rows = psycopg2.extras.execute_values(cursor, sql_statement, values, page_size=len(values),
+                                                               fetch=sum_returning_sql is not None)
+            finally:
+                cursor.close()
+        except:
+            transaction.rollback()
+            raise
+
+        transaction.commit()
+
+        if sum_returning_sql is not None:
+            return int(returned_rows[0][0])
+
     def update_struct(self, row_id, update_dict):
         sql_expr = self.table_obj.update().where(self.table_obj.c.id == row_id).values(update_dict)
         self.connection.execute(sql_expr)
@@ -30,6 +80,10 @@ class DBClass(object):
         cursor = self.connection.execute(sql_expr)
         return list(cursor)[0]
 
+    def find_all(self):
+        cursor = self.connection.execute(self.table_obj.select())
+        return list(cursor)
+
 
 class DataTransformationStep(DBClass):
     def _table_name(self):
@@ -127,7 +181,73 @@ class PipelineJob(DBClass):
 
         return list(cursor)[0]
 
+    def find_by_job_id(self, job_id):
+        sql_expr = self.table_obj.select().where(self.table_obj.c.job_id == job_id).order_by(self.table_obj.c.id)
+        cursor = self.connection.execute(sql_expr)
+        return list(cursor)
+
+
+class PipelineDB(DBClass):
+    def _table_name(self):
+        return "pipelines"
+
 
 class PipelineJobDataTranformationStep(DBClass):
     def _table_name(self):
-        return "pipeline_jobs_data_transformation_steps"
\ No newline at end of file
+        return "pipeline_jobs_data_transformation_steps"
+
+    def find_by_pipeline_job_id(self, pipeline_job_id):
+        sql_expr = self.table_obj.select().where(self.table_obj.c.pipeline_job_id == pipeline_job_id).order_by(self.table_obj.c.id)
+        cursor = self.connection.execute(sql_expr)
+        return list(cursor)
+
+
+class DataTransformationStepMetrics(DBClass):
+    def _table_name(self):
+        return "data_transformation_step_metrics"
+
+
+class ReferenceCatalog(object):
+    """In-process cache of the reference rows read while running jobs: ids of named rows such as job statuses and
+    pipelines, data transformation step classes and the data transformation steps of pipelines. Rows are read once
+    and kept until invalidate() is called."""
+
+    def __init__(self, connection, meta_data):
+        self.connection = connection
+        self.meta_data = meta_data
+        self.lock = threading.Lock()  # Steps running in parallel share the catalog
+
+        self._name_ids = {}
+        self._step_classes_by_id = {}
+        self._steps_by_pipeline_id = {}
+
+    def invalidate(self):
+        """Drop cached rows so they are read again, e.g. after pipelines or step classes are changed"""
+        with self.lock:
+            self._name_ids = {}
+            self._step_classes_by_id = {}
+            self._steps_by_pipeline_id = {}
+
+    def get_id(self, db_class_name, name):
+        """Id of a named row of a DBClassName subclass, for example get_id(JobStatus, "Finished")"""
+        with self.lock:
+            if (db_class_name, name) not in self._name_ids:
+                self._name_ids[(db_class_name, name)] = db_class_name(name, self.connection, self.meta_data).get_id()
+            return self._name_ids[(db_class_name, name)]
+
+    def find_step_class_by_id(self, step_class_id):
+        """All step classes are read on the first lookup or when a step class is not cached"""
+        with self.lock:
+            if step_class_id not in self._step_classes_by_id:
+                step_class_obj = DataTransformationStepClassDB(self.connection, self.meta_data)
+                self._step_classes_by_id = dict([(r.id, r) for r in step_class_obj.find_all()])
+            return self._step_classes_by_id[step_class_id]
+
+    def find_steps_by_pipeline_id(self, pipeline_id):
+        """Data transformation steps of a pipeline ordered by step number"""
+        with self.lock:
+            if pipeline_id not in self._steps_by_pipeline_id:
+                data_transformation_step_obj = DataTransformationStep(self.connection, self.meta_data)
+                self._steps_by_pipeline_id[pipeline_id] = sorted(data_transformation_step_obj.find_by_pipeline_id(pipeline_id),
+                                                                 key=lambda x: (x.step_number, x.id))
+            return self._steps_by_pipeline_id[pipeline_id]
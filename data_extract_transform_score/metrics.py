@@ -0,0 +1,250 @@
+"""
+Execution metrics of pipeline job steps recorded in the data_transformation_step_metrics table and a report
+which ranks the steps of a pipeline across its last jobs
+"""
+
+import contextlib
+import os
+import threading
+import time
+import datetime
+from sqlalchemy import event, text
+
+try:
+    from db_classes import DataTransformationStepMetrics
+except ImportError:
+    from .db_classes import DataTransformationStepMetrics
+
+
+def current_rss():
+    """Resident set size in bytes of the process read from /proc/self/statm; None where it is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, AttributeError):
+        return None
+
+
+class StepTimer(object):
+    """Wall time of a step, the time spent executing statements on the step's connection and the peak of the
+    process's resident set size sampled while the step runs. Statements executed through SQLAlchemy are timed with
+    its cursor events; work on the DBAPI cursor which the events do not see, such as fetching rows from a server
+    side cursor, COPY or execute_values, is timed by the step with db_call. The resident set size is of the whole
+    process so with steps running in parallel it includes the memory of the other running steps, and worker
+    processes of a step are not included."""
+
+    rss_sample_interval = 0.05  # Seconds
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.wall_time = None
+        self.db_time = 0.0
+        self.peak_rss = None
+        self._start_time = None
+        self._statement_start_times = []
+        self._db_call_depth = 0
+        self._stop_sampling = threading.Event()
+        self._sampling_thread = None
+
+    def _sample_rss(self):
+        rss = current_rss()
+        if rss is not None and (self.peak_rss is None or rss > self.peak_rss):
+            self.peak_rss = rss
+
+    def _sample_rss_until_stopped(self):
+        while not self._stop_sampling.wait(self.rss_sample_interval):
+            self._sample_rss()
+
+    def _before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        self._statement_start_times.append(time.time())
+
+    def _after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        statement_time = time.time() - self._statement_start_times.pop()
+        if not self._db_call_depth:  # Counted by the enclosing db_call
+            self.db_time += statement_time
+
+    @contextlib.contextmanager
+    def db_call(self, python_time=None):
+        """Count the time of the block as DB time. python_time returns the time spent in Python callbacks of the
+        block, such as the reader of a COPY, which is not counted."""
+        self._db_call_depth += 1
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self._db_call_depth -= 1
+            if not self._db_call_depth:
+                call_time = time.time() - start_time
+                if python_time is not None:
+                    call_time -= python_time()
+                self.db_time += max(call_time, 0.0)
+
+    def start(self):
+        event.listen(self.connection, "before_cursor_execute", self._before_cursor_execute)
+        event.listen(self.connection, "after_cursor_execute", self._after_cursor_execute)
+
+        self._sample_rss()
+        if self.peak_rss is not None:
+            self._sampling_thread = threading.Thread(target=self._sample_rss_until_stopped)
+            self._sampling_thread.daemon = True
+            self._sampling_thread.start()
+
+        self._start_time = time.time()
+
+    def started(self):
+        return self._start_time is not None
+
+    def stop(self):
+        self.wall_time = time.time() - self._start_time
+        event.remove(self.connection, "before_cursor_execute", self._before_cursor_execute)
+        event.remove(self.connection, "after_cursor_execute", self._after_cursor_execute)
+
+        if self._sampling_thread is not None:
+            self._stop_sampling.set()
+            self._sampling_thread.join()
+            self._sample_rss()
+
+    def python_time(self):
+        return max(self.wall_time - self.db_time, 0.0)
+
+
+def _schema_name(meta_data):
+    if meta_data.schema is None:
+        return ""
+    else:
+        return meta_data.schema + "."
+
+
+def record_step_metrics(connection, meta_data, pipeline_job_data_transformation_step_id, step_timer, rows_written,
+                        bytes_written, rows_read=None, read_step_numbers=None,
+                        output_pipeline_job_data_transformation_step_id=None):
+    """Record the metrics of a finished step. Rows and JSONB bytes written are counted by the step as it inserts
+    them; a step which reused the output of output_pipeline_job_data_transformation_step_id is recorded with the
+    rows and bytes recorded for that step. When a step does not count the rows it reads, rows read are the rows
+    written by the steps read_step_numbers in the same pipeline job."""
+
+    schema = _schema_name(meta_data)
+
+    if output_pipeline_job_data_transformation_step_id is not None:
+        cursor = connection.execute(text("""
+select rows_written, bytes_written from %sdata_transformation_step_metrics
+  where pipeline_job_data_transformation_step_id = :pipeline_job_data_transformation_step_id order by id desc limit 1
+        """ % schema), pipeline_job_data_transformation_step_id=output_pipeline_job_data_transformation_step_id)
+        output_metric_rows = list(cursor)
+        if len(output_metric_rows):
+            rows_written, bytes_written = output_metric_rows[0].rows_written, output_metric_rows[0].bytes_written
+        else:
+            rows_written, bytes_written = None, None
+
+    if rows_read is None and read_step_numbers is not None and len(read_step_numbers):
+        cursor = connection.execute(text("""
+select sum(m.rows_written) as rows_read from %sdata_transformation_step_metrics m
+  join %spipeline_jobs_data_transformation_steps pjdts on pjdts.id = m.pipeline_job_data_transformation_step_id
+  join %sdata_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+  join %spipeline_jobs_data_transformation_steps step_pjdts on step_pjdts.pipeline_job_id = pjdts.pipeline_job_id
+    where step_pjdts.id = :pipeline_job_data_transformation_step_id and dts.step_number = any(:step_numbers)
+        """ % (schema, schema, schema, schema)),
+                                    pipeline_job_data_transformation_step_id=pipeline_job_data_transformation_step_id,
+                                    step_numbers=list(read_step_numbers))
+        rows_read = list(cursor)[0].rows_read
+
+    metrics_dict = {"pipeline_job_data_transformation_step_id": pipeline_job_data_transformation_step_id,
+                    "rows_read": rows_read,
+                    "rows_written": rows_written,
+                    "bytes_written": bytes_written,
+                    "wall_time": step_timer.wall_time,
+                    "db_time": step_timer.db_time,
+                    "python_time": step_timer.python_time(),
+                    "peak_rss": step_timer.peak_rss,
+                    "created_at": datetime.datetime.utcnow()}
+
+    return DataTransformationStepMetrics(connection, meta_data).insert_struct(metrics_dict)
+
+
+def _median(values):
+    sorted_values = sorted(values)
+    middle = len(sorted_values) // 2
+    if len(sorted_values) % 2:
+        return sorted_values[middle]
+    else:
+        return (sorted_values[middle - 1] + sorted_values[middle]) / 2.0
+
+
+def step_metrics_report(connection, meta_data, pipeline_name, last_n_jobs=5, regression_ratio=1.25):
+    """Steps of the last jobs of a pipeline ranked by their wall time in the latest job. A step has regressed when
+    its latest wall time is more than regression_ratio times its median wall time in the earlier jobs."""
+
+    schema = _schema_name(meta_data)
+
+    cursor = connection.execute(text("""
+with last_pipeline_jobs as (
+  select pj.id from %spipeline_jobs pj join %spipelines p on p.id = pj.pipeline_id
+    where p.name = :pipeline_name
+      and exists (select 1 from %spipeline_jobs_data_transformation_steps pjdts
+        join %sdata_transformation_step_metrics m on m.pipeline_job_data_transformation_step_id = pjdts.id
+          where pjdts.pipeline_job_id = pj.id)
+    order by pj.id desc limit :last_n_jobs)
+select pjdts.pipeline_job_id, dts.step_number, dts.name, m.rows_read, m.rows_written, m.bytes_written, m.wall_time,
+    m.db_time, m.python_time, m.peak_rss
+  from last_pipeline_jobs lpj
+    join %spipeline_jobs_data_transformation_steps pjdts on pjdts.pipeline_job_id = lpj.id
+    join %sdata_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+    join %sdata_transformation_step_metrics m on m.pipeline_job_data_transformation_step_id = pjdts.id
+  order by pjdts.pipeline_job_id, dts.step_number""" % ((schema,) * 7)),
+                                pipeline_name=pipeline_name, last_n_jobs=last_n_jobs)
+    metric_rows = list(cursor)
+
+    if not len(metric_rows):
+        return []
+
+    latest_pipeline_job_id = max([r.pipeline_job_id for r in metric_rows])
+
+    steps_dict = {}
+    for metric_row in metric_rows:
+        step_key = (metric_row.step_number, metric_row.name)
+        if step_key not in steps_dict:
+            steps_dict[step_key] = {"latest": None, "previous_wall_times": []}
+
+        if metric_row.pipeline_job_id == latest_pipeline_job_id:
+            steps_dict[step_key]["latest"] = metric_row
+        else:
+            steps_dict[step_key]["previous_wall_times"] += [metric_row.wall_time]
+
+    report = []
+    for step_key in steps_dict:
+        latest_row = steps_dict[step_key]["latest"]
+        if latest_row is None:  # Step is not in the latest job
+            continue
+
+        previous_wall_times = steps_dict[step_key]["previous_wall_times"]
+        if len(previous_wall_times):
+            median_wall_time = _median(previous_wall_times)
+        else:
+            median_wall_time = None
+
+        if median_wall_time:
+            wall_time_ratio = latest_row.wall_time / median_wall_time
+        else:
+            wall_time_ratio = None
+
+        if latest_row.wall_time > 0 and latest_row.rows_written is not None:
+            rows_per_second = latest_row.rows_written / latest_row.wall_time
+        else:
+            rows_per_second = None
+
+        report += [{"step_number": latest_row.step_number,
+                    "name": latest_row.name,
+                    "rows_read": latest_row.rows_read,
+                    "rows_written": latest_row.rows_written,
+                    "bytes_written": latest_row.bytes_written,
+                    "wall_time": latest_row.wall_time,
+                    "db_time": latest_row.db_time,
+                    "python_time": latest_row.python_time,
+                    "peak_rss": latest_row.peak_rss,
+                    "rows_per_second": rows_per_second,
+                    "median_wall_time": median_wall_time,
+                    "wall_time_ratio": wall_time_ratio,
+                    "regressed": wall_time_ratio is not None and wall_time_ratio > regression_ratio,
+                    "number_of_jobs": len(previous_wall_times) + 1}]
+
+    return sorted(report, key=lambda x: x["wall_time"], reverse=True)
@@ -1,5 +1,17 @@
+import heapq
 import math
 import requests
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class TransientModelError(IOError):
+    """Raised by a model for a failure which may succeed when retried, e.g., a timeout"""
 
 
 class ModelsRegistry(object):
@@ -25,15 +37,56 @@ class ModelsRegistry(object):
 
 class PredictiveModel(object):
     """Base class for a predictive model"""
+
+    supports_batch_scoring = False  # When True ScoreData passes rows to score_batch
+
     def __init__(self, parameters):
         self.parameters = parameters
 
     def score(self, input_dict):
         return (0.0, None)
 
+    def score_batch(self, input_dicts, record_ids=None):
+        """Score a list of inputs returning a list of (score, meta) in the same order. The record_ids,
+        when given, identify each input to models which pass them on, e.g., the common_id of a row."""
+        return [self.score(input_dict) for input_dict in input_dicts]
+
+    def set_explanation(self, explanation, top_k=None):
+        """Set how much of an explanation of each score is returned in meta"""
+        pass
+
+    def close(self):
+        """Release resources held by the model, e.g., HTTP connections"""
+        pass
+
 
 class GeneralizedLinearModel(PredictiveModel):
 
+    supports_batch_scoring = True
+
+    explanation_levels = ["full", "top_k", "none"]
+
+    def __init__(self, parameters):
+        super(GeneralizedLinearModel, self).__init__(parameters)
+        self.feature_index_dict = None
+        self.coefficients_array = None
+        self.explanation = "full"
+        self.explanation_top_k = 10
+
+        # Parameters sorted once so coefficients not included are filtered rather than sorted for each score
+        self.sorted_parameter_pairs = self._pair_with_coefficients(list(self.parameters.keys()),
+                                                                   list(self.parameters.values()))
+
+    def set_explanation(self, explanation, top_k=None):
+        """Explanation in meta of 'full' (all coefficients included and not included), 'top_k' (the top_k
+        largest coefficients included), or 'none'"""
+        if explanation not in self.explanation_levels:
+            raise RuntimeError("Explanation must be one of: %s" % ", ".join(self.explanation_levels))
+
+        self.explanation = explanation
+        if top_k is not None:
+            self.explanation_top_k = top_k
+
     def _pair_with_coefficients(self, pair1, pair2):
 
         paired_list = [(pair1[i], pair2[i]) for i in range(len(pair1))]
@@ -41,7 +94,17 @@ class GeneralizedLinearModel(PredictiveModel):
 
         return paired_list
 
-    def score(self, input_dict):
+    def _compile_parameters(self):
+        """Compile the parameters once into a feature index and a coefficient vector"""
+        self.feature_index_dict = {}
+        coefficients = []
+        for variable in self.parameters:
+            self.feature_index_dict[variable] = len(coefficients)
+            coefficients += [self.parameters[variable]]
+
+        self.coefficients_array = np.array(coefficients, dtype=float)
+
+    def _included_coefficients(self, input_dict):
 
         input_dict["intercept"] = 1.0
 
@@ -52,29 +115,90 @@ class GeneralizedLinearModel(PredictiveModel):
                 variables_included += [key]
                 coefficients_included += [self.parameters[key] * input_dict[key]]
 
-        coefficients_included_paired = self._pair_with_coefficients(variables_included, coefficients_included)
+        return variables_included, coefficients_included
 
-        variables_not_included = []
-        coefficients_not_included = []
-        for key in self.parameters:
-            if key not in variables_included:
-                variables_not_included += [key]
-                coefficients_not_included += [self.parameters[key]]
+    def score(self, input_dict):
 
-        coefficients_not_included_pairs = self._pair_with_coefficients(variables_not_included, coefficients_not_included)
+        variables_included, coefficients_included = self._included_coefficients(input_dict)
 
         return (self._compute_score_using_model(coefficients_included),
-                {"coefficients_included": coefficients_included_paired,
-                 "coefficients_not_included": coefficients_not_included_pairs})
+                self._explain_score(variables_included, coefficients_included))
+
+    def score_batch(self, input_dicts, record_ids=None):
+
+        if np is None:
+            return super(GeneralizedLinearModel, self).score_batch(input_dicts)
+
+        if self.coefficients_array is None:
+            self._compile_parameters()
+
+        scores = self._compute_scores_using_model(self._linear_predictors(input_dicts))
+
+        if self.explanation == "none":
+            return [(float(score), {}) for score in scores]
+
+        scored_list = []
+        for input_dict, score in zip(input_dicts, scores):
+            variables_included, coefficients_included = self._included_coefficients(input_dict)
+            scored_list += [(float(score), self._explain_score(variables_included, coefficients_included))]
+
+        return scored_list
+
+    def _linear_predictors(self, input_dicts):
+        """Linear predictor for each input as a sparse product with the coefficient vector"""
+
+        feature_index_dict = self.feature_index_dict
+        row_indices = []
+        feature_indices = []
+        values = []
+        for i, input_dict in enumerate(input_dicts):
+            input_dict["intercept"] = 1.0
+            for key in input_dict:
+                if key in feature_index_dict:
+                    row_indices += [i]
+                    feature_indices += [feature_index_dict[key]]
+                    values += [input_dict[key]]
+
+        weights = np.array(values, dtype=float) * self.coefficients_array[np.array(feature_indices, dtype=int)]
+
+        return np.bincount(np.array(row_indices, dtype=int), weights=weights, minlength=len(input_dicts))
+
+    def _explain_score(self, variables_included, coefficients_included):
+
+        if self.explanation == "none":
+            return {}
+
+        elif self.explanation == "top_k":
+            top_k_pairs = heapq.nlargest(self.explanation_top_k, zip(variables_included, coefficients_included),
+                                         key=lambda x: x[1])
+            return {"coefficients_included": top_k_pairs}
+
+        coefficients_included_paired = self._pair_with_coefficients(variables_included, coefficients_included)
+
+        variables_included_set = set(variables_included)
+        coefficients_not_included_pairs = [pair for pair in self.sorted_parameter_pairs
+                                           if pair[0] not in variables_included_set]
+
+        return {"coefficients_included": coefficients_included_paired,
+                "coefficients_not_included": coefficients_not_included_pairs}
 
     def _compute_score_using_model(self, input_dict):
         return None
 
+    def _compute_scores_using_model(self, linear_predictors):
+        """Scores for an array of linear predictors; override with a NumPy expression of the model"""
+        return [self._compute_score_using_model([linear_predictor]) for linear_predictor in linear_predictors]
+
 
 class LogisticRegressionModel(GeneralizedLinearModel):
 
     def _compute_score_using_model(self, coefficients):
-        return math.exp(sum(coefficients)) / (1 + math.exp(sum(coefficients)))
+        exp_sum = math.exp(sum(coefficients))
+        return exp_sum / (1 + exp_sum)
+
+    def _compute_scores_using_model(self, linear_predictors):
+        exp_linear_predictors = np.exp(linear_predictors)
+        return exp_linear_predictors / (1 + exp_linear_predictors)
 
 
 class LinearRegressionModel(GeneralizedLinearModel):
@@ -82,6 +206,10 @@ class LinearRegressionModel(GeneralizedLinearModel):
     def _compute_score_using_model(self, coefficients):
         return sum(coefficients)
 
+    def _compute_scores_using_model(self, linear_predictors):
+        return linear_predictors
+
+
 class LnLinearRegressionModelWithCorrection(GeneralizedLinearModel):
     """Natural logarithm correction factor"""
 
@@ -91,20 +219,73 @@ class LnLinearRegressionModelWithCorrection(GeneralizedLinearModel):
     def _compute_score_using_model(self, coefficients):
         return math.exp(sum(coefficients)) * self.correction_factor
 
+    def _compute_scores_using_model(self, linear_predictors):
+        return np.exp(linear_predictors) * self.correction_factor
+
 
 class HTTPRestModel(PredictiveModel):
-    """A base model that calls an HTTP response"""
+    """A base model that calls an HTTP response.
+
+    Requests share a pooled session which keeps connections alive. Optional parameters are "pool_size"
+    (connections kept per host), "timeout" (seconds) and "batch_url", an endpoint which scores a list of
+    records in one request and responds with a list of results in the same order.
+
+    Connection errors, timeouts and responses with a status in transient_status_codes raise a
+    TransientModelError.
+    """
+
+    transient_status_codes = [429, 502, 503, 504]
+
+    def __init__(self, parameters):
+        super(HTTPRestModel, self).__init__(parameters)
+
+        if "pool_size" in self.parameters:
+            pool_size = self.parameters["pool_size"]
+        else:
+            pool_size = 10
+
+        if "timeout" in self.parameters:
+            self.timeout = self.parameters["timeout"]
+        else:
+            self.timeout = None
+
+        self.session = requests.Session()
+        http_adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", http_adapter)
+        self.session.mount("https://", http_adapter)
+
+        self.supports_batch_scoring = "batch_url" in self.parameters
+
+    def close(self):
+        self.session.close()
 
     def _post_json_with_json_response(self, url, object_to_json):
-        r_obj = requests.post(url, json=object_to_json)
+        r_obj = self._request("post", url, json=object_to_json)
         json_obj = r_obj.json()
         return json_obj
 
     def _get_with_json_response(self, url):
-        r_obj = requests.get(url)
+        r_obj = self._request("get", url)
         json_obj = r_obj.json()
         return json_obj
 
+    def _request(self, method, url, **request_options):
+        try:
+            r_obj = self.session.request(method, url, timeout=self.timeout, **request_options)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            raise TransientModelError("Request to '%s' failed: %s" % (url, e))
+
+        if r_obj.status_code in self.transient_status_codes:
+            raise TransientModelError("Request to '%s' returned status %s" % (url, r_obj.status_code))
+
+        return r_obj
+
+    def score_batch(self, input_dicts, record_ids=None):
+        if "batch_url" in self.parameters:
+            return self._post_json_with_json_response(self.parameters["batch_url"], input_dicts)
+        else:
+            return super(HTTPRestModel, self).score_batch(input_dicts)
+
     def score(self, input_dict):
         score_url = self.parameters["url"]
         if "method" in self.parameters:
@@ -117,16 +298,109 @@ class HTTPRestModel(PredictiveModel):
 
 
 class OpenScoringRestModel(HTTPRestModel):
-    """Score against an OpenScoring API"""
+    """Score against an OpenScoring API.
 
-    def score(self, input_dict):
+    The model details are requested once per model object, or when "model_details_ttl" is set shared between
+    model objects in the process for that many seconds. "model_details_meta" sets what is stored in the meta of
+    each score: "full" (the default, the model details as returned), "summary" (the model id, mining function and
+    summary) or "none". With "batch" set records are scored a batch at a time through the batch evaluation endpoint.
+    """
+
+    model_details_cache = {}  # Keyed by model URL: (time requested, model details)
+    model_details_cache_lock = threading.Lock()
+
+    model_details_summary_keys = ["id", "miningFunction", "summary"]
+
+    def __init__(self, parameters):
+        super(OpenScoringRestModel, self).__init__(parameters)
+
+        self.supports_batch_scoring = True  # Passes record ids to the API
+        self.model_details = None
+        self.record_counter = 0
+
+        if "model_details_meta" in self.parameters:
+            self.model_details_meta = self.parameters["model_details_meta"]
+        else:
+            self.model_details_meta = "full"
+
+    def _get_model_details(self):
+
+        if self.model_details is not None:
+            return self.model_details
 
         openscoring_model_url = self.parameters["url"]
-        model_details = self._get_with_json_response(openscoring_model_url)
 
-        request_struct = {"id": "test1", "arguments": input_dict}
-        # print(request_struct)
+        # Records scored from several threads wait for the first request rather than each requesting the details
+        with self.model_details_cache_lock:
+            if self.model_details is not None:
+                return self.model_details
+
+            if "model_details_ttl" in self.parameters:
+                if openscoring_model_url in self.model_details_cache:
+                    requested_time, model_details = self.model_details_cache[openscoring_model_url]
+                    if time.time() - requested_time < self.parameters["model_details_ttl"]:
+                        self.model_details = model_details
+                        return self.model_details
+
+                model_details = self._get_with_json_response(openscoring_model_url)
+                self.model_details_cache[openscoring_model_url] = (time.time(), model_details)
+            else:
+                model_details = self._get_with_json_response(openscoring_model_url)
+
+            self.model_details = model_details
+
+        return self.model_details
+
+    def _meta(self):
+
+        if self.model_details_meta == "none":
+            return {}
+
+        model_details = self._get_model_details()
+        if self.model_details_meta == "summary":
+            return dict([(key, model_details[key]) for key in self.model_details_summary_keys if key in model_details])
+        else:
+            return dict(model_details)
+
+    def _next_record_id(self):
+        self.record_counter += 1
+        return "record %s" % self.record_counter
+
+    def score(self, input_dict, record_id=None):
+
+        openscoring_model_url = self.parameters["url"]
+
+        if record_id is None:
+            record_id = self._next_record_id()
+
+        request_struct = {"id": str(record_id), "arguments": input_dict}
         model_response = self._post_json_with_json_response(openscoring_model_url, request_struct)
-        # print(model_response)
 
-        return (model_response["result"], model_details)
+        return (model_response["result"], self._meta())
+
+    def score_batch(self, input_dicts, record_ids=None):
+
+        if record_ids is None:
+            record_ids = [self._next_record_id() for input_dict in input_dicts]
+
+        if not self.parameters.get("batch", False):
+            return [self.score(input_dict, record_id) for input_dict, record_id in zip(input_dicts, record_ids)]
+
+        if "batch_url" in self.parameters:
+            openscoring_batch_url = self.parameters["batch_url"]
+        else:
+            openscoring_batch_url = self.parameters["url"].rstrip("/") + "/batch"
+
+        batch_request_struct = {"id": "batch %s" % record_ids[0],
+                                "requests": [{"id": str(record_id), "arguments": input_dict}
+                                             for input_dict, record_id in zip(input_dicts, record_ids)]}
+
+        batch_response = self._post_json_with_json_response(openscoring_batch_url, batch_request_struct)
+
+        scored_list = []
+        for model_response in batch_response["responses"]:
+            if "message" in model_response:
+                raise RuntimeError("Record '%s' was not scored: %s" % (model_response["id"], model_response["message"]))
+            scored_list += [(model_response["result"], self._meta())]
+
+        return scored_list
@@ -14,12 +14,25 @@ except ImportError:
     from .data_transformations import *
 
 import datetime
+import concurrent.futures
+import hashlib
+import json
 
 try:
     from db_classes import *
 except ImportError:
     from .db_classes import *
 
+try:
+    from schema_define import is_partitioned, create_step_partition, step_partition_name
+except ImportError:
+    from .schema_define import is_partitioned, create_step_partition, step_partition_name
+
+try:
+    from metrics import StepTimer, record_step_metrics
+except ImportError:
+    from .metrics import StepTimer, record_step_metrics
+
 
 class DataTransformationStepClasses(object):
     """The data translation step class name is registered with a class"""
@@ -61,17 +74,20 @@ class Pipeline(DBClassName):
         self.raw_pipeline_structure = pipeline_structure
         self.raw_db_pipeline_structure = []
 
+        data_transformation_class_ids = {}
         for element in pipeline_structure:
             data_transformation_step_dict = {}
             data_transformation_class = element["data_transformation_class"]
-            data_transformation_class_obj = DataTransformationStepClass(data_transformation_class,
-                                                                        self.connection, self.meta_data)
+            if data_transformation_class not in data_transformation_class_ids:
+                data_transformation_class_obj = DataTransformationStepClass(data_transformation_class,
+                                                                            self.connection, self.meta_data)
+                data_transformation_class_ids[data_transformation_class] = data_transformation_class_obj.get_id()
             for field in data_trans_fields:
                 if field in element:
                     data_transformation_step_dict[field] = element[field]
 
             data_transformation_step_dict["pipeline_id"] = self.get_id()
-            data_transformation_step_dict["data_transformation_step_class_id"] = data_transformation_class_obj.get_id()
+            data_transformation_step_dict["data_transformation_step_class_id"] = data_transformation_class_ids[data_transformation_class]
 
             self.raw_db_pipeline_structure += [data_transformation_step_dict]
 
@@ -92,7 +108,9 @@ class Jobs(object):
     """Class for running and executing jobs"""
 
     def __init__(self, name, connection, meta_data, file_directory="./",
-                 external_data_connections_dict=None):
+                 external_data_connections_dict=None, write_batch_size=None, stream_results=True, fetch_size=None,
+                 max_parallel_steps=1, catalog=None, record_metrics=True, reuse_step_results=False,
+                 commit_chunk_size=None):
         self.connection = connection
         self.meta_data = meta_data
         self.file_directory = file_directory
@@ -102,6 +120,47 @@ class Jobs(object):
         self.pipeline_jobs_ids = []
         self.name = name
         self.external_data_connections_dict = external_data_connections_dict
+        self.write_batch_size = write_batch_size
+        self.stream_results = stream_results
+        self.fetch_size = fetch_size
+        self.max_parallel_steps = max_parallel_steps  # Steps whose inputs are ready run concurrently when > 1
+        self.status_ids = {}
+
+        # Steps whose fingerprint matches a finished step of an earlier job reference its output instead of running
+        self.reuse_step_results = reuse_step_results
+        self.step_fingerprints = {}  # (pipeline_job_id, step_number) to fingerprint
+
+        self.record_metrics = record_metrics  # Rows, bytes, times and peak memory of each step
+        if self.record_metrics:
+            metrics_table_name = "data_transformation_step_metrics"
+            if meta_data.schema is not None:
+                metrics_table_name = meta_data.schema + "." + metrics_table_name
+            if metrics_table_name not in meta_data.tables:
+                print("Table '%s' does not exist so step metrics are not recorded" % metrics_table_name)
+                self.record_metrics = False
+
+        # Failed jobs and steps are marked with a status that schemas created before it was added do not have
+        failed_status_obj = JobStatus("Failed", connection, meta_data, create_if_does_not_exists=False)
+        if failed_status_obj.name_obj is None:
+            raise RuntimeError("Job status 'Failed' does not exist; run manage_and_run_pipeline_jobs.py with --upgrade-schema")
+        self.failed_status_id = failed_status_obj.get_id()
+
+        pipeline_job_data_trans_obj = PipelineJobDataTranformationStep(connection, meta_data)
+
+        # Schemas created before step outputs were reused have no column for the step whose output is read
+        self.read_reused_step_outputs = "reused_pipeline_job_data_transformation_step_id" in pipeline_job_data_trans_obj.table_obj.c
+
+        # Steps which read another step commit their output every commit_chunk_size rows with a checkpoint
+        self.commit_chunk_size = commit_chunk_size
+        if self.commit_chunk_size is not None:
+            if "checkpoint_id" not in pipeline_job_data_trans_obj.table_obj.c:
+                print("Column 'checkpoint_id' does not exist so steps are not committed in chunks")
+                self.commit_chunk_size = None
+
+        if catalog is not None:
+            self.catalog = catalog  # A catalog can be shared by jobs run one after another
+        else:
+            self.catalog = ReferenceCatalog(connection, meta_data)
 
         self.data_trans_step_classes_obj = DataTransformationStepClasses()
 
@@ -116,8 +175,8 @@ class Jobs(object):
 
         self.job_obj = Job(self.connection, self.meta_data)
 
-        not_start_obj = JobStatus("Not started", self.connection, self.meta_data)
-        job_dict = {"job_status_id": not_start_obj.get_id(),
+        not_started_id = self.catalog.get_id(JobStatus, "Not started")
+        job_dict = {"job_status_id": not_started_id,
                     "name": self.name,
                     "start_date_time": datetime.datetime.utcnow(),
                     "is_active": True}
@@ -126,166 +185,599 @@ class Jobs(object):
 
         pipeline_job_obj = PipelineJob(self.connection, self.meta_data)
         for pipeline in self.pipelines:
-            pipeline_obj = Pipeline(pipeline, self.connection, self.meta_data)
-            pipeline_id = pipeline_obj.get_id()
+            pipeline_id = self.catalog.get_id(Pipeline, pipeline)
 
-            pipeline_obj_dict = {"job_id": self.job_id, "pipeline_id": pipeline_id, "job_status_id": not_start_obj.get_id(),
+            pipeline_obj_dict = {"job_id": self.job_id, "pipeline_id": pipeline_id, "job_status_id": not_started_id,
                                  "start_date_time": datetime.datetime.utcnow(), "is_active": True}
 
             pipeline_job_obj.insert_struct(pipeline_obj_dict)
 
     def run_job(self, with_transaction_rollback=False):
-        """Execute the job"""
+        """Execute the job; reference rows are read once into the catalog for the run"""
+
+        self.catalog.invalidate()
+        self._run_pipelines()
+
+    def resume_job(self, job_id):
+        """Continue a job which failed or was interrupted. Finished steps are not run again, a step which committed
+        chunks continues after its checkpoint and other unfinished steps are run from the start."""
+
+        self.catalog.invalidate()
+
+        self.job_obj = Job(self.connection, self.meta_data)
+        job_row = self.job_obj.find_by_id(job_id)
+        if job_row.job_status_id == self.catalog.get_id(JobStatus, "Finished"):
+            raise RuntimeError("Job %s has already finished" % job_id)
+
+        self.job_id = job_id
+
+        pipeline_db_obj = PipelineDB(self.connection, self.meta_data)
+        pipeline_job_obj = PipelineJob(self.connection, self.meta_data)
+        self.pipelines = [pipeline_db_obj.find_by_id(r.pipeline_id).name for r in pipeline_job_obj.find_by_job_id(job_id)]
 
-        data_transformation_step_obj = DataTransformationStep(self.connection, self.meta_data)
+        print("Resuming job %s" % job_id)
+        self._run_pipelines(resume=True)
 
-        data_transformation_step_class_obj = DataTransformationStepClassDB(self.connection, self.meta_data)
+    def _run_pipelines(self, resume=False):
 
         pipeline_job_data_trans_obj = PipelineJobDataTranformationStep(self.connection, self.meta_data)
 
-        start_obj = JobStatus("Started", self.connection, self.meta_data)
-        finished_obj = JobStatus("Finished", self.connection, self.meta_data)
+        for status_name in ["Not started", "Started", "Finished"]:
+            self.status_ids[status_name] = self.catalog.get_id(JobStatus, status_name)
 
         pipeline_job_obj = PipelineJob(self.connection, self.meta_data)
 
+        partitioned = is_partitioned(self.connection, self.meta_data)  # Each step writes to its own partition
+
         for pipeline in self.pipelines:
-            pipeline_obj = Pipeline(pipeline, self.connection, self.meta_data)
-            pipeline_id = pipeline_obj.get_id()
+            pipeline_id = self.catalog.get_id(Pipeline, pipeline)
 
             pjd_row_obj = pipeline_job_obj.find_by_job_id_and_pipeline_id(self.job_id, pipeline_id)
 
-            pipeline_job_obj.update_struct(pjd_row_obj.id, {"job_status_id": start_obj.get_id()})
-            data_transform_step_objects = data_transformation_step_obj.find_by_pipeline_id(pipeline_id)
+            # Steps recorded before a job is resumed keyed by data transformation step id
+            pipeline_job_steps = {}
+            started_dict = {"job_status_id": self.status_ids["Started"]}
+            if resume:
+                if pjd_row_obj.job_status_id == self.status_ids["Finished"]:
+                    continue
+                for pipeline_job_step in pipeline_job_data_trans_obj.find_by_pipeline_job_id(pjd_row_obj.id):
+                    pipeline_job_steps[pipeline_job_step.data_transformation_step_id] = pipeline_job_step
+                started_dict.update({"end_date_time": None, "is_active": True})
+
+            pipeline_job_obj.update_struct(pjd_row_obj.id, started_dict)
+            data_transform_step_objects = self.catalog.find_steps_by_pipeline_id(pipeline_id)
+
+            self.job_obj.update_struct(self.job_id, started_dict)
+
+            try:
+                if self.max_parallel_steps > 1:
+                    self._run_steps_in_parallel(data_transform_step_objects, pjd_row_obj.id, partitioned,
+                                                pipeline_job_steps)
+                else:
+                    for data_transform_step in data_transform_step_objects:
+
+                        if data_transform_step.id in pipeline_job_steps:
+                            pipeline_job_data_transformation_step_id = self._prepare_resumed_step(
+                                pipeline_job_steps[data_transform_step.id], data_transform_step, pjd_row_obj.id)
+                            if pipeline_job_data_transformation_step_id is None:
+                                continue
+                        else:
+                            pipeline_job_data_transformation_step_id = \
+                                pipeline_job_data_trans_obj.insert_struct(
+                                    self._pipeline_job_data_trans_step_dict(data_transform_step, pjd_row_obj.id, "Started"))
+
+                            if partitioned:
+                                create_step_partition(self.connection, self.meta_data, pipeline_job_data_transformation_step_id)
+
+                        self._run_step(self.connection, data_transform_step, pjd_row_obj.id,
+                                       pipeline_job_data_transformation_step_id)
+            except:
+                failed_dict = {"end_date_time": datetime.datetime.utcnow(),
+                               "job_status_id": self.failed_status_id,
+                               "is_active": False}
+                pipeline_job_obj.update_struct(pjd_row_obj.id, failed_dict)
+                self.job_obj.update_struct(self.job_id, failed_dict)
+                print("Job %s failed; it can be continued with resume_job" % self.job_id)
+                raise
 
-            for data_transform_step in data_transform_step_objects:
+            pipeline_job_obj.update_struct(pjd_row_obj.id, {"end_date_time": datetime.datetime.utcnow(),
+                                                            "job_status_id":  self.status_ids["Finished"],
+                                                            "is_active": False})
 
-                pipeline_job_data_trans_step_dict = {"data_transformation_step_id": data_transform_step.id,
-                                                     "pipeline_job_id": pjd_row_obj.id,
-                                                     "job_status_id": start_obj.get_id(),
-                                                     "start_date_time": datetime.datetime.utcnow(),
-                                                     "is_active": True,
-                                                     "data_transformations_deleted": False,
-                                                     "data_transformations_archived": False
-                                                     }
+        self.job_obj.update_struct(self.job_id, {"end_date_time": datetime.datetime.utcnow(),
+                                                 "job_status_id":  self.status_ids["Finished"],
+                                                  "is_active": False,
+                                                  "is_latest": True})
 
-                self.job_obj.update_struct(self.job_id, {"job_status_id": start_obj.get_id()})
+    def _pipeline_job_data_trans_step_dict(self, data_transform_step, pipeline_job_id, status_name):
 
-                pipeline_job_data_transformation_step_id = \
-                    pipeline_job_data_trans_obj.insert_struct(pipeline_job_data_trans_step_dict)
+        return {"data_transformation_step_id": data_transform_step.id,
+                "pipeline_job_id": pipeline_job_id,
+                "job_status_id": self.status_ids[status_name],
+                "start_date_time": datetime.datetime.utcnow(),
+                "is_active": True,
+                "data_transformations_deleted": False,
+                "data_transformations_archived": False
+                }
 
-                # Run methods registered for data step class
+    def _prepare_resumed_step(self, pipeline_job_step, data_transform_step, pipeline_job_id):
+        """Id of a step recorded before the job was resumed or None when the step has finished. Chunks committed
+        by a step are kept when steps are run in chunks; otherwise its output is deleted so it runs from the start."""
 
-                parameters = data_transform_step.parameters
-                dt_step_class_item = data_transformation_step_class_obj.find_by_id(data_transform_step.data_transformation_step_class_id)
+        if pipeline_job_step.job_status_id == self.status_ids["Finished"]:
+            if self.reuse_step_results:
+                self.step_fingerprints[(pipeline_job_id, data_transform_step.step_number)] = pipeline_job_step.fingerprint
+            return None
+
+        pipeline_job_data_transformation_step_id = pipeline_job_step.id
+
+        if "checkpoint_id" in pipeline_job_step.keys():
+            checkpoint_id = pipeline_job_step.checkpoint_id
+        else:
+            checkpoint_id = None
+
+        if checkpoint_id is None or self.commit_chunk_size is None:
+            schema = self.meta_data.schema + "." if self.meta_data.schema is not None else ""
+            result_proxy = self.connection.execute(text("""
+delete from %sdata_transformations where pipeline_job_data_transformation_step_id = :pipeline_job_data_transformation_step_id"""
+                                                        % schema),
+                                                   pipeline_job_data_transformation_step_id=pipeline_job_data_transformation_step_id)
+            if result_proxy.rowcount:
+                print("Deleted %s rows of step %s to run it from the start" % (result_proxy.rowcount,
+                                                                              data_transform_step.step_number))
+
+            if checkpoint_id is not None:
+                PipelineJobDataTranformationStep(self.connection, self.meta_data).update_struct(
+                    pipeline_job_data_transformation_step_id, {"checkpoint_id": None})
+
+        return pipeline_job_data_transformation_step_id
+
+    def _run_step(self, connection, data_transform_step, pipeline_job_id, pipeline_job_data_transformation_step_id):
+        """Run a single data transformation step on the connection and record that it finished"""
+
+        pipeline_job_data_trans_obj = PipelineJobDataTranformationStep(connection, self.meta_data)
+
+        # Run methods registered for data step class
+
+        parameters = data_transform_step.parameters
+        dt_step_class_item = self.catalog.find_step_class_by_id(data_transform_step.data_transformation_step_class_id)
 
-                data_step_class_name = dt_step_class_item.name
+        data_step_class_name = dt_step_class_item.name
 
-                print("Running step %s: '%s'" % (data_transform_step.step_number, data_transform_step.name))
+        print("Running step %s: '%s'" % (data_transform_step.step_number, data_transform_step.name))
 
-                data_step_class = self.data_trans_step_classes_obj.get_by_class_name(data_step_class_name)
-                data_step_class_obj = data_step_class(**parameters) # Call with parameters from function
-                data_step_class_obj.set_connection_and_meta_data(self.connection, self.meta_data)  # Set DB connection, metadata, and transaction
+        step_timer = StepTimer(connection)
+        try:
+            # A step which can not be created or set up is marked as failed like a step which fails when it runs
+            data_step_class = self.data_trans_step_classes_obj.get_by_class_name(data_step_class_name)
+            data_step_class_obj = data_step_class(**parameters) # Call with parameters from function
+            data_step_class_obj.set_connection_and_meta_data(connection, self.meta_data)  # Set DB connection, metadata, and transaction
 
-                data_step_class_obj.set_external_db_data_connections(self.external_data_connections_dict)
+            data_step_class_obj.set_external_db_data_connections(self.external_data_connections_dict)
 
-                data_step_class_obj.set_pipeline_job_data_transformation_id(pipeline_job_data_transformation_step_id)
-                data_step_class_obj.set_file_directory(self.file_directory)
+            if self.write_batch_size is not None:
+                data_step_class_obj.set_write_batch_size(self.write_batch_size)
 
+            data_step_class_obj.set_stream_results(self.stream_results, self.fetch_size)
+
+            if self.commit_chunk_size is not None:
+                data_step_class_obj.set_commit_chunk_size(self.commit_chunk_size)
+
+            data_step_class_obj.set_read_reused_step_outputs(self.read_reused_step_outputs)
+            data_step_class_obj.set_step_timer(step_timer)
+            data_step_class_obj.set_count_bytes_written(self.record_metrics)
+
+            data_step_class_obj.set_pipeline_job_data_transformation_id(pipeline_job_data_transformation_step_id,
+                                                                        pipeline_job_id, data_transform_step)
+            data_step_class_obj.set_file_directory(self.file_directory)
+
+            fingerprint = None
+            reused_step_id = None
+            if self.reuse_step_results:
+                fingerprint = self._step_fingerprint(data_step_class_name, data_step_class_obj, parameters, pipeline_job_id)
+                if fingerprint is not None:
+                    reused_step_id = self._find_step_with_fingerprint(connection, fingerprint)
+
+            step_timer.start()
+            if reused_step_id is None:
                 data_step_class_obj.run()
+                data_step_class_obj._flush_write_buffer()  # Rows left in the buffer by a step which did not flush
+            else:
+                print("    Reusing the output of pipeline job step %s" % reused_step_id)
+        except:
+            pipeline_job_data_trans_obj.update_struct(pipeline_job_data_transformation_step_id,
+                                                      {"end_date_time": datetime.datetime.utcnow(),
+                                                       "job_status_id": self.failed_status_id,
+                                                       "is_active": False})
+            raise
+        finally:
+            if step_timer.started():
+                step_timer.stop()
+
+        if self.record_metrics:
+            record_step_metrics(connection, self.meta_data, pipeline_job_data_transformation_step_id, step_timer,
+                                data_step_class_obj.rows_written, data_step_class_obj.bytes_written,
+                                data_step_class_obj.rows_read, self._read_step_numbers(parameters), reused_step_id)
+
+        self.step_fingerprints[(pipeline_job_id, data_transform_step.step_number)] = fingerprint
+
+        # Update job information associated with completion
+
+        update_dict = {"end_date_time": datetime.datetime.utcnow(),
+                       "job_status_id":  self.status_ids["Finished"],
+                       "is_active": False}
+
+        if self.reuse_step_results:
+            update_dict["fingerprint"] = fingerprint
+            update_dict["reused_pipeline_job_data_transformation_step_id"] = reused_step_id
+
+        pipeline_job_data_trans_obj.update_struct(pipeline_job_data_transformation_step_id, update_dict)
+
+    def _step_fingerprint(self, data_step_class_name, data_step_class_obj, parameters, pipeline_job_id):
+        """Hash of the step's class, the source of its code, parameters, the contents of its input files and the
+        fingerprints of the steps it reads. None when the output of the step, or of a step it reads, can not be
+        reused."""
+
+        if not data_step_class_obj.reusable:
+            return None
 
-                # Update job information associated with completion
+        code_fingerprint = data_step_class_obj.code_fingerprint()
+        if code_fingerprint is None:
+            return None
 
-                pipeline_job_data_trans_obj.update_struct(pipeline_job_data_transformation_step_id,
-                                                          {"end_date_time": datetime.datetime.utcnow(),
-                                                           "job_status_id":  finished_obj.get_id(),
-                                                           "is_active": False})
+        read_step_fingerprints = []
+        for step_number in self._read_step_numbers(parameters):
+            read_step_fingerprint = self.step_fingerprints.get((pipeline_job_id, step_number))
+            if read_step_fingerprint is None:
+                return None
+            read_step_fingerprints += [read_step_fingerprint]
+
+        input_file_hashes = []
+        for file_name in data_step_class_obj.input_file_names():
+            file_hash = hashlib.sha256()
+            with open(file_name, "rb") as f:
+                for file_block in iter(lambda: f.read(1048576), b""):
+                    file_hash.update(file_block)
+            input_file_hashes += [file_hash.hexdigest()]
+
+        fingerprint_dict = {"data_transformation_class": data_step_class_name, "code_fingerprint": code_fingerprint,
+                            "parameters": parameters,
+                            "input_file_hashes": input_file_hashes, "read_step_fingerprints": read_step_fingerprints}
+
+        return hashlib.sha256(json.dumps(fingerprint_dict, sort_keys=True).encode("utf8")).hexdigest()
+
+    def _find_step_with_fingerprint(self, connection, fingerprint):
+        """Latest finished step with the fingerprint whose output has not been archived or deleted"""
+
+        schema = self.meta_data.schema + "." if self.meta_data.schema is not None else ""
+
+        cursor = connection.execute(text("""
+select output_pjdts.id from %spipeline_jobs_data_transformation_steps pjdts
+    join %sjob_statuses js on js.id = pjdts.job_status_id
+    join %spipeline_jobs_data_transformation_steps output_pjdts
+      on output_pjdts.id = coalesce(pjdts.reused_pipeline_job_data_transformation_step_id, pjdts.id)
+    where pjdts.fingerprint = :fingerprint and js.name = 'Finished'
+      and output_pjdts.data_transformations_archived = FALSE and output_pjdts.data_transformations_deleted = FALSE
+    order by pjdts.id desc limit 1""" % (schema, schema, schema)), fingerprint=fingerprint)
+
+        found_rows = list(cursor)
+        if len(found_rows):
+            return found_rows[0].id
+        else:
+            return None
 
-            pipeline_job_obj.update_struct(pjd_row_obj.id, {"end_date_time": datetime.datetime.utcnow(),
-                                                            "job_status_id":  finished_obj.get_id(),
-                                                            "is_active": False})
+    def _run_step_on_new_connection(self, data_transform_step, pipeline_job_id, pipeline_job_data_transformation_step_id):
+        """Run a step on its own connection from the engine's pool"""
 
-        self.job_obj.update_struct(self.job_id, {"end_date_time": datetime.datetime.utcnow(),
-                                                 "job_status_id":  finished_obj.get_id(),
-                                                  "is_active": False,
-                                                  "is_latest": True})
+        connection = self.connection.engine.connect()
+        try:
+            pipeline_job_data_trans_obj = PipelineJobDataTranformationStep(connection, self.meta_data)
+            pipeline_job_data_trans_obj.update_struct(pipeline_job_data_transformation_step_id,
+                                                      {"start_date_time": datetime.datetime.utcnow(),
+                                                       "job_status_id": self.status_ids["Started"]})
+
+            self._run_step(connection, data_transform_step, pipeline_job_id, pipeline_job_data_transformation_step_id)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _read_step_numbers(parameters):
+        """Numbers of the steps a step reads from through its step_number or step_numbers parameters. A step_numbers
+        item is either a step number or a [step number, name] pair."""
+
+        if parameters is None:
+            parameters = {}
+
+        step_numbers = []
+        if "step_number" in parameters:
+            step_numbers += [parameters["step_number"]]
+        if "step_numbers" in parameters:
+            for step_number in parameters["step_numbers"]:
+                if step_number.__class__ == [].__class__:
+                    step_number = step_number[0]
+                step_numbers += [step_number]
+
+        return step_numbers
+
+    def _step_dependencies(self, data_transform_steps):
+        """Steps each step reads from"""
+
+        step_ids_by_number = {}
+        for data_transform_step in data_transform_steps:
+            if data_transform_step.step_number not in step_ids_by_number:
+                step_ids_by_number[data_transform_step.step_number] = []
+            step_ids_by_number[data_transform_step.step_number] += [data_transform_step.id]
+
+        dependencies = {}
+        for data_transform_step in data_transform_steps:
+            dependencies[data_transform_step.id] = set()
+            for step_number in self._read_step_numbers(data_transform_step.parameters):
+                if step_number in step_ids_by_number:
+                    dependencies[data_transform_step.id] |= set(step_ids_by_number[step_number])
+
+            dependencies[data_transform_step.id].discard(data_transform_step.id)
+
+        return dependencies
+
+    def _run_steps_in_parallel(self, data_transform_steps, pipeline_job_id, partitioned, pipeline_job_steps=None):
+        """Run steps as soon as the steps they read from have finished with up to max_parallel_steps steps running
+        at once, each on a separate pooled connection. pipeline_job_steps are the steps recorded before a job is
+        resumed."""
+
+        if pipeline_job_steps is None:
+            pipeline_job_steps = {}
+
+        dependencies = self._step_dependencies(data_transform_steps)
+
+        # All steps are recorded and their partitions created up front as creating a partition while other steps
+        # hold locks on data_transformations can deadlock
+        pipeline_job_data_trans_obj = PipelineJobDataTranformationStep(self.connection, self.meta_data)
+        pipeline_job_data_transformation_step_ids = {}
+        finished_step_ids = set()
+        for data_transform_step in data_transform_steps:
+            if data_transform_step.id in pipeline_job_steps:
+                pipeline_job_data_transformation_step_id = self._prepare_resumed_step(
+                    pipeline_job_steps[data_transform_step.id], data_transform_step, pipeline_job_id)
+                if pipeline_job_data_transformation_step_id is None:
+                    finished_step_ids.add(data_transform_step.id)
+                    continue
+            else:
+                pipeline_job_data_transformation_step_id = \
+                    pipeline_job_data_trans_obj.insert_struct(
+                        self._pipeline_job_data_trans_step_dict(data_transform_step, pipeline_job_id, "Not started"))
+
+                if partitioned:
+                    create_step_partition(self.connection, self.meta_data, pipeline_job_data_transformation_step_id)
+
+            pipeline_job_data_transformation_step_ids[data_transform_step.id] = pipeline_job_data_transformation_step_id
+
+            self.catalog.find_step_class_by_id(data_transform_step.data_transformation_step_class_id)  # Fill the cache before steps run on other connections
+
+        remaining_steps = [s for s in data_transform_steps if s.id not in finished_step_ids]
+        running_steps = {}
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_parallel_steps)
+        try:
+            while len(remaining_steps) or len(running_steps):
+
+                ready_steps = [s for s in remaining_steps if dependencies[s.id] <= finished_step_ids]
+                for data_transform_step in ready_steps[:self.max_parallel_steps - len(running_steps)]:
+                    remaining_steps.remove(data_transform_step)
+                    future = executor.submit(self._run_step_on_new_connection, data_transform_step, pipeline_job_id,
+                                             pipeline_job_data_transformation_step_ids[data_transform_step.id])
+                    running_steps[future] = data_transform_step
+
+                if not len(running_steps):
+                    raise RuntimeError("Steps %s depend on steps which can not run before them" %
+                                       [s.step_number for s in remaining_steps])
+
+                done_futures, _ = concurrent.futures.wait(list(running_steps.keys()),
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done_futures:
+                    data_transform_step = running_steps.pop(future)
+                    future.result()  # Raises the exception of a failed step
+                    finished_step_ids.add(data_transform_step.id)
+        except:
+            # Steps which did not start are marked as failed so they are not left waiting to run
+            for data_transform_step in remaining_steps:
+                pipeline_job_data_trans_obj.update_struct(pipeline_job_data_transformation_step_ids[data_transform_step.id],
+                                                          {"end_date_time": datetime.datetime.utcnow(),
+                                                           "job_status_id": self.failed_status_id,
+                                                           "is_active": False})
+            raise
+        finally:
+            executor.shutdown(wait=True)  # Steps already running are finished before an exception is raised
 
 
 class ArchivePipeline(object):
-    """Archives and deletes unwanted data transformations"""
+    """Archives and deletes unwanted data transformations. The rows of each step are moved in chunks with a commit
+    after each chunk so archiving does not hold locks on data_transformations for long."""
 
-    def __init__(self, pipeline_name, connection, meta_data):
+    def __init__(self, pipeline_name, connection, meta_data, chunk_size=50000):
 
         self.pipeline_name = pipeline_name
         self.connection = connection
         self.meta_data = meta_data
+        self.chunk_size = chunk_size  # Rows of a step moved in each transaction
 
         self.pipeline_obj = Pipeline(pipeline_name, self.connection, self.meta_data)
 
-    def _get_associated_pipeline_jobs(self):
-        schema = self.meta_data.schema
-        query_string = """select pj.id as pipeline_job_id, pj.job_id 
-  from %s.pipeline_jobs pj 
-  join %s.jobs j on pj.job_id = j.id
-  join %s.pipelines p on pj.pipeline_id  = p.id
-  where p.id = %s""" % (schema, schema, schema, self.pipeline_obj.get_id())
-
-        return list(self.connection.execute(query_string))
+        self.partitioned = is_partitioned(self.connection, self.meta_data)
 
     def _get_associated_pipeline_data_steps(self):
-
-        pipeline_jobs_list = self._get_associated_pipeline_jobs()
-        pipeline_jobs_dict = {}
+        """Finished steps of the pipeline's jobs whose data transformations are not archived or deleted keyed by
+        (job_id, pipeline_job_id)"""
 
         schema = self.meta_data.schema
-        for pipeline_job_item in pipeline_jobs_list:
-            dict_key = (pipeline_job_item.job_id, pipeline_job_item.pipeline_job_id)
-
-            query_string = """select pjdt.data_transformation_step_id, dts.step_number,
+        query_string = """select pj.job_id, pj.id as pipeline_job_id, pjdt.data_transformation_step_id, dts.step_number,
     pjdt.id as pipeline_job_data_transformation_step_id
-  from %s.pipeline_jobs_data_transformation_steps pjdt 
+  from %s.pipeline_jobs pj
+    join %s.pipeline_jobs_data_transformation_steps pjdt on pjdt.pipeline_job_id = pj.id
     join %s.job_statuses js on pjdt.job_status_id = js.id
     join %s.data_transformation_steps dts on dts.id = pjdt.data_transformation_step_id
-      where js.name = 'Finished' and pjdt.pipeline_job_id = %s and (data_transformations_archived = FALSE and data_transformations_deleted = FALSE)
-            """ % (schema, schema, schema, pipeline_job_item.job_id)
+      where pj.pipeline_id = %s and js.name = 'Finished'
+        and (data_transformations_archived = FALSE and data_transformations_deleted = FALSE)
+      order by pj.id, pjdt.id""" % (schema, schema, schema, schema, self.pipeline_obj.get_id())
 
-            cursor = self.connection.execute(query_string)
-            result_list = [(c.pipeline_job_data_transformation_step_id, c.data_transformation_step_id, c.step_number) for c in cursor]
+        pipeline_jobs_dict = {}
+        for c in self.connection.execute(query_string):
+            dict_key = (c.job_id, c.pipeline_job_id)
+            if dict_key not in pipeline_jobs_dict:
+                pipeline_jobs_dict[dict_key] = []
 
-            pipeline_jobs_dict[dict_key] = result_list
+            pipeline_jobs_dict[dict_key] += [(c.pipeline_job_data_transformation_step_id, c.data_transformation_step_id, c.step_number)]
 
         return pipeline_jobs_dict
 
     def archive_steps(self, steps=None):
+        """Archive the data transformations of the steps, all steps when None, and delete the data transformations of
+        the other steps"""
 
         pipeline_job_dict = self._get_associated_pipeline_data_steps()
-        schema = self.meta_data.schema
 
+        archived_step_ids = []
+        deleted_step_ids = []
         for job_tuple in pipeline_job_dict:
-            #job_id, pipeline_job_id = job_tuple
-
             for dts in pipeline_job_dict[job_tuple]:
                 pipeline_job_data_transformation_step_id, data_transformation_id, step_number = dts
 
-                insert_query_string = """insert into %s.archived_data_transformations select dts.*, cast(now() as timestamp) at time zone 'utc' from %s.data_transformations dts 
-                                                        where dts.pipeline_job_data_transformation_step_id = %s""" % (
-                schema, schema, pipeline_job_data_transformation_step_id)
+                if steps is None or step_number in steps:
+                    archived_step_ids += [pipeline_job_data_transformation_step_id]
+                else:
+                    deleted_step_ids += [pipeline_job_data_transformation_step_id]
+
+        archived_step_ids, deleted_step_ids = self._keep_reused_step_outputs(archived_step_ids, deleted_step_ids)
+
+        if not len(archived_step_ids + deleted_step_ids):
+            print("No steps to archive")
+            return
 
-                step_archived = False
-                if steps is None:
-                    self.connection.execute(insert_query_string)
-                    step_archived = True
+        print("Archiving %s and deleting %s steps" % (len(archived_step_ids), len(deleted_step_ids)))
 
-                elif step_number in steps:
-                    self.connection.execute(insert_query_string)
-                    step_archived = True
+        # Each step is moved on its own so its rows are read through the index on (step, id)
+        archived_step_id_set = set(archived_step_ids)
+        for pipeline_job_data_transformation_step_id in archived_step_ids + deleted_step_ids:
+            step_archived = pipeline_job_data_transformation_step_id in archived_step_id_set
+            if self.partitioned and self._has_step_partition(pipeline_job_data_transformation_step_id):
+                self._move_step_partition(pipeline_job_data_transformation_step_id, step_archived)
+            else:
+                self._move_step_rows_in_chunks(pipeline_job_data_transformation_step_id, step_archived)
 
-                delete_query_string = """
-                delete from %s.data_transformations where pipeline_job_data_transformation_step_id = %s 
-                """ % (schema, pipeline_job_data_transformation_step_id)
+    def _keep_reused_step_outputs(self, archived_step_ids, deleted_step_ids):
+        """The output of a step reused by a step of a later job is kept while that step is not archived or deleted.
+        It is archived rather than deleted when a step which reuses it is archived."""
 
-                self.connection.execute(delete_query_string)
+        pjdts_table_obj = PipelineJobDataTranformationStep(self.connection, self.meta_data).table_obj
+        if "reused_pipeline_job_data_transformation_step_id" not in pjdts_table_obj.c:
+            return archived_step_ids, deleted_step_ids
 
-                pjdts_obj = PipelineJobDataTranformationStep(self.connection, self.meta_data)
-                pjdts_obj_id = pjdts_obj.find_by_id(pipeline_job_data_transformation_step_id)
+        schema = self.meta_data.schema
+        query_string = """select id, reused_pipeline_job_data_transformation_step_id as reused_step_id
+    from %s.pipeline_jobs_data_transformation_steps
+    where reused_pipeline_job_data_transformation_step_id = any(:step_ids)
+      and data_transformations_archived = FALSE and data_transformations_deleted = FALSE""" % (schema,)
+
+        archived_step_id_set = set(archived_step_ids)
+        deleted_step_id_set = set(deleted_step_ids)
+
+        kept_step_ids = set()
+        for c in self.connection.execute(text(query_string), step_ids=archived_step_ids + deleted_step_ids):
+            if c.id in archived_step_id_set:
+                if c.reused_step_id in deleted_step_id_set:
+                    deleted_step_id_set.remove(c.reused_step_id)
+                    archived_step_id_set.add(c.reused_step_id)
+            elif c.id not in deleted_step_id_set:
+                kept_step_ids.add(c.reused_step_id)
+
+        if len(kept_step_ids):
+            print("Keeping the output of %s steps reused by later jobs" % len(kept_step_ids))
+
+        archived_step_ids = [s for s in archived_step_ids + deleted_step_ids
+                             if s in archived_step_id_set and s not in kept_step_ids]
+        deleted_step_ids = [s for s in deleted_step_ids if s in deleted_step_id_set and s not in kept_step_ids]
+
+        return archived_step_ids, deleted_step_ids
 
-                pjdts_obj.update_struct(pjdts_obj_id.id, {"data_transformations_deleted": True, "data_transformations_archived": step_archived})
\ No newline at end of file
+    def _move_step_rows_in_chunks(self, pipeline_job_data_transformation_step_id, step_archived):
+        """Delete the rows of the step chunk_size rows at a time in order of id, inserting the deleted rows into
+        archived_data_transformations in the same statement when the step is archived. The step is marked as
+        archived or deleted with its last chunk."""
+
+        schema = self.meta_data.schema
+
+        move_query_string = """with chunk as (
+    select id from %s.data_transformations
+        where pipeline_job_data_transformation_step_id = :step_id and id > :last_id order by id limit :chunk_size
+), moved as (
+    delete from %s.data_transformations where id in (select id from chunk)
+        returning *
+), archived as (
+    insert into %s.archived_data_transformations
+        select moved.*, cast(now() as timestamp) at time zone 'utc' from moved where :step_archived
+)
+select count(*) as number_of_rows, max(id) as last_id from moved""" % (schema, schema, schema)
+
+        number_of_rows_moved = 0
+        last_id = 0
+        number_of_rows_in_chunk = self.chunk_size
+        while number_of_rows_in_chunk == self.chunk_size:
+
+            transaction = self.connection.begin()
+            try:
+                moved_row = list(self.connection.execute(text(move_query_string), step_id=pipeline_job_data_transformation_step_id,
+                                                         last_id=last_id, chunk_size=self.chunk_size,
+                                                         step_archived=step_archived))[0]
+                number_of_rows_in_chunk = moved_row.number_of_rows
+
+                if number_of_rows_in_chunk < self.chunk_size:
+                    self._mark_step_moved(pipeline_job_data_transformation_step_id, step_archived)
+            except:
+                transaction.rollback()
+                raise
+
+            transaction.commit()
+
+            if number_of_rows_in_chunk:
+                number_of_rows_moved += number_of_rows_in_chunk
+                last_id = moved_row.last_id
+                print("    " + "Archived or deleted %s rows of step %s" % (number_of_rows_moved,
+                                                                          pipeline_job_data_transformation_step_id))
+
+    def _mark_step_moved(self, pipeline_job_data_transformation_step_id, step_archived):
+        PipelineJobDataTranformationStep(self.connection, self.meta_data).update_struct(
+            pipeline_job_data_transformation_step_id,
+            {"data_transformations_deleted": True, "data_transformations_archived": step_archived})
+
+    def _has_step_partition(self, pipeline_job_data_transformation_step_id):
+        partition_name = "%s.%s" % (self.meta_data.schema, step_partition_name("data_transformations", pipeline_job_data_transformation_step_id))
+        return list(self.connection.execute(text("select to_regclass(:partition_name) is not null"), partition_name=partition_name))[0][0]
+
+    def _move_step_partition(self, pipeline_job_data_transformation_step_id, step_archived):
+        """Detach the step's partition and either attach it to archived_data_transformations or drop it"""
+
+        schema = self.meta_data.schema
+        partition_name = step_partition_name("data_transformations", pipeline_job_data_transformation_step_id)
+        archived_partition_name = step_partition_name("archived_data_transformations", pipeline_job_data_transformation_step_id)
+
+        transaction = self.connection.begin()
+        try:
+            self.connection.execute("alter table %s.data_transformations detach partition %s.%s" % (schema, schema, partition_name))
+
+            if step_archived:
+                sql_statements = ["alter table %s.%s add column archived_at timestamp default (cast(now() as timestamp) at time zone 'utc')",
+                                  "alter table %s.%s alter column archived_at drop default",
+                                  "alter table %s.%s rename to " + archived_partition_name]
+                for sql_statement in sql_statements:
+                    self.connection.execute(sql_statement % (schema, partition_name))
+
+                self.connection.execute("alter table %s.archived_data_transformations attach partition %s.%s for values in (%s)" %
+                                        (schema, schema, archived_partition_name, int(pipeline_job_data_transformation_step_id)))
+            else:
+                self.connection.execute("drop table %s.%s" % (schema, partition_name))
+
+            self._mark_step_moved(pipeline_job_data_transformation_step_id, step_archived)
+        except:
+            transaction.rollback()
+            raise
+
+        transaction.commit()
@@ -1,9 +1,16 @@
-from sqlalchemy import Table, Column, Integer, Text, String, DateTime, ForeignKey, create_engine, MetaData, Boolean, UniqueConstraint
+from sqlalchemy import Table, Column, Integer, BigInteger, Text, String, DateTime, Float, ForeignKey, create_engine, MetaData, Boolean, UniqueConstraint, Index, text, inspect
 from sqlalchemy.dialects.postgresql import JSONB
 import json
 
 
-def schema_define(meta_data):
+def schema_define(meta_data, partitioned=False):
+    """With partitioned the data transformations tables are list partitioned by the pipeline job data transformation
+    step so each step's output is stored, read, archived and dropped as its own partition"""
+
+    if partitioned:
+        partition_options = {"postgresql_partition_by": "LIST (pipeline_job_data_transformation_step_id)"}
+    else:
+        partition_options = {}
 
     job_statuses = Table("job_statuses", meta_data,
                          Column("id", Integer, primary_key=True),
@@ -42,6 +49,7 @@ def schema_define(meta_data):
                           Column("start_date_time", DateTime),
                           Column("end_date_time", DateTime),
                           Column("is_active", Boolean),
+                          Index("idx_pj_job_pipeline", "job_id", "pipeline_id"),
                           extend_existing=True
                           )
 
@@ -68,28 +76,57 @@ def schema_define(meta_data):
                                                  Column("is_active", Boolean),
                                                  Column("data_transformations_archived", Boolean, default=False),
                                                  Column("data_transformations_deleted", Boolean, default=False),
+                                                 Column("fingerprint", String(64)),  # See Jobs reuse_step_results
+                                                 Column("reused_pipeline_job_data_transformation_step_id",
+                                                        ForeignKey("pipeline_jobs_data_transformation_steps.id")),
+                                                 Column("checkpoint_id", BigInteger),  # Last data transformation id read by a committed chunk
+                                                 Index("idx_pjdts_pj_dts", "pipeline_job_id", "data_transformation_step_id"),
+                                                 Index("idx_pjdts_fingerprint", "fingerprint"),
                                                  extend_existing=True
                                                 )
 
+    # Times are in seconds and peak_rss in bytes
+    data_transformation_step_metrics = Table("data_transformation_step_metrics", meta_data,
+                                             Column("id", Integer, primary_key=True),
+                                             Column("pipeline_job_data_transformation_step_id",
+                                                    ForeignKey("pipeline_jobs_data_transformation_steps.id"), nullable=False),
+                                             Column("rows_read", BigInteger),
+                                             Column("rows_written", BigInteger),
+                                             Column("bytes_written", BigInteger),
+                                             Column("wall_time", Float),
+                                             Column("db_time", Float),
+                                             Column("python_time", Float),
+                                             Column("peak_rss", BigInteger),
+                                             Column("created_at", DateTime),
+                                             Index("idx_dtsm_pjdts", "pipeline_job_data_transformation_step_id"),
+                                             extend_existing=True
+                                             )
+
+    # The primary key of a partitioned table includes the partition column
     data_transformations = Table("data_transformations", meta_data,
-                                 Column("id", Integer, primary_key=True),
+                                 Column("id", BigInteger, primary_key=True, autoincrement=True),
                                  Column("data", JSONB),
                                  Column("meta", JSONB),
                                  Column("common_id", String(255), index=True),
-                                 Column("pipeline_job_data_transformation_step_id", ForeignKey("pipeline_jobs_data_transformation_steps.id"), nullable=False),
+                                 Column("pipeline_job_data_transformation_step_id", ForeignKey("pipeline_jobs_data_transformation_steps.id"), nullable=False,
+                                        primary_key=partitioned),
                                  Column("created_at", DateTime),
-                                 extend_existing=True
+                                 Index("idx_dt_pjdts_common_id", "pipeline_job_data_transformation_step_id", "common_id"),
+                                 Index("idx_dt_pjdts_id", "pipeline_job_data_transformation_step_id", "id"),
+                                 extend_existing=True, **partition_options
                                  )
 
     archived_data_transformations = Table("archived_data_transformations", meta_data,
-                                 Column("id", Integer, primary_key=True),
+                                 Column("id", BigInteger, primary_key=True, autoincrement=True),
                                  Column("data", JSONB),
                                  Column("meta", JSONB),
                                  Column("common_id", String(255), index=True),
-                                 Column("pipeline_job_data_transformation_step_id", ForeignKey("pipeline_jobs_data_transformation_steps.id"), nullable=False),
+                                 Column("pipeline_job_data_transformation_step_id", ForeignKey("pipeline_jobs_data_transformation_steps.id"), nullable=False,
+                                        primary_key=partitioned),
                                  Column("created_at", DateTime),
                                  Column("archived_at", DateTime),
-                                 extend_existing=True
+                                 Index("idx_adt_pjdts", "pipeline_job_data_transformation_step_id"),
+                                 extend_existing=True, **partition_options
                                  )
 
     return meta_data
@@ -113,19 +150,30 @@ def populate_reference_table(table_name, connection, meta, list_of_values):
         connection.execute(table_obj.insert(tuple_value))
 
 
-def create_and_populate_schema(connection, meta_data, drop_all=True):
+job_statuses = [(1, "Started"), (2, "Finished"), (3, "Not started"), (4, "Failed")]
+
+
+def create_and_populate_schema(connection, meta_data, drop_all=True, partitioned=False):
     schema_name = meta_data.schema
     if drop_all:
         meta_data.reflect()
+        for partition_name in get_partition_names(connection, meta_data):  # Dropped with their partitioned table
+            if partition_name in meta_data.tables:
+                meta_data.remove(meta_data.tables[partition_name])
         meta_data.drop_all()
 
     meta_data = MetaData(connection, schema=schema_name)
-    meta_data = schema_define(meta_data)
+    meta_data = schema_define(meta_data, partitioned=partitioned)
 
     meta_data.create_all(checkfirst=True)
 
+    if partitioned:
+        for table_name in partitioned_table_names:  # Holds rows of steps without a partition
+            connection.execute("create table if not exists %s partition of %s default" %
+                               (_qualified_table_name(meta_data, table_name + "_default"),
+                                _qualified_table_name(meta_data, table_name)))
+
     table_dict = get_table_names_without_schema(meta_data)
-    job_statuses = [(1, "Started"), (2, "Finished"), (3, "Not started")]
     populate_reference_table(table_dict["job_statuses"], connection, meta_data, job_statuses)
 
     primary_data_transform_classes = [
@@ -157,6 +205,147 @@ def create_and_populate_schema(connection, meta_data, drop_all=True):
     return meta_data, table_dict
 
 
+partitioned_table_names = ["data_transformations", "archived_data_transformations"]
+
+
+def _qualified_table_name(meta_data, table_name):
+    if meta_data.schema is None:
+        return table_name
+    else:
+        return meta_data.schema + "." + table_name
+
+
+def _schema_name_in_db(meta_data):
+    if meta_data.schema is None:
+        return "public"
+    else:
+        return meta_data.schema
+
+
+def get_partition_names(connection, meta_data):
+    """Names, as keys of meta_data.tables, of the tables in the schema which are partitions of another table"""
+
+    cursor = connection.execute(text("""
+select c.relname from pg_inherits i
+    join pg_class c on c.oid = i.inhrelid
+    join pg_namespace n on n.oid = c.relnamespace
+    where n.nspname = :schema_name and c.relkind in ('r', 'p')"""), schema_name=_schema_name_in_db(meta_data))
+
+    return [_qualified_table_name(meta_data, r.relname) for r in cursor]
+
+
+def is_partitioned(connection, meta_data, table_name="data_transformations"):
+    """True when the table was created by schema_define with partitioned"""
+
+    cursor = connection.execute(text("""
+select c.relkind from pg_class c join pg_namespace n on n.oid = c.relnamespace
+    where n.nspname = :schema_name and c.relname = :table_name"""),
+                                schema_name=_schema_name_in_db(meta_data), table_name=table_name)
+    return [r.relkind for r in cursor] == ["p"]
+
+
+def step_partition_name(table_name, pipeline_job_data_transformation_step_id):
+    return "%s_%s" % (table_name, pipeline_job_data_transformation_step_id)
+
+
+def create_step_partition(connection, meta_data, pipeline_job_data_transformation_step_id):
+    """Create the partition of data_transformations which holds the output of a pipeline job step"""
+
+    connection.execute("create table %s partition of %s for values in (%s)" % (
+        _qualified_table_name(meta_data, step_partition_name("data_transformations", pipeline_job_data_transformation_step_id)),
+        _qualified_table_name(meta_data, "data_transformations"), int(pipeline_job_data_transformation_step_id)))
+
+
+def add_missing_tables_and_columns(connection, meta_data):
+    """Create the tables and add the columns in schema_define that are missing from an existing schema. Added
+    columns are nullable. Returns the names of the added tables and columns."""
+
+    defined_meta_data = schema_define(MetaData(schema=meta_data.schema))
+    inspector = inspect(connection)
+    quote = connection.dialect.identifier_preparer.quote
+
+    existing_table_names = inspector.get_table_names(schema=meta_data.schema)
+
+    added_names = []
+    for table_obj in defined_meta_data.sorted_tables:
+        if table_obj.name not in existing_table_names:
+            print("Creating table '%s'" % table_obj.name)
+            table_obj.create(connection)
+            added_names += [table_obj.name]
+            continue
+
+        existing_column_names = [c["name"] for c in inspector.get_columns(table_obj.name, schema=meta_data.schema)]
+        for column_obj in table_obj.columns:
+            if column_obj.name in existing_column_names:
+                continue
+
+            references_sql = ""
+            for foreign_key_obj in column_obj.foreign_keys:
+                references_sql = " references %s (%s)" % (
+                    _qualified_table_name(meta_data, foreign_key_obj.column.table.name), quote(foreign_key_obj.column.name))
+
+            print("Adding column '%s' to '%s'" % (column_obj.name, table_obj.name))
+            connection.execute("alter table %s add column %s %s%s" % (
+                _qualified_table_name(meta_data, table_obj.name), quote(column_obj.name),
+                column_obj.type.compile(dialect=connection.dialect), references_sql))
+            added_names += ["%s.%s" % (table_obj.name, column_obj.name)]
+
+    return added_names
+
+
+def add_missing_job_statuses(connection, meta_data):
+    """Insert the job statuses that are missing from an existing schema. Returns the names of the added statuses."""
+
+    table_obj = meta_data.tables[_qualified_table_name(meta_data, "job_statuses")]
+    existing_names = [r.name for r in connection.execute(table_obj.select())]
+
+    added_names = []
+    for job_status in job_statuses:
+        if job_status[1] not in existing_names:
+            print("Adding job status '%s'" % job_status[1])
+            connection.execute(table_obj.insert(job_status))
+            added_names += [job_status[1]]
+
+    return added_names
+
+
+def create_indexes(connection, meta_data, concurrently=True):
+    """Create the indexes in schema_define that are missing from an existing schema. Indexes created concurrently do
+    not block writes to the table but cannot be created inside a transaction. Returns the names of created indexes."""
+
+    schema_name = _schema_name_in_db(meta_data)
+
+    if concurrently:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+
+    defined_meta_data = schema_define(MetaData(schema=meta_data.schema))
+    quote = connection.dialect.identifier_preparer.quote
+
+    cursor = connection.execute(text("select indexname from pg_indexes where schemaname = :schema_name"),
+                                schema_name=schema_name)
+    existing_index_names = [r.indexname for r in cursor]
+
+    created_index_names = []
+    for table_obj in defined_meta_data.sorted_tables:
+        for index_obj in sorted(table_obj.indexes, key=lambda x: x.name):
+            if index_obj.name in existing_index_names:
+                continue
+
+            # Indexes on a partitioned table cannot be created concurrently
+            index_concurrently = concurrently and not is_partitioned(connection, meta_data, table_obj.name)
+
+            sql_statement = "create %sindex %sif not exists %s on %s.%s (%s)" % (
+                "unique " if index_obj.unique else "", "concurrently " if index_concurrently else "",
+                quote(index_obj.name), quote(schema_name), quote(table_obj.name),
+                ", ".join([quote(column_obj.name) for column_obj in index_obj.columns]))
+
+            print("Creating index '%s' on '%s'" % (index_obj.name, table_obj.name))
+            connection.execute(sql_statement)
+            created_index_names += [index_obj.name]
+
+    return created_index_names
+
+
 def main():
     with open("./config.json", "r") as f:
         config = json.load(f)
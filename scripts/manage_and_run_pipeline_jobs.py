@@ -13,17 +13,27 @@ except ImportError:
     sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0], os.path.pardir)))
     import data_extract_transform_score as dets
 
-from data_extract_transform_score.schema_define import create_and_populate_schema
+from data_extract_transform_score.schema_define import create_and_populate_schema, create_indexes, \
+    add_missing_tables_and_columns, add_missing_job_statuses
 from data_extract_transform_score.pipeline import Pipeline, Jobs
+from data_extract_transform_score.metrics import step_metrics_report
 
 """
 Command line program for creating, managing, and running pipelines jobs.
 """
 
 
+def create_db_engine(connection_uri):
+    """Create an engine; psycopg2 sends executemany statements with execute_values"""
+    if sa.engine.url.make_url(connection_uri).drivername in ("postgresql", "postgresql+psycopg2"):
+        return sa.create_engine(connection_uri, executemany_mode="values")
+    else:
+        return sa.create_engine(connection_uri)
+
+
 def get_db_connection(config_dict, reflect_db=True):
     """Connect to the PostgreSQL database"""
-    engine = sa.create_engine(config_dict["connection_uri"])
+    engine = create_db_engine(config_dict["connection_uri"])
     connection = engine.connect()
     meta_data = sa.MetaData(connection, schema=config_dict["db_schema"])
     meta_data.reflect()
@@ -39,13 +49,32 @@ def print_pipelines(config_dict):
     print([(r.id, r.name) for r in list_of_pipelines])
 
 
-def initialize_database_schema(config_dict, drop_all_tables=False):
+def initialize_database_schema(config_dict, drop_all_tables=False, partitioned=False):
     connection, meta_data = get_db_connection(config_dict, reflect_db=False)
 
-    meta_data, table_dict = create_and_populate_schema(connection, meta_data, drop_all=drop_all_tables)
+    meta_data, table_dict = create_and_populate_schema(connection, meta_data, drop_all=drop_all_tables,
+                                                       partitioned=partitioned)
     print("Initialized %s tables in schema '%s'" % (len(table_dict), meta_data.schema))
 
 
+def create_missing_indexes(config_dict):
+    connection, meta_data = get_db_connection(config_dict)
+    created_index_names = create_indexes(connection, meta_data, concurrently=True)
+    print("Created %s indexes in schema '%s'" % (len(created_index_names), meta_data.schema))
+
+
+def upgrade_database_schema(config_dict):
+    connection, meta_data = get_db_connection(config_dict)
+    added_names = add_missing_tables_and_columns(connection, meta_data)
+    print("Added %s tables and columns in schema '%s'" % (len(added_names), meta_data.schema))
+
+    meta_data = sa.MetaData(connection, schema=config_dict["db_schema"])
+    meta_data.reflect()
+    add_missing_job_statuses(connection, meta_data)
+    created_index_names = create_indexes(connection, meta_data, concurrently=True)
+    print("Created %s indexes in schema '%s'" % (len(created_index_names), meta_data.schema))
+
+
 def print_pipeline_steps(pipeline_name, config_dict):
     connection, meta_data = get_db_connection(config_dict)
     pipeline_obj = Pipeline(pipeline_name, connection, meta_data)
@@ -73,10 +102,44 @@ def archive_pipeline(pipeline_name, config_dict, step_numbers=None):
     connection, meta_data = get_db_connection(config_dict)
     print('Pipeline in schema: "%s"' % (meta_data.schema,))
     print("Archiving '%s'" % pipeline_name)
-    ap = dets.pipeline.ArchivePipeline(pipeline_name, connection, meta_data)
+    archive_options = {}
+    if "archive_chunk_size" in config_dict:
+        archive_options["chunk_size"] = config_dict["archive_chunk_size"]
+
+    ap = dets.pipeline.ArchivePipeline(pipeline_name, connection, meta_data, **archive_options)
     ap.archive_steps(step_list)
 
 
+def print_step_metrics_report(pipeline_name, config_dict, last_n_jobs=5):
+    connection, meta_data = get_db_connection(config_dict)
+    report = step_metrics_report(connection, meta_data, pipeline_name, last_n_jobs=last_n_jobs)
+
+    if not len(report):
+        print("No step metrics recorded for '%s'" % pipeline_name)
+        return
+
+    print("Steps of '%s' ranked by wall time in the latest of %s jobs" % (pipeline_name, report[0]["number_of_jobs"]))
+    print("%5s  %-40s %10s %10s %10s %12s %12s %10s %12s %10s %10s" %
+          ("step", "name", "wall (s)", "db (s)", "python (s)", "rows read", "rows written", "MB written",
+           "rows/sec", "peak MB", "vs median"))
+
+    for step in report:
+        if step["wall_time_ratio"] is None:
+            ratio_text = ""
+        else:
+            ratio_text = "%.2fx" % step["wall_time_ratio"]
+            if step["regressed"]:
+                ratio_text += " !"
+
+        print("%5s  %-40s %10.3f %10.3f %10.3f %12s %12s %10s %12s %10s %10s" % (
+            step["step_number"], (step["name"] or "")[:40], step["wall_time"], step["db_time"], step["python_time"],
+            "" if step["rows_read"] is None else step["rows_read"],
+            "" if step["rows_written"] is None else step["rows_written"],
+            "" if step["bytes_written"] is None else "%.1f" % (step["bytes_written"] / 1048576.0),
+            "" if step["rows_per_second"] is None else "%.1f" % step["rows_per_second"],
+            "" if step["peak_rss"] is None else "%.1f" % (step["peak_rss"] / 1048576.0), ratio_text))
+
+
 def rename_pipeline(old_pipeline_name, new_pipeline_name, config_dict):
     connection, meta_data = get_db_connection(config_dict)
     pipeline_obj = Pipeline(old_pipeline_name, connection, meta_data)
@@ -112,26 +175,42 @@ def update_pipeline_json_file(pipeline_json_filename, pipeline_name, config_dict
     load_pipeline_json_file(pipeline_json_filename, pipeline_name, config_dict)
 
 
-def run_pipeline(pipeline_name, config_dict, with_transaction_rollback=False):
-    connection, meta_data = get_db_connection(config_dict)
+def add_local_pipeline_import_path(pipeline_name, config_dict):
+    if "local_pipeline_import_path" in config_dict:
+        if pipeline_name in config_dict["local_pipeline_import_path"]:
+            sys.path.insert(0, config_dict["local_pipeline_import_path"][pipeline_name])
+
+
+def create_jobs_obj(job_name, connection, meta_data, config_dict):
 
     if "root_file_path" in config_dict:
         root_file_path = config_dict["root_file_path"]
     else:
         root_file_path = "./"
 
-    if "local_pipeline_import_path" in config_dict:
-        if pipeline_name in config_dict["local_pipeline_import_path"]:
-            sys.path.insert(0, config_dict["local_pipeline_import_path"][pipeline_name])
-
-    job_name = "Job_" + str(random.randint(1, 10000))
-
     if "external_data_connections" in config_dict:
         external_data_connections = config_dict["external_data_connections"]
     else:
         external_data_connections = {}
 
-    jobs_obj = Jobs(job_name, connection, meta_data, root_file_path, external_data_connections_dict=external_data_connections)
+    jobs_options = {}
+    for option_name in ["write_batch_size", "stream_results", "fetch_size", "max_parallel_steps", "reuse_step_results",
+                        "commit_chunk_size"]:
+        if option_name in config_dict:
+            jobs_options[option_name] = config_dict[option_name]
+
+    return Jobs(job_name, connection, meta_data, root_file_path, external_data_connections_dict=external_data_connections,
+                **jobs_options)
+
+
+def run_pipeline(pipeline_name, config_dict, with_transaction_rollback=False):
+    connection, meta_data = get_db_connection(config_dict)
+
+    add_local_pipeline_import_path(pipeline_name, config_dict)
+
+    job_name = "Job_" + str(random.randint(1, 10000))
+
+    jobs_obj = create_jobs_obj(job_name, connection, meta_data, config_dict)
     jobs_obj.create_jobs_to_run(pipeline_name)
 
     jobs_obj.run_job(with_transaction_rollback)
@@ -139,6 +218,25 @@ def run_pipeline(pipeline_name, config_dict, with_transaction_rollback=False):
     print("Ran job: '%s' against pipeline: '%s'" % (job_name, pipeline_name))
 
 
+def resume_job(job_id, config_dict):
+    """Continue a failed job from the last committed chunk of its failed step"""
+    connection, meta_data = get_db_connection(config_dict)
+
+    cursor = connection.execute(sa.text("select j.name, p.name as pipeline_name from %s.jobs j join %s.pipeline_jobs pj on pj.job_id = j.id join %s.pipelines p on p.id = pj.pipeline_id where j.id = :job_id"
+                                        % (meta_data.schema, meta_data.schema, meta_data.schema)), job_id=job_id)
+    job_rows = list(cursor)
+    if not len(job_rows):
+        raise RuntimeError("Job %s does not exist" % job_id)
+
+    for job_row in job_rows:
+        add_local_pipeline_import_path(job_row.pipeline_name, config_dict)
+
+    jobs_obj = create_jobs_obj(job_rows[0].name, connection, meta_data, config_dict)
+    jobs_obj.resume_job(job_id)
+
+    print("Resumed job: '%s'" % job_rows[0].name)
+
+
 def main():
     arg_parse_obj = argparse.ArgumentParser(description='Load, manage, and run data extraction and scoring pipelines')
     arg_parse_obj.add_argument("-c", "--config-json-filename", dest="config_json_filename",
@@ -162,6 +260,15 @@ def main():
                                dest="drop_all_tables",
                                help="Drop all tables in schema")
 
+    arg_parse_obj.add_argument("--partitioned", action="store_true", default=False, dest="partitioned",
+                               help="Initialize the database schema with data transformations partitioned by step")
+
+    arg_parse_obj.add_argument("--create-indexes", action="store_true", default=False, dest="create_indexes",
+                               help="Concurrently add missing indexes to an existing schema")
+
+    arg_parse_obj.add_argument("--upgrade-schema", action="store_true", default=False, dest="upgrade_schema",
+                               help="Add missing tables, columns and indexes to an existing schema")
+
     arg_parse_obj.add_argument("-u", "--update-pipeline", action="store_true", default=False,
                                   dest="update_pipeline",
                                   help="Update an existing name pipeline"
@@ -177,6 +284,15 @@ def main():
 
     arg_parse_obj.add_argument("-r", "--run-pipeline", action="store_true", help="Run pipeline")
 
+    arg_parse_obj.add_argument("--resume-job", default=None, type=int, dest="resume_job_id",
+                               help="Continue a failed job from the last committed chunk of its failed step")
+
+    arg_parse_obj.add_argument("--report", action="store_true", default=False, dest="report",
+                               help="Rank the steps of a pipeline by wall time and mark regressions (!) against earlier jobs")
+
+    arg_parse_obj.add_argument("--last-n-jobs", default=5, type=int, dest="last_n_jobs",
+                               help="Number of the pipeline's last jobs in the report")
+
     arg_obj = arg_parse_obj.parse_args()
 
     config_json_filename = arg_obj.config_json_filename
@@ -192,15 +308,31 @@ def main():
         return True
     
     if arg_obj.initialize_database_schema:
-        initialize_database_schema(config_dict, arg_obj.drop_all_tables)
+        initialize_database_schema(config_dict, arg_obj.drop_all_tables, arg_obj.partitioned)
         return True
 
-    if arg_obj.list_pipeline_steps or arg_obj.run_pipeline or arg_obj.pipeline_json_filename or arg_obj.archive_pipeline:
+    if arg_obj.create_indexes:
+        create_missing_indexes(config_dict)
+        return True
+
+    if arg_obj.upgrade_schema:
+        upgrade_database_schema(config_dict)
+        return True
+
+    if arg_obj.resume_job_id is not None:
+        resume_job(arg_obj.resume_job_id, config_dict)
+        return True
+
+    if arg_obj.list_pipeline_steps or arg_obj.run_pipeline or arg_obj.pipeline_json_filename or arg_obj.archive_pipeline \
+            or arg_obj.report:
         pipeline_name = arg_obj.pipeline_name
         if pipeline_name:
             if arg_obj.list_pipeline_steps:
                 print_pipeline_steps(pipeline_name, config_dict)
                 return True
+            elif arg_obj.report:
+                print_step_metrics_report(pipeline_name, config_dict, arg_obj.last_n_jobs)
+                return True
             elif arg_obj.pipeline_json_filename:
                 pipeline_json_filename = arg_obj.pipeline_json_filename
                 if arg_obj.update_pipeline:
@@ -1,11 +1,15 @@
 from data_extract_transform_score import models
 from math import exp
+import numpy as np
 
 
 class LogLinearRegressionModel(models.GeneralizedLinearModel):
     def _compute_score_using_model(self, coefficients):
         return exp(sum(coefficients))
 
+    def _compute_scores_using_model(self, linear_predictors):
+        return np.exp(linear_predictors)
+
 
 # Add new models here
 LOCAL_MODELS_TO_REGISTER = [("Log-linear regression", LogLinearRegressionModel)]
@@ -5,6 +5,7 @@ from data_extract_transform_score.models import LogisticRegressionModel
 
 from flask import Flask, request
 from flask_restful import Resource, Api
+from werkzeug.serving import WSGIRequestHandler
 
 app = Flask(__name__)
 api = Api(app)
@@ -19,7 +20,18 @@ class TestLogisticRegressionModelRest(Resource):
 
         return list(lrm_score)
 
+
+class TestLogisticRegressionModelBatchRest(Resource):
+
+    def post(self):
+        input_dicts = request.get_json()
+        lrm = LogisticRegressionModel({"intercept": -5.0, "X": 2.0, "Y": 1.5})
+
+        return [list(lrm_score) for lrm_score in lrm.score_batch(input_dicts)]
+
 api.add_resource(TestLogisticRegressionModelRest, '/logistic_regression/')
+api.add_resource(TestLogisticRegressionModelBatchRest, '/logistic_regression/batch/')
 
 if __name__ == '__main__':
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"  # Keep connections alive between requests
     app.run(debug=True)
\ No newline at end of file
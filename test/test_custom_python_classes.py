@@ -24,6 +24,10 @@ class TestUpdateWithCustomClasses(unittest.TestCase):
         if os.path.exists("./test_output.json"):
             os.remove("./test_output.json")
 
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
     def test_create_and_run_custom_job(self):
 
         with open("./test_pipeline_build_custom.json") as f:
@@ -69,7 +73,116 @@ class TestUpdateWithCustomClasses(unittest.TestCase):
 
         self.assertEqual(len(output1), len(output2))
 
-    def test_and_run_pipeline_with_load_from_db(self):
+    def test_and_run_custom_job_with_worker_processes(self):
+
+        with open("./test_pipeline_build_custom.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_name = "test custom pipeline"
+        sys.path.insert(0, self.config["local_pipeline_import_path"][pipeline_name])
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj1 = pipeline.Jobs("Test custom job", self.connection, self.meta_data)
+        jobs_obj1.create_jobs_to_run(pipeline_name)
+        jobs_obj1.run_job()
+
+        with open("test_output_custom.json", "r") as f:
+            output1 = json.load(f)
+
+        for step in pipeline_structure:
+            if step["data_transformation_class"] == "Transform with function":
+                step["parameters"]["workers"] = 2
+                step["parameters"]["chunk_size"] = 1
+
+        pipeline_name = "test custom pipeline with worker processes"
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj2 = pipeline.Jobs("Test custom job with worker processes", self.connection, self.meta_data)
+        jobs_obj2.create_jobs_to_run(pipeline_name)
+        jobs_obj2.run_job()
+
+        with open("test_output_custom.json", "r") as f:
+            output2 = json.load(f)
+
+        self.assertEqual(output1, output2)
+
+    def test_and_run_custom_job_with_mapping_on_server(self):
+
+        with open("./test_pipeline_build_custom.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_name = "test custom pipeline"
+        sys.path.insert(0, self.config["local_pipeline_import_path"][pipeline_name])
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj1 = pipeline.Jobs("Test custom job", self.connection, self.meta_data)
+        jobs_obj1.create_jobs_to_run(pipeline_name)
+        jobs_obj1.run_job()
+
+        with open("test_output_custom.json", "r") as f:
+            output1 = json.load(f)
+
+        for step in pipeline_structure:
+            if step["data_transformation_class"] == "Map with Dict":
+                step["parameters"]["execution_mode"] = "server"
+
+        pipeline_name = "test custom pipeline with mapping on server"
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj2 = pipeline.Jobs("Test custom job with mapping on server", self.connection, self.meta_data)
+        jobs_obj2.create_jobs_to_run(pipeline_name)
+        jobs_obj2.run_job()
+
+        with open("test_output_custom.json", "r") as f:
+            output2 = json.load(f)
+
+        self.assertEqual(output1, output2)
+
+    def test_and_run_custom_job_with_indicators_on_client(self):
+
+        with open("./test_pipeline_build_custom.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_name = "test custom pipeline"
+        sys.path.insert(0, self.config["local_pipeline_import_path"][pipeline_name])
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj1 = pipeline.Jobs("Test custom job", self.connection, self.meta_data)
+        jobs_obj1.create_jobs_to_run(pipeline_name)
+        jobs_obj1.run_job()
+
+        with open("test_output_custom.json", "r") as f:
+            output1 = json.load(f)
+
+        for step in pipeline_structure:
+            if step["data_transformation_class"] == "Transform indicator list to dict":
+                step["parameters"]["execution_mode"] = "client"
+
+        pipeline_name = "test custom pipeline with indicators on client"
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj2 = pipeline.Jobs("Test custom job with indicators on client", self.connection, self.meta_data)
+        jobs_obj2.create_jobs_to_run(pipeline_name)
+        jobs_obj2.run_job()
+
+        with open("test_output_custom.json", "r") as f:
+            output2 = json.load(f)
+
+        self.assertEqual(output1, output2)
+
+    def _create_sqlite_test_db(self):
 
         sqlite_file_name = os.path.join(os.path.curdir, "files", "test.db3")
 
@@ -118,6 +231,10 @@ class TestUpdateWithCustomClasses(unittest.TestCase):
 
         connection.close()
 
+    def test_and_run_pipeline_with_load_from_db(self):
+
+        self._create_sqlite_test_db()
+
         with open("./test_pipeline_build_from_db.json") as f:
             pipeline_structure = json.load(f)
 
@@ -138,6 +255,105 @@ class TestUpdateWithCustomClasses(unittest.TestCase):
 
         self.assertEqual(2, len(output))
 
+        # The engine of the external data connection is kept for the next job
+        external_engine = pipeline.external_db_engines.engines_dict["test_sqlite"]
+
+        jobs_obj = pipeline.Jobs("Test custom job", self.connection, self.meta_data,
+                                 external_data_connections_dict=self.config["external_data_connections"])
+        jobs_obj.create_jobs_to_run("test loading from db")
+        jobs_obj.run_job()
+
+        self.assertIs(external_engine, pipeline.external_db_engines.engines_dict["test_sqlite"])
+
+    def test_and_run_pipeline_with_load_from_db_by_batches_of_ids(self):
+
+        self._create_sqlite_test_db()
+
+        with open("./test_pipeline_build_from_db.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_structure[1]["parameters"]["sql_query"] = "select * from test_summary_dx_list where eid in :common_ids"
+        pipeline_structure[1]["parameters"]["batch_size"] = 100
+        pipeline_structure[1]["parameters"]["common_id_field_name"] = "eid"
+        pipeline_structure[1]["parameters"]["expand_common_ids"] = True
+
+        pipeline_name = "test loading from db"
+        sys.path.insert(0, self.config["local_pipeline_import_path"][pipeline_name])
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test custom job", self.connection, self.meta_data,
+                                 external_data_connections_dict=self.config["external_data_connections"])
+        jobs_obj.create_jobs_to_run("test loading from db")
+
+        jobs_obj.run_job()
+
+        cursor = self.connection.execute("""select dt.common_id, dt.data, dt.meta from %s.data_transformations dt
+          join %s.pipeline_jobs_data_transformation_steps pjdts on pjdts.id = dt.pipeline_job_data_transformation_step_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          where dts.step_number = 2 order by dt.id""" % ((self.meta_data.schema,) * 3))
+        dx_rows = list(cursor)
+
+        self.assertEqual(3, len(dx_rows))
+        self.assertEqual(["1000", "1000", "1000"], [r.common_id for r in dx_rows])
+        self.assertEqual([1, 2, 3], [r.meta["row"] for r in dx_rows])
+        self.assertEqual("N10", dx_rows[0].data["code"])
+
+    def test_resume_failed_job_from_checkpoint(self):
+
+        self._create_sqlite_test_db()
+
+        sqlite_engine = sa.create_engine("sqlite:///./files/test.db3")
+        sqlite_connection = sqlite_engine.connect()
+        sqlite_connection.execute("INSERT INTO test_summary_dx_list (eid,seq_id,poa,code) VALUES (2000,1,'1','N11')")
+        sqlite_connection.close()
+
+        with open("./test_pipeline_build_from_db.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_name = "test loading from db"
+        sys.path.insert(0, self.config["local_pipeline_import_path"][pipeline_name])
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        # The query by id fails for the second common id after the first chunk is committed
+        execute_external_query = pipeline.ReadDataFromExternalDBQueryById._execute_external_query
+        queried_common_ids = []
+
+        def failing_execute_external_query(read_obj, external_connection, query_string, parameter_dict={},
+                                           expanding_parameters=None):
+            queried_common_ids.append(parameter_dict["common_id"])
+            if len(queried_common_ids) == 2:
+                raise RuntimeError("Query failed")
+            return execute_external_query(read_obj, external_connection, query_string, parameter_dict,
+                                          expanding_parameters)
+
+        jobs_obj = pipeline.Jobs("Test custom job", self.connection, self.meta_data, commit_chunk_size=1,
+                                 external_data_connections_dict=self.config["external_data_connections"])
+        jobs_obj.create_jobs_to_run(pipeline_name)
+
+        pipeline.ReadDataFromExternalDBQueryById._execute_external_query = failing_execute_external_query
+        try:
+            self.assertRaises(RuntimeError, jobs_obj.run_job)
+        finally:
+            pipeline.ReadDataFromExternalDBQueryById._execute_external_query = execute_external_query
+
+        resume_jobs_obj = pipeline.Jobs("Test custom job", self.connection, self.meta_data, commit_chunk_size=1,
+                                        external_data_connections_dict=self.config["external_data_connections"])
+        resume_jobs_obj.resume_job(jobs_obj.job_id)
+
+        cursor = self.connection.execute("""select dt.common_id, dt.meta from %s.data_transformations dt
+          join %s.pipeline_jobs_data_transformation_steps pjdts on pjdts.id = dt.pipeline_job_data_transformation_step_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          where dts.step_number = 2 order by dt.id""" % ((self.meta_data.schema,) * 3))
+        dx_rows = list(cursor)
+
+        # Rows read after resuming are numbered after the rows committed before the failure
+        self.assertEqual(["1000", "1000", "1000", "2000"], [r.common_id for r in dx_rows])
+        self.assertEqual([1, 2, 3, 4], [r.meta["row"] for r in dx_rows])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,149 @@
+import unittest
+import collections
+import decimal
+import data_transformations
+
+
+class TestRecordTransformations(unittest.TestCase):
+
+    def setUp(self):
+        self.record = {"eid": "1000", "dx_list": [{"code": "N10"}, {"code": "E119"}, {"code": "N11"}, {"poa": "1"}]}
+        self.mapping_rules = {"N10": "X", "N11": ["Y", "Z"], "E119": 1}
+
+    def test_map_data(self):
+
+        map_obj = data_transformations.MapDataWithDict(["dx_list", "code"], 4, mapping_rules=self.mapping_rules)
+        data, meta = map_obj.map_data(self.record)
+
+        self.assertEqual(["X", "Y", "Z"], data)
+        self.assertEqual([{"N10": "X"}, {"N11": ["Y", "Z"]}], meta)
+
+        map_obj = data_transformations.MapDataWithDict(["dx_list", "code"], 4, mapping_rules=self.mapping_rules,
+                                                       field_name="mapped")
+        data, meta = map_obj.map_data(self.record)
+        self.assertEqual({"mapped": ["X", "Y", "Z"]}, data)
+
+    def test_map_data_without_fields(self):
+
+        map_obj = data_transformations.MapDataWithDict(["dx_list", "code"], 4, mapping_rules=self.mapping_rules)
+
+        self.assertIsNone(map_obj.map_data({"eid": "1000"}))
+        self.assertEqual(([], []), map_obj.map_data({"dx_list": {"poa": "1"}}))
+
+    def test_indicator_dict(self):
+
+        self.assertEqual({"X": 1.0, "Y": 1.0}, data_transformations.TransformIndicatorListToDict.indicator_dict(["X", "Y", "X"]))
+        self.assertEqual({}, data_transformations.TransformIndicatorListToDict.indicator_dict([]))
+
+    def test_score_records(self):
+
+        score_obj = data_transformations.ScoreData(6, "Logistic regression", {"intercept": -5.0, "X": 2.0, "Y": 1.5})
+        scored_list = score_obj.score_records([{"X": 1.0, "Y": 1.0}, {}], ["1000", "2000"])
+
+        self.assertEqual(2, len(scored_list))
+        self.assertAlmostEqual(0.18242552380635635, scored_list[0][0])
+
+    def test_code_fingerprint(self):
+
+        score_obj = data_transformations.ScoreData(6, "Logistic regression", {"intercept": -5.0, "X": 2.0})
+        map_obj = data_transformations.MapDataWithDict(["dx_list", "code"], 4, mapping_rules=self.mapping_rules)
+
+        self.assertIsNotNone(score_obj.code_fingerprint())
+        self.assertNotEqual(map_obj.code_fingerprint(), score_obj.code_fingerprint())  # Includes the source of models
+
+        # A function in this module changes the fingerprint and a function without source can not be fingerprinted
+        self.assertNotEqual(data_transformations.source_fingerprint([data_transformations.MapDataWithDict]),
+                            data_transformations.source_fingerprint([data_transformations.MapDataWithDict, lambda x: x]))
+        self.assertIsNone(data_transformations.source_fingerprint([data_transformations.MapDataWithDict, len]))
+
+
+class TestReadDataFromExternalDBQueryById(unittest.TestCase):
+
+    def test_common_id_key(self):
+
+        self.assertEqual("1000", data_transformations._common_id_key(1000))
+        self.assertEqual("1000", data_transformations._common_id_key(decimal.Decimal("1000")))
+        self.assertEqual("1000", data_transformations._common_id_key(1000.0))
+        self.assertEqual("1000.5", data_transformations._common_id_key(1000.5))
+        self.assertEqual("1000", data_transformations._common_id_key("1000    "))
+        self.assertEqual("nan", data_transformations._common_id_key(float("nan")))
+
+    def test_query_by_batches_of_common_ids(self):
+
+        read_obj = data_transformations.ReadDataFromExternalDBQueryById(
+            "external", "select * from dx where eid = ANY(CAST(:common_ids AS int[]))", 1, batch_size=10,
+            common_id_field_name="eid")
+
+        external_rows = [{"eid": 1000, "code": "N10"}, {"eid": decimal.Decimal("2000"), "code": "N11"},
+                         {"eid": "3000  ", "code": "E119"}, {"eid": 1000, "code": "N12"}, {"eid": 9999, "code": "X"}]
+
+        queried_parameters = []
+
+        def execute_external_query(external_connection, query_string, parameter_dict={}, expanding_parameters=None):
+            queried_parameters.append(parameter_dict)
+            return external_rows
+
+        written_rows = []
+
+        def write_data(data, common_id, meta=None):
+            written_rows.append((common_id, data["code"], meta["row"]))
+
+        read_obj._execute_external_query = execute_external_query
+        read_obj._write_data = write_data
+        read_obj.row_number = 1
+
+        Row = collections.namedtuple("Row", ["common_id"])
+        row_proxy = data_transformations.FetchedRows([Row("1000"), Row("2000"), Row("3000"), Row("1000")])
+        read_obj._query_by_batches_of_common_ids(None, row_proxy)
+
+        self.assertEqual([{"common_ids": ["1000", "2000", "3000"]}], queried_parameters)
+        self.assertEqual([("1000", "N10", 1), ("1000", "N12", 2), ("2000", "N11", 3), ("3000", "E119", 4),
+                          ("1000", "N10", 5), ("1000", "N12", 6)], written_rows)
+        self.assertEqual(1, read_obj.rows_not_matched)
+
+
+class TestExternalDBEngines(unittest.TestCase):
+
+    def setUp(self):
+        self.external_db_engines = data_transformations.ExternalDBEngines()
+        self.data_connection_dict = {"connection_string": "postgresql://localhost/external_db", "pool_size": 3}
+
+    def tearDown(self):
+        self.external_db_engines.dispose_all()
+
+    def test_get_engine(self):
+
+        engine = self.external_db_engines.get_engine("external", self.data_connection_dict)
+        self.assertEqual(3, engine.pool.size())
+        self.assertTrue(engine.pool._pre_ping)
+
+        self.assertIs(engine, self.external_db_engines.get_engine("external", dict(self.data_connection_dict)))
+
+        other_engine = self.external_db_engines.get_engine("other", self.data_connection_dict)
+        self.assertIsNot(engine, other_engine)
+
+    def test_get_engine_after_connection_string_changes(self):
+
+        engine = self.external_db_engines.get_engine("external", self.data_connection_dict)
+        pool = engine.pool
+
+        changed_engine = self.external_db_engines.get_engine(
+            "external", {"connection_string": "postgresql://localhost/changed_db"})
+
+        self.assertIsNot(engine, changed_engine)
+        self.assertEqual("changed_db", changed_engine.url.database)
+        self.assertIsNot(pool, engine.pool)  # Disposing of an engine replaces its pool
+
+    def test_dispose_all(self):
+
+        engine = self.external_db_engines.get_engine("external", self.data_connection_dict)
+        pool = engine.pool
+
+        self.external_db_engines.dispose_all()
+
+        self.assertIsNot(pool, engine.pool)
+        self.assertIsNot(engine, self.external_db_engines.get_engine("external", self.data_connection_dict))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,11 @@
 import unittest
 import pipeline
+import metrics
 import schema_define
 import json
 import sqlalchemy as sa
 import os
+import time
 
 
 class TestLoadPipeline(unittest.TestCase):
@@ -17,11 +19,15 @@ class TestLoadPipeline(unittest.TestCase):
             self.connection = self.engine.connect()
             self.meta_data = sa.MetaData(self.connection, schema=config["db_schema"])
 
-        schema_define.create_and_populate_schema(self.connection, self.meta_data)
+        self.meta_data, table_dict = schema_define.create_and_populate_schema(self.connection, self.meta_data)
 
         if os.path.exists("./test_output.json"):
             os.remove("./test_output.json")
 
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
     def test_load_pipeline(self):
 
         with open("./test_pipeline_build.json") as f:
@@ -41,6 +47,33 @@ class TestLoadPipeline(unittest.TestCase):
 
         self.assertTrue(len(list_of_data_trans_steps))
 
+    def test_create_indexes(self):
+
+        schema = self.meta_data.schema
+        self.connection.execute("drop index %s.idx_dt_pjdts_common_id" % schema)
+
+        created_index_names = schema_define.create_indexes(self.connection, self.meta_data, concurrently=False)
+        self.assertEquals(["idx_dt_pjdts_common_id"], created_index_names)
+
+        cursor = self.connection.execute("select indexname from pg_indexes where schemaname = '%s'" % schema)
+        self.assertIn("idx_dt_pjdts_common_id", [r.indexname for r in cursor])
+
+        self.assertEquals([], schema_define.create_indexes(self.connection, self.meta_data, concurrently=False))
+
+    def test_add_missing_tables_and_columns(self):
+
+        schema = self.meta_data.schema
+        self.connection.execute("drop table %s.data_transformation_step_metrics" % schema)
+        self.connection.execute("alter table %s.pipeline_jobs_data_transformation_steps drop column fingerprint" % schema)
+
+        added_names = schema_define.add_missing_tables_and_columns(self.connection, self.meta_data)
+        self.assertEquals(["pipeline_jobs_data_transformation_steps.fingerprint", "data_transformation_step_metrics"],
+                          added_names)
+
+        self.assertEquals(["idx_pjdts_fingerprint"],
+                          schema_define.create_indexes(self.connection, self.meta_data, concurrently=False))
+        self.assertEquals([], schema_define.add_missing_tables_and_columns(self.connection, self.meta_data))
+
     def test_create_and_run_jobs(self):
 
         with open("./test_pipeline_build.json") as f:
@@ -59,6 +92,391 @@ class TestLoadPipeline(unittest.TestCase):
 
         self.assertEquals(2, len(pipeline_results))
 
+    def test_create_and_run_jobs_with_bulk_load(self):
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        for step in pipeline_structure:
+            if step["data_transformation_class"] == "Load file":
+                step["parameters"]["bulk_load"] = True
+
+        pipeline_obj = pipeline.Pipeline("test bulk load pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test bulk load job", self.connection, self.meta_data)
+        jobs_obj.create_jobs_to_run("test bulk load pipeline")
+
+        jobs_obj.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results = json.load(f)
+
+        self.assertEquals(2, len(pipeline_results))
+
+        cursor = self.connection.execute("select meta from %s.data_transformations order by id limit 1" % (self.meta_data.schema,))
+        self.assertEquals({"row": 1}, list(cursor)[0].meta)
+
+    def test_create_and_run_jobs_with_parallel_steps(self):
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test parallel job", self.connection, self.meta_data, max_parallel_steps=3)
+        jobs_obj.create_jobs_to_run("test pipeline")
+
+        jobs_obj.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results = json.load(f)
+
+        self.assertEquals(2, len(pipeline_results))
+
+        cursor = self.connection.execute("""select js.name, pjdts.end_date_time from %s.pipeline_jobs_data_transformation_steps pjdts
+          join %s.job_statuses js on js.id = pjdts.job_status_id""" % ((self.meta_data.schema,) * 2))
+        step_statuses = list(cursor)
+
+        self.assertEquals(len(pipeline_structure), len(step_statuses))
+        self.assertEquals(["Finished"] * len(pipeline_structure), [r.name for r in step_statuses])
+
+    def test_steps_which_do_not_start_after_a_parallel_step_fails_are_marked_failed(self):
+
+        schema = self.meta_data.schema
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_structure[4]["parameters"]["unknown_parameter"] = True
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test parallel job", self.connection, self.meta_data, max_parallel_steps=3)
+        jobs_obj.create_jobs_to_run("test pipeline")
+        self.assertRaises(TypeError, jobs_obj.run_job)
+
+        steps = list(self.connection.execute("""select dts.step_number, js.name as status, pjdts.is_active
+            from %s.pipeline_jobs_data_transformation_steps pjdts
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          join %s.job_statuses js on js.id = pjdts.job_status_id
+          order by dts.step_number""" % (schema, schema, schema)))
+
+        self.assertEquals(list(range(1, 10)), [r.step_number for r in steps])
+        self.assertEquals(["Finished"] * 4 + ["Failed"] * 5, [r.status for r in steps])
+        self.assertEquals([False] * 9, [r.is_active for r in steps])
+
+    def test_rows_written_by_a_step_without_flushing_are_inserted(self):
+
+        class WriteWithoutFlushing(pipeline.ServerClientServerDataTransformation):
+            def __init__(self, step_number):
+                self.step_number = step_number
+
+            def run(self):
+                for row_obj in self._get_data_transformation_step_proxy(self.step_number):
+                    self._write_data(row_obj.data, row_obj.common_id)
+
+        pipeline_structure = [
+            {"step_number": 1, "data_transformation_class": "Load file", "name": "Load main file",
+             "parameters": {"file_name": "test_summary_file.csv", "file_type": "csv", "common_id_field_name": "eid"}},
+            {"step_number": 2, "data_transformation_class": "Write without flushing", "name": "Copy rows",
+             "parameters": {"step_number": 1}}]
+
+        # Reference rows are populated with ids so the class is inserted with an id
+        self.connection.execute("insert into %s.data_transformation_step_classes (id, name) values (1000, 'Write without flushing')"
+                                % (self.meta_data.schema,))
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test job", self.connection, self.meta_data)
+        jobs_obj.data_trans_step_classes_obj._register("Write without flushing", WriteWithoutFlushing)
+        jobs_obj.create_jobs_to_run("test pipeline")
+        jobs_obj.run_job()
+
+        cursor = self.connection.execute("""select dts.step_number, count(*) as number_of_rows from %s.data_transformations dt
+          join %s.pipeline_jobs_data_transformation_steps pjdts on pjdts.id = dt.pipeline_job_data_transformation_step_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          group by dts.step_number order by dts.step_number""" % ((self.meta_data.schema,) * 3))
+        self.assertEquals([(1, 2), (2, 2)], [(r.step_number, r.number_of_rows) for r in cursor])
+
+    def test_run_job_reads_reference_tables_once(self):
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test job", self.connection, self.meta_data)
+        jobs_obj.create_jobs_to_run("test pipeline")
+
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        sa.event.listen(self.engine, "before_cursor_execute", record_statement)
+        try:
+            jobs_obj.run_job()
+        finally:
+            sa.event.remove(self.engine, "before_cursor_execute", record_statement)
+
+        def count_reads(table_name):
+            return len([s for s in statements if s.startswith("SELECT") and "FROM %s.%s" % (self.meta_data.schema, table_name) in s])
+
+        self.assertEquals(1, count_reads("data_transformation_step_classes"))
+        self.assertEquals(1, count_reads("data_transformation_steps"))
+        self.assertEquals(3, count_reads("job_statuses"))
+        self.assertEquals(1, count_reads("pipelines"))
+
+    def test_step_timer_db_calls(self):
+
+        step_timer = metrics.StepTimer(self.connection)
+        step_timer.start()
+
+        # A statement executed inside a db_call is counted once
+        with step_timer.db_call():
+            self.connection.execute("select pg_sleep(0.2)")
+
+        # Time spent in Python callbacks of a db_call is not counted
+        with step_timer.db_call(lambda: 0.1):
+            time.sleep(0.15)
+
+        step_timer.stop()
+
+        self.assertTrue(0.25 <= step_timer.db_time < 0.4)
+        self.assertTrue(step_timer.db_time <= step_timer.wall_time)
+
+    def test_step_metrics_report(self):
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        for job_name in ["Test job 1", "Test job 2"]:
+            jobs_obj = pipeline.Jobs(job_name, self.connection, self.meta_data)
+            jobs_obj.create_jobs_to_run("test pipeline")
+            jobs_obj.run_job()
+
+        cursor = self.connection.execute("select * from %s.data_transformation_step_metrics" % (self.meta_data.schema,))
+        self.assertEquals(2 * len(pipeline_structure), len(list(cursor)))
+
+        report = metrics.step_metrics_report(self.connection, self.meta_data, "test pipeline", last_n_jobs=2)
+        self.assertEquals(len(pipeline_structure), len(report))
+
+        wall_times = [step["wall_time"] for step in report]
+        self.assertEquals(sorted(wall_times, reverse=True), wall_times)
+
+        steps_dict = dict([(step["step_number"], step) for step in report])
+        self.assertEquals(2, steps_dict[1]["number_of_jobs"])
+        self.assertEquals(steps_dict[1]["rows_written"], steps_dict[1]["rows_read"])
+        self.assertEquals(steps_dict[2]["rows_written"], steps_dict[3]["rows_read"])
+        self.assertTrue(steps_dict[4]["bytes_written"] > 0)
+        self.assertEquals(0, steps_dict[9]["rows_written"])
+        self.assertTrue(steps_dict[1]["peak_rss"] > 0)
+
+        # Rows and bytes are counted as they are written
+        cursor = self.connection.execute("""select m.rows_written, m.bytes_written, count(dt.id) as number_of_rows,
+            coalesce(sum(pg_column_size(dt.data) + coalesce(pg_column_size(dt.meta), 0)), 0) as number_of_bytes
+          from %s.data_transformation_step_metrics m
+            left outer join %s.data_transformations dt
+              on dt.pipeline_job_data_transformation_step_id = m.pipeline_job_data_transformation_step_id
+          group by m.id, m.rows_written, m.bytes_written""" % ((self.meta_data.schema,) * 2))
+        for metric_row in cursor:
+            self.assertEquals(metric_row.number_of_rows, metric_row.rows_written)
+            self.assertEquals(metric_row.number_of_bytes, metric_row.bytes_written)
+
+    def test_reuse_step_results(self):
+
+        schema = self.meta_data.schema
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj_1 = pipeline.Jobs("Test job 1", self.connection, self.meta_data, reuse_step_results=True)
+        jobs_obj_1.create_jobs_to_run("test pipeline")
+        jobs_obj_1.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results_1 = json.load(f)
+
+        num_dts_1 = len(list(self.connection.execute("select * from %s.data_transformations" % (schema,))))
+
+        jobs_obj_2 = pipeline.Jobs("Test job 2", self.connection, self.meta_data, reuse_step_results=True)
+        jobs_obj_2.create_jobs_to_run("test pipeline")
+        jobs_obj_2.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results_2 = json.load(f)
+
+        num_dts_2 = len(list(self.connection.execute("select * from %s.data_transformations" % (schema,))))
+
+        self.assertEquals(pipeline_results_1, pipeline_results_2)
+        self.assertEquals(num_dts_1, num_dts_2)
+
+        reused_query_string = """select dts.step_number from %s.pipeline_jobs_data_transformation_steps pjdts
+          join %s.pipeline_jobs pj on pj.id = pjdts.pipeline_job_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          where pj.job_id = %%s and pjdts.reused_pipeline_job_data_transformation_step_id is not null
+          order by dts.step_number""" % (schema, schema, schema)
+
+        reused_step_numbers = [r.step_number for r in self.connection.execute(reused_query_string % jobs_obj_2.job_id)]
+        self.assertEquals([1, 2, 3, 4, 5, 6, 7, 8], reused_step_numbers)
+
+        # Changing the model reruns the score and the steps after it
+        pipeline_structure[6]["parameters"]["model_parameters"]["X"] = 1.0
+
+        pipeline_obj = pipeline.Pipeline("test edited pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj_3 = pipeline.Jobs("Test job 3", self.connection, self.meta_data, reuse_step_results=True)
+        jobs_obj_3.create_jobs_to_run("test edited pipeline")
+        jobs_obj_3.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results_3 = json.load(f)
+
+        self.assertEquals(2, len(pipeline_results_3))
+        self.assertNotEqual(pipeline_results_1, pipeline_results_3)
+
+        reused_step_numbers = [r.step_number for r in self.connection.execute(reused_query_string % jobs_obj_3.job_id)]
+        self.assertEquals([1, 2, 3, 4, 5, 6], reused_step_numbers)
+
+        # Outputs reused by the job of the edited pipeline are kept when the first pipeline is archived
+        ap_obj = pipeline.ArchivePipeline("test pipeline", self.connection, self.meta_data)
+        ap_obj.archive_steps()
+
+        cursor = self.connection.execute("""select distinct pj.job_id from %s.data_transformations dt
+          join %s.pipeline_jobs_data_transformation_steps pjdts on pjdts.id = dt.pipeline_job_data_transformation_step_id
+          join %s.pipeline_jobs pj on pj.id = pjdts.pipeline_job_id order by pj.job_id""" % (schema, schema, schema))
+        self.assertEquals([jobs_obj_1.job_id, jobs_obj_3.job_id], [r.job_id for r in cursor])
+
+    def test_resume_failed_job_from_checkpoint(self):
+
+        schema = self.meta_data.schema
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj_1 = pipeline.Jobs("Test job 1", self.connection, self.meta_data)
+        jobs_obj_1.create_jobs_to_run("test pipeline")
+        jobs_obj_1.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results_1 = json.load(f)
+        os.remove("./test_output.json")
+
+        # The mapping step fails on its second row after committing its first chunk
+        map_data = pipeline.MapDataWithDict.map_data
+        mapped_rows = []
+
+        def failing_map_data(map_obj, result_data):
+            mapped_rows.append(result_data)
+            if len(mapped_rows) == 2:
+                raise RuntimeError("Mapping failed")
+            return map_data(map_obj, result_data)
+
+        jobs_obj_2 = pipeline.Jobs("Test job 2", self.connection, self.meta_data, commit_chunk_size=1)
+        jobs_obj_2.create_jobs_to_run("test pipeline")
+
+        pipeline.MapDataWithDict.map_data = failing_map_data
+        try:
+            self.assertRaises(RuntimeError, jobs_obj_2.run_job)
+        finally:
+            pipeline.MapDataWithDict.map_data = map_data
+
+        steps_query_string = """select dts.step_number, js.name as status, pjdts.checkpoint_id,
+          (select count(*) from %s.data_transformations dt where dt.pipeline_job_data_transformation_step_id = pjdts.id) as number_of_rows
+            from %s.pipeline_jobs_data_transformation_steps pjdts
+          join %s.pipeline_jobs pj on pj.id = pjdts.pipeline_job_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          join %s.job_statuses js on js.id = pjdts.job_status_id
+          where pj.job_id = %%s order by dts.step_number""" % (schema, schema, schema, schema, schema)
+
+        steps = list(self.connection.execute(steps_query_string % jobs_obj_2.job_id))
+        self.assertEquals([1, 2, 3, 4, 5], [r.step_number for r in steps])
+        self.assertEquals("Failed", steps[4].status)
+        self.assertIsNotNone(steps[4].checkpoint_id)
+        self.assertEquals(1, steps[4].number_of_rows)
+
+        committed_rows_query_string = """select dt.id from %s.data_transformations dt
+          join %s.pipeline_jobs_data_transformation_steps pjdts on pjdts.id = dt.pipeline_job_data_transformation_step_id
+          join %s.pipeline_jobs pj on pj.id = pjdts.pipeline_job_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          where pj.job_id = %s and dts.step_number = 5 order by dt.id""" % (schema, schema, schema, schema, jobs_obj_2.job_id)
+        committed_row_ids = [r.id for r in self.connection.execute(committed_rows_query_string)]
+
+        job_status = list(self.connection.execute("""select js.name from %s.jobs j join %s.job_statuses js
+          on js.id = j.job_status_id where j.id = %s""" % (schema, schema, jobs_obj_2.job_id)))[0].name
+        self.assertEquals("Failed", job_status)
+
+        jobs_obj_3 = pipeline.Jobs("Test job 2", self.connection, self.meta_data, commit_chunk_size=1)
+        jobs_obj_3.resume_job(jobs_obj_2.job_id)
+
+        with open("./test_output.json") as f:
+            pipeline_results_2 = json.load(f)
+
+        self.assertEquals(pipeline_results_1, pipeline_results_2)
+
+        steps = list(self.connection.execute(steps_query_string % jobs_obj_2.job_id))
+        self.assertEquals(list(range(1, 10)), [r.step_number for r in steps])
+        self.assertEquals(["Finished"] * 9, [r.status for r in steps])
+
+        steps_1 = list(self.connection.execute(steps_query_string % jobs_obj_1.job_id))
+        self.assertEquals([r.number_of_rows for r in steps_1], [r.number_of_rows for r in steps])
+
+        # The row committed before the failure is kept rather than mapped again
+        self.assertEquals(committed_row_ids, [r.id for r in self.connection.execute(committed_rows_query_string)][:1])
+
+        self.assertRaises(RuntimeError, jobs_obj_3.resume_job, jobs_obj_2.job_id)
+
+    def test_step_which_can_not_be_created_is_marked_failed(self):
+
+        schema = self.meta_data.schema
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_structure[4]["parameters"]["unknown_parameter"] = True
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test job", self.connection, self.meta_data)
+        jobs_obj.create_jobs_to_run("test pipeline")
+        self.assertRaises(TypeError, jobs_obj.run_job)
+
+        steps = list(self.connection.execute("""select dts.step_number, js.name as status, pjdts.is_active
+            from %s.pipeline_jobs_data_transformation_steps pjdts
+          join %s.pipeline_jobs pj on pj.id = pjdts.pipeline_job_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          join %s.job_statuses js on js.id = pjdts.job_status_id
+          where pj.job_id = %s order by dts.step_number""" % (schema, schema, schema, schema, jobs_obj.job_id)))
+
+        self.assertEquals([1, 2, 3, 4, 5], [r.step_number for r in steps])
+        self.assertEquals("Failed", steps[4].status)
+        self.assertFalse(steps[4].is_active)
+
+    def test_jobs_require_failed_job_status(self):
+
+        self.connection.execute("delete from %s.job_statuses where name = 'Failed'" % self.meta_data.schema)
+
+        with self.assertRaises(RuntimeError) as context:
+            pipeline.Jobs("Test job", self.connection, self.meta_data)
+
+        self.assertIn("--upgrade-schema", str(context.exception))
+
     def test_create_and_run_multiple_jobs(self):
 
         with open("./test_pipeline_build.json") as f:
@@ -111,7 +529,7 @@ class TestLoadPipeline(unittest.TestCase):
         jobs_obj_2.create_jobs_to_run("test pipeline")
         jobs_obj_2.run_job()
 
-        ap_obj2 = pipeline.ArchivePipeline("test pipeline", self.connection, self.meta_data)
+        ap_obj2 = pipeline.ArchivePipeline("test pipeline", self.connection, self.meta_data, chunk_size=5)
         ap_obj2.archive_steps(steps=[8])
 
         num_dts_3 = len(list(self.connection.execute("select * from %s.data_transformations dts" % (self.meta_data.schema,))))
@@ -122,6 +540,60 @@ class TestLoadPipeline(unittest.TestCase):
 
         self.assertEquals(15, num_adts_3)
 
+        schema = self.meta_data.schema
+        step_flags = list(self.connection.execute("""select dts.step_number, pjdts.data_transformations_archived,
+            pjdts.data_transformations_deleted from %s.pipeline_jobs_data_transformation_steps pjdts
+          join %s.pipeline_jobs pj on pj.id = pjdts.pipeline_job_id
+          join %s.data_transformation_steps dts on dts.id = pjdts.data_transformation_step_id
+          where pj.job_id = %s order by dts.step_number""" % (schema, schema, schema, jobs_obj_2.job_id)))
+
+        self.assertEquals([(step_number, step_number == 8, True) for step_number in range(1, 10)],
+                          [tuple(r) for r in step_flags])
+
+    def test_partitioned_data_transformations(self):
+
+        self.meta_data, table_dict = schema_define.create_and_populate_schema(self.connection, self.meta_data,
+                                                                              partitioned=True)
+        schema = self.meta_data.schema
+
+        with open("./test_pipeline_build.json") as f:
+            pipeline_structure = json.load(f)
+
+        pipeline_obj = pipeline.Pipeline("test pipeline", self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test job", self.connection, self.meta_data)
+        jobs_obj.create_jobs_to_run("test pipeline")
+        jobs_obj.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results = json.load(f)
+
+        self.assertEquals(2, len(pipeline_results))
+
+        num_dts_1 = len(list(self.connection.execute("select * from %s.data_transformations dts" % (schema,))))
+        num_default_1 = len(list(self.connection.execute("select * from %s.data_transformations_default dts" % (schema,))))
+
+        self.assertTrue(num_dts_1 > 0)
+        self.assertEquals(0, num_default_1)
+
+        ap_obj = pipeline.ArchivePipeline("test pipeline", self.connection, self.meta_data)
+        ap_obj.archive_steps()
+
+        num_dts_2 = len(list(self.connection.execute("select * from %s.data_transformations dts" % (schema,))))
+        num_adts_2 = len(list(self.connection.execute("select * from %s.archived_data_transformations dts where archived_at is not null" % (schema,))))
+
+        self.assertEquals(0, num_dts_2)
+        self.assertEquals(num_dts_1, num_adts_2)
+
+        partition_names = schema_define.get_partition_names(self.connection, self.meta_data)
+        self.assertEquals(["%s.data_transformations_default" % schema],
+                          [p for p in partition_names if p.startswith("%s.data_transformations_" % schema)])
+
+        # The next test recreates a schema which is not partitioned
+        self.meta_data.reflect()
+        schema_define.create_and_populate_schema(self.connection, self.meta_data)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,211 @@
+import unittest
+import concurrent.futures
+import threading
+import time
+import models
+
+
+class TestGeneralizedLinearModels(unittest.TestCase):
+
+    def setUp(self):
+        self.parameters = {"intercept": -5.0, "X": 2.0, "Y": 1.5}
+        self.input_dicts = [{"X": 1.0}, {"X": 1.0, "Y": 1.0}, {}, {"Z": 1.0, "Y": 2.0}]
+
+    def test_score_batch_matches_score(self):
+
+        for model_class in [models.LogisticRegressionModel, models.LinearRegressionModel]:
+            model_obj = model_class(self.parameters)
+
+            scored_list = [model_obj.score(dict(input_dict)) for input_dict in self.input_dicts]
+            batch_scored_list = model_obj.score_batch([dict(input_dict) for input_dict in self.input_dicts])
+
+            self.assertEqual(len(scored_list), len(batch_scored_list))
+            for (score, meta), (batch_score, batch_meta) in zip(scored_list, batch_scored_list):
+                self.assertAlmostEqual(score, batch_score)
+                self.assertEqual(meta, batch_meta)
+
+    def test_logistic_regression_score(self):
+
+        model_obj = models.LogisticRegressionModel(self.parameters)
+        score, meta = model_obj.score({"X": 1.0, "Y": 1.0})
+
+        self.assertAlmostEqual(0.18242552380635635, score)
+        self.assertEqual([("X", 2.0), ("Y", 1.5), ("intercept", -5.0)], meta["coefficients_included"])
+        self.assertEqual([], meta["coefficients_not_included"])
+
+    def test_explanation_levels(self):
+
+        model_obj = models.LogisticRegressionModel(self.parameters)
+        score, full_meta = model_obj.score({"X": 1.0})
+
+        model_obj.set_explanation("top_k", 1)
+        top_k_score, top_k_meta = model_obj.score({"X": 1.0})
+        self.assertEqual(score, top_k_score)
+        self.assertEqual(full_meta["coefficients_included"][:1], top_k_meta["coefficients_included"])
+
+        model_obj.set_explanation("none")
+        batch_score, batch_meta = model_obj.score_batch([{"X": 1.0}])[0]
+        self.assertAlmostEqual(score, batch_score)
+        self.assertEqual({}, batch_meta)
+
+        self.assertEqual([("Y", 1.5)], full_meta["coefficients_not_included"])
+
+    def test_score_batch_with_correction_factor(self):
+
+        model_obj = models.LnLinearRegressionModelWithCorrection(self.parameters)
+        model_obj.set_correction_factor(1.1)
+
+        score, meta = model_obj.score({"X": 1.0})
+        batch_score, batch_meta = model_obj.score_batch([{"X": 1.0}])[0]
+
+        self.assertAlmostEqual(score, batch_score)
+
+
+class ResponseStub(object):
+
+    def __init__(self, json_obj):
+        self.status_code = 200
+        self.json_obj = json_obj
+
+    def json(self):
+        return self.json_obj
+
+
+class OpenScoringSessionStub(object):
+    """Stands in for the requests session of a model and answers like an OpenScoring server. The score of a record
+    is the sum of its arguments."""
+
+    def __init__(self, model_details, get_delay=0.0):
+        self.model_details = model_details
+        self.get_delay = get_delay
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def request(self, method, url, timeout=None, json=None):
+        with self.lock:
+            self.requests += [(method, url, json)]
+
+        if method == "get":
+            time.sleep(self.get_delay)
+            return ResponseStub(self.model_details)
+        elif "requests" in json:
+            return ResponseStub({"id": json["id"],
+                                 "responses": [{"id": r["id"], "result": {"y": sum(r["arguments"].values())}}
+                                               for r in json["requests"]]})
+        else:
+            return ResponseStub({"id": json["id"], "result": {"y": sum(json["arguments"].values())}})
+
+    def close(self):
+        pass
+
+    def requests_with_method(self, method):
+        return [r for r in self.requests if r[0] == method]
+
+
+class TestOpenScoringRestModel(unittest.TestCase):
+
+    def setUp(self):
+        self.url = "http://localhost:8080/openscoring/model/test_model"
+        self.model_details = {"id": "test_model", "miningFunction": "regression", "summary": "Test model",
+                              "schema": {"inputFields": [{"id": "X"}, {"id": "Y"}]}}
+        models.OpenScoringRestModel.model_details_cache.clear()
+
+    def _model_obj(self, parameters=None, get_delay=0.0):
+        model_parameters = {"url": self.url}
+        if parameters is not None:
+            model_parameters.update(parameters)
+
+        model_obj = models.OpenScoringRestModel(model_parameters)
+        model_obj.session = OpenScoringSessionStub(self.model_details, get_delay)
+        return model_obj
+
+    def test_model_details_meta(self):
+
+        score, meta = self._model_obj().score({"X": 1.0})
+        self.assertEqual({"y": 1.0}, score)
+        self.assertEqual(self.model_details, meta)
+
+        score, meta = self._model_obj({"model_details_meta": "summary"}).score({"X": 1.0})
+        self.assertEqual({"id": "test_model", "miningFunction": "regression", "summary": "Test model"}, meta)
+
+        model_obj = self._model_obj({"model_details_meta": "none"})
+        score, meta = model_obj.score({"X": 1.0})
+        self.assertEqual({}, meta)
+        self.assertEqual([], model_obj.session.requests_with_method("get"))
+
+    def test_model_details_requested_once(self):
+
+        model_obj = self._model_obj(get_delay=0.05)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            scored_list = list(executor.map(lambda x: model_obj.score({"X": x}), range(16)))
+
+        self.assertEqual(16, len(scored_list))
+        self.assertEqual([("get", self.url, None)], model_obj.session.requests_with_method("get"))
+
+        # Without a time to live the details are not shared between model objects
+        self._model_obj().score({"X": 1.0})
+        self.assertEqual({}, models.OpenScoringRestModel.model_details_cache)
+
+    def test_model_details_ttl(self):
+
+        model_obj_1 = self._model_obj({"model_details_ttl": 60})
+        model_obj_1.score({"X": 1.0})
+        model_obj_2 = self._model_obj({"model_details_ttl": 60})
+        model_obj_2.score({"X": 1.0})
+
+        self.assertEqual(1, len(model_obj_1.session.requests_with_method("get")))
+        self.assertEqual(0, len(model_obj_2.session.requests_with_method("get")))
+
+        # Details requested longer ago than the time to live are requested again
+        requested_time, model_details = models.OpenScoringRestModel.model_details_cache[self.url]
+        models.OpenScoringRestModel.model_details_cache[self.url] = (requested_time - 120, model_details)
+
+        model_obj_3 = self._model_obj({"model_details_ttl": 60})
+        model_obj_3.score({"X": 1.0})
+        self.assertEqual(1, len(model_obj_3.session.requests_with_method("get")))
+        self.assertGreater(models.OpenScoringRestModel.model_details_cache[self.url][0], requested_time)
+
+    def test_score_batch_record_ids(self):
+
+        model_obj = self._model_obj()
+        scored_list = model_obj.score_batch([{"X": 1.0}, {"X": 2.0}])
+
+        self.assertEqual([{"y": 1.0}, {"y": 2.0}], [score for score, meta in scored_list])
+        self.assertEqual(["record 1", "record 2"],
+                         [r[2]["id"] for r in model_obj.session.requests_with_method("post")])
+
+        # Common ids of the rows are sent as record ids
+        model_obj.score_batch([{"X": 1.0}], [1000])
+        self.assertEqual("1000", model_obj.session.requests_with_method("post")[-1][2]["id"])
+
+    def test_score_batch_with_batch_endpoint(self):
+
+        model_obj = self._model_obj({"batch": True})
+        input_dicts = [{"X": 1.0, "Y": 1.0}, {"X": 2.0}]
+        scored_list = model_obj.score_batch(input_dicts, ["1000", "2000"])
+
+        self.assertEqual([({"y": 2.0}, self.model_details), ({"y": 2.0}, self.model_details)], scored_list)
+
+        post_requests = model_obj.session.requests_with_method("post")
+        self.assertEqual(1, len(post_requests))
+        self.assertEqual(self.url + "/batch", post_requests[0][1])
+        self.assertEqual({"id": "batch 1000",
+                          "requests": [{"id": "1000", "arguments": {"X": 1.0, "Y": 1.0}},
+                                       {"id": "2000", "arguments": {"X": 2.0}}]}, post_requests[0][2])
+
+        model_obj = self._model_obj({"batch": True, "batch_url": "http://localhost:8080/batch"})
+        model_obj.score_batch(input_dicts)
+        self.assertEqual("http://localhost:8080/batch", model_obj.session.requests_with_method("post")[0][1])
+
+    def test_score_batch_record_not_scored(self):
+
+        model_obj = self._model_obj({"batch": True})
+        model_obj.session.request = lambda method, url, timeout=None, json=None: ResponseStub(
+            {"id": json["id"], "responses": [{"id": "1000", "message": "Missing argument X"}]})
+
+        self.assertRaises(RuntimeError, model_obj.score_batch, [{"Y": 1.0}], ["1000"])
+
+
+if __name__ == '__main__':
+    unittest.main()
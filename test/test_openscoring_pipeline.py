@@ -30,6 +30,10 @@ class TestOpenScoringPipeline(unittest.TestCase):
         if os.path.exists("./test_output.json"):
             os.remove("./test_output.json")
 
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
     def test_open_scoring_pipeline(self):
 
         with open("./test_pipeline_build_openscoring.json") as f:
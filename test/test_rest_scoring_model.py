@@ -29,6 +29,10 @@ class TestRestModel(unittest.TestCase):
         if os.path.exists("./test_output.json"):
             os.remove("./test_output.json")
 
+    def tearDown(self):
+        self.connection.close()
+        self.engine.dispose()
+
     def test_create_and_run_rest_job(self):
 
         with open("./test_pipeline_build_rest.json") as f:
@@ -44,6 +48,54 @@ class TestRestModel(unittest.TestCase):
 
         jobs_obj.run_job()
 
+    def test_create_and_run_rest_job_with_batches(self):
+
+        with open("./test_pipeline_build_rest.json") as f:
+            pipeline_structure = json.load(f)
+
+        for step in pipeline_structure:
+            if step["data_transformation_class"] == "Score":
+                step["parameters"]["model_parameters"]["batch_url"] = "http://localhost:5000/logistic_regression/batch/"
+
+        pipeline_name = "test rest batch scoring pipeline"
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test rest batch scoring job", self.connection, self.meta_data)
+        jobs_obj.create_jobs_to_run(pipeline_name)
+
+        jobs_obj.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results = json.load(f)
+
+        self.assertEqual(2, len(pipeline_results))
+
+    def test_create_and_run_rest_job_concurrently(self):
+
+        with open("./test_pipeline_build_rest.json") as f:
+            pipeline_structure = json.load(f)
+
+        for step in pipeline_structure:
+            if step["data_transformation_class"] == "Score":
+                step["parameters"]["max_in_flight"] = 4
+
+        pipeline_name = "test rest concurrent scoring pipeline"
+
+        pipeline_obj = pipeline.Pipeline(pipeline_name, self.connection, self.meta_data)
+        pipeline_obj.load_steps_into_db(pipeline_structure)
+
+        jobs_obj = pipeline.Jobs("Test rest concurrent scoring job", self.connection, self.meta_data)
+        jobs_obj.create_jobs_to_run(pipeline_name)
+
+        jobs_obj.run_job()
+
+        with open("./test_output.json") as f:
+            pipeline_results = json.load(f)
+
+        self.assertEqual(2, len(pipeline_results))
+
 
 if __name__ == '__main__':
     unittest.main()